@@ -0,0 +1,103 @@
+from typing import Iterable, List, Union
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from torch import Tensor
+
+from redkg.n_hop_index import NHopIndex
+
+Ids = Union[NDArray, Iterable[int]]
+
+
+class CandidateSet:
+    """Deduplicated candidate items of one recommendation session
+
+    Membership is kept in boolean masks over all items and the active candidates in an
+    append-only id buffer, so adding neighbours costs O(added) and listing the candidates
+    needs neither a set nor a sort. Consumed items are never candidates again; they are
+    dropped from the buffer lazily, once they make up half of it.
+
+    :param num_items: (int) number of item ids, ids are in [0, num_items)
+    """
+
+    def __init__(self, num_items: int) -> None:
+        self.num_items = num_items
+        self.is_candidate = np.zeros(num_items, dtype=bool)
+        self.is_consumed = np.zeros(num_items, dtype=bool)
+        self._ids = np.zeros(64, dtype=np.int64)
+        self._size = 0
+        self._num_active = 0
+        self._consumed: List[NDArray] = []
+
+    def __len__(self) -> int:
+        return self._num_active
+
+    def __contains__(self, item_id: int) -> bool:
+        return bool(self.is_candidate[item_id])
+
+    def add(self, ids: Ids) -> int:
+        """Add items that are neither candidates nor consumed yet
+
+        :param ids: item ids
+        :returns: (int) number of new candidates
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        new = np.unique(ids[~self.is_candidate[ids] & ~self.is_consumed[ids]])
+        if self._size + len(new) > len(self._ids):
+            self._ids = np.resize(self._ids, max(2 * len(self._ids), self._size + len(new)))
+        self._ids[self._size : self._size + len(new)] = new
+        self._size += len(new)
+        self._num_active += len(new)
+        self.is_candidate[new] = True
+        return len(new)
+
+    def add_neighbors(self, n_hop_index: NHopIndex, item_id: int, hops: Iterable[int] = (1,)) -> int:
+        """Add the KG neighbours of an item
+
+        :param n_hop_index: (NHopIndex) n-hop neighbourhoods
+        :param item_id: (int) item id
+        :param hops: (Iterable[int]) hop distances to add
+        :returns: (int) number of new candidates
+        """
+        return sum(self.add(n_hop_index.neighbors_of(item_id, hop)) for hop in hops)
+
+    def consume(self, ids: Ids) -> None:
+        """Mark items as consumed, e.g. watched or already recommended
+
+        :param ids: item ids
+        """
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[~self.is_consumed[ids]]
+        self._num_active -= int(self.is_candidate[ids].sum())
+        self.is_candidate[ids] = False
+        self.is_consumed[ids] = True
+        self._consumed.append(ids)
+        if 2 * self._num_active < self._size:
+            active = self._ids[: self._size][self.is_candidate[self._ids[: self._size]]]
+            self._ids[: len(active)] = active
+            self._size = len(active)
+
+    def active_ids(self) -> NDArray:
+        """Candidate ids in the order they were added
+
+        :returns: (NDArray) item ids
+        """
+        ids = self._ids[: self._size]
+        return ids[self.is_candidate[ids]]
+
+    def active_tensor(self) -> Tensor:
+        """Candidate ids as a tensor for one batched scoring call
+
+        :returns: (Tensor) item ids
+        """
+        return torch.from_numpy(self.active_ids())
+
+    def reset(self) -> None:
+        """Clear the set for a new session, touching only the entries set so far"""
+        self.is_candidate[self._ids[: self._size]] = False
+        for ids in self._consumed:
+            self.is_consumed[ids] = False
+        self._size = 0
+        self._num_active = 0
+        self._consumed = []
@@ -6,6 +6,11 @@ class Config:
         self.raw_data_dir = "./raw_data"
         self.preprocess_results_dir = f"./data/{self.dataset_name}"
 
+        # Parameters of the preprocessing run
+        self.use_stage_cache = True  # Skip preprocessing stages whose inputs and parameters did not change
+        self.num_workers = 1  # Number of processes parsing large input files
+        self.chunk_size = 1 << 28  # Bytes of an input file parsed by one process at a time
+
         # Raw data file paths
         self.kg_path = f"{self.raw_data_dir}/{self.dataset_name}/kg.txt"
         self.item2entity_path = f"{self.raw_data_dir}/{self.dataset_name}/item_index2entity_id.txt"
@@ -19,14 +24,29 @@ class Config:
 
         # Parameters to preprocess kg.txt
         self.hops = 2
+        self.entity_vocab_size = 30000  # Entity vocab is filled up to this size with the most frequent KG tails
 
         # Parameters to split train test val
         self.train_proportion = 0.8
         self.test_proportion = 0.1
         self.validation_proportion = 0.1
+        self.split_seed = 14  # Seed of the permutation that splits the users
         assert sum([self.train_proportion, self.test_proportion, self.validation_proportion]) == 1.0
 
         # KGQR train
+        self.adj_path = f"{self.preprocess_results_dir}/kg_adj_mat.npz"  # KG adjacency of the GCN layers
         self.epochs = 100
         self.item_embed_dim = 50  # Dimension of item embedding
         self.state_embed_dim = 20  # Dimension of user embedding
+        self.replay_capacity = 10000  # Number of transitions kept in the replay buffer
+        self.replay_batch_size = 10  # Number of transitions per DQN optimization step
+        self.prioritized_replay = False  # Sample transitions proportionally to their TD errors
+        self.replay_alpha = 0.6  # How much the priorities skew prioritized sampling, 0 is uniform
+        self.replay_beta = 0.4  # Strength of the importance sampling correction of prioritized sampling
+        self.discount = 0.1  # Discount factor of the Bellman target
+        self.target_update = 100  # Steps between hard copies of the policy network into the target network
+        self.target_soft_update = 0.0  # Rate of soft target updates after every step, 0 for hard copies only
+        self.epsilon = 0.3  # Exploration rate of the epsilon greedy policy
+        self.num_rollout_workers = 4  # Actor processes of TrainPipeline.run_parallel
+        self.rollout_envs = 16  # Concurrent user sessions per actor
+        self.policy_sync_interval = 50  # Actor steps between copies of the shared policy network
@@ -1,14 +1,30 @@
-from collections import defaultdict
-from typing import Any, Dict, Generator, List, Optional, Tuple
+import logging
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 import torch
+from numpy.typing import NDArray
 from torch import Tensor
 from torch.utils.data import DataLoader, Dataset
 
+from redkg.triple_format import MappedArray, MappedColumn, factorize
+from redkg.triple_store import CountView, KnownEntitiesView, TripleStore
+
 
 class TrainDataset(Dataset):
-    """Dataset with training data"""
+    """Dataset with training data
+
+    The dataset keeps references to the triple columns: arrays from
+    :func:`redkg.triple_format.load_triples` stay memory mapped and are pickled as their file
+    paths, so DataLoader workers map the same files. A DataLoader fetches a whole batch through
+    ``__getitems__``: the rows are gathered and shifted by their entity type offsets, negatives
+    are drawn with one vectorized call and everything is returned as contiguous tensors.
+    Subsampling weights do not depend on the mode, the tail-batch dataset can reuse the
+    array of the head-batch one.
+    """
+
+    _columns = ("head", "relation", "tail", "head_codes", "tail_codes", "subsampling_weight")
 
     def __init__(
         self,
@@ -17,71 +33,158 @@ class TrainDataset(Dataset):
         nrelation: int,
         negative_sample_size: int,
         mode: str,
-        count: Dict,
+        count: Union[Dict, TripleStore],
         entity_dict: Optional[Dict[str, List[Any]]] = None,
         negative_mode: str = "full",
+        subsampling_weight: Optional[NDArray] = None,
     ) -> None:
+        if mode not in ("head-batch", "tail-batch"):
+            raise ValueError(f"Not supported mode: {mode}")
         self.len = len(triples["head"])
-        self.triples = triples
         self.nentity = nentity
         self.nrelation = nrelation
         self.negative_sample_size = negative_sample_size
         self.mode = mode
         self.count = count
         self.entity_dict = entity_dict
+        self.negative_mode = negative_mode
         if negative_mode == "simple":
             self.negative_sample = self._gen_negative_s
         elif negative_mode == "full":
             self.negative_sample = self._gen_negative_f
 
+        self.head, self.relation, self.tail = (_int_column(triples[column]) for column in ("head", "relation", "tail"))
+        self.head_codes: Optional[NDArray] = None
+        self.tail_codes: Optional[NDArray] = None
+        if self.entity_dict:
+            # Rows keep their type codes, the [low, high) id range of a type is looked up per batch
+            self.head_codes, self.head_ranges = self._type_ranges(triples["head_type"])
+            self.tail_codes, self.tail_ranges = self._type_ranges(triples["tail_type"])
+        elif negative_mode == "full":
+            logging.warning(
+                "negative_mode='full' without entity_dict: negatives are sampled uniformly over all %d entities, "
+                "as with negative_mode='simple'",
+                nentity,
+            )
+
+        if subsampling_weight is None:
+            subsampling_weight = self._subsampling_weight(triples)
+        self.subsampling_weight = subsampling_weight
+
+    def _subsampling_weight(self, triples: Dict[str, Any], block_size: int = 1 << 20) -> NDArray:
+        """Subsampling weights of all triples, computed ``block_size`` rows at a time"""
+        weights = np.empty(self.len, dtype=np.float32)
+        for start in range(0, self.len, block_size):
+            rows = np.arange(start, min(start + block_size, self.len))
+            if isinstance(self.count, TripleStore):
+                weights[rows] = self.count.subsampling_weight(*self._positive_columns(rows))
+            elif self.entity_dict:
+                head_type, tail_type = (np.asarray(triples[column])[rows] for column in ("head_type", "tail_type"))
+                weights[rows] = self._count_subsampling_weight(
+                    self.head[rows], self.relation[rows], self.tail[rows], head_type, tail_type
+                )
+            else:
+                none = np.full(len(rows), None)
+                weights[rows] = self._count_subsampling_weight(
+                    self.head[rows], self.relation[rows], self.tail[rows], none, none
+                )
+        return weights
+
+    def _positive_columns(self, idx: NDArray) -> Tuple[NDArray, NDArray, NDArray]:
+        """Global head, relation and tail ids of the rows"""
+        head = self.head[idx].astype(np.int64)
+        relation = self.relation[idx].astype(np.int64)
+        tail = self.tail[idx].astype(np.int64)
+        if self.head_codes is not None and self.tail_codes is not None:
+            head += self.head_ranges[0][self.head_codes[idx]]
+            tail += self.tail_ranges[0][self.tail_codes[idx]]
+        return head, relation, tail
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        for name in self._columns:
+            column = state[name]
+            if isinstance(column, MappedArray) and column.source is not None:
+                state[name] = column.source
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name in self._columns:
+            if isinstance(state[name], MappedColumn):
+                state[name] = state[name].open()
+        self.__dict__.update(state)
+
     def __len__(self) -> int:
         return self.len
 
-    def _gen_negative_s(
-        self, head: int, relation: int, tail: int, head_type: str, tail_type: str
-    ) -> Tuple[Tensor, Tensor]:
-        subsampling_weight = self.count[(head, relation)] + self.count[(tail, -relation - 1)]
-        subsampling_weight = torch.sqrt(1 / torch.Tensor([subsampling_weight]))
-        return torch.randint(0, self.nentity, (self.negative_sample_size,)), subsampling_weight
-
-    def _gen_negative_f(
-        self, head: int, relation: int, tail: int, head_type: str, tail_type: str
-    ) -> Tuple[Tensor, Tensor]:
-        subsampling_weight = self.count[(head, relation, head_type)] + self.count[(tail, -relation - 1, tail_type)]
-        subsampling_weight = torch.sqrt(1 / torch.Tensor([subsampling_weight]))
-        if self.mode == "head-batch":
-            negative_sample = torch.randint(
-                self.entity_dict[head_type][0], self.entity_dict[head_type][1], (self.negative_sample_size,)  # type: ignore
-            )
-        elif self.mode == "tail-batch":
-            negative_sample = torch.randint(
-                self.entity_dict[tail_type][0], self.entity_dict[tail_type][1], (self.negative_sample_size,)  # type: ignore
-            )
+    def _count_subsampling_weight(
+        self, head: NDArray, relation: NDArray, tail: NDArray, head_type: Any, tail_type: Any
+    ) -> NDArray:
+        """Subsampling weights from a ``count`` dict keyed by (entity, relation[, type]) tuples"""
+        if self.negative_mode == "simple":
+            keys = zip(zip(head.tolist(), relation.tolist()), zip(tail.tolist(), (-relation - 1).tolist()))
         else:
-            raise
-
-        return negative_sample, subsampling_weight
+            keys = zip(
+                zip(head.tolist(), relation.tolist(), np.asarray(head_type).tolist()),
+                zip(tail.tolist(), (-relation - 1).tolist(), np.asarray(tail_type).tolist()),
+            )
+        subsampling_weight = np.fromiter(
+            (self.count[head_key] + self.count[tail_key] for head_key, tail_key in keys),  # type: ignore
+            dtype=np.float64,
+            count=len(head),
+        )
+        return np.sqrt(1 / subsampling_weight).astype(np.float32)
+
+    def _type_ranges(self, types: Any) -> Tuple[NDArray, Tuple[NDArray, NDArray]]:
+        """Type code of every row and the entity id ranges [low, high) of every code"""
+        codes, uniques = factorize(types)
+        low = np.array([self.entity_dict[t][0] for t in uniques], dtype=np.int64)  # type: ignore
+        high = np.array([self.entity_dict[t][1] for t in uniques], dtype=np.int64)  # type: ignore
+        return codes, (low, high)
+
+    def _gen_negative_s(self, idx: NDArray) -> Tensor:
+        return torch.randint(0, self.nentity, (len(idx), self.negative_sample_size))
+
+    def _gen_negative_f(self, idx: NDArray) -> Tensor:
+        if self.head_codes is None or self.tail_codes is None:
+            # Untyped entities, warned about in __init__
+            return self._gen_negative_s(idx)
+        codes, (low_by_code, high_by_code) = (
+            (self.head_codes, self.head_ranges) if self.mode == "head-batch" else (self.tail_codes, self.tail_ranges)
+        )
+        row_codes = codes[idx]
+        low = torch.from_numpy(low_by_code[row_codes]).unsqueeze(1)
+        span = torch.from_numpy(high_by_code[row_codes] - low_by_code[row_codes]).unsqueeze(1)
+        uniform = torch.rand((len(idx), self.negative_sample_size), dtype=torch.float64)
+        return low + (uniform * span).long()
 
     def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor, Tensor, str]:
-        head, relation, tail = self.triples["head"][idx], self.triples["relation"][idx], self.triples["tail"][idx]
-        if self.entity_dict:
-            head_type, tail_type = self.triples["head_type"][idx], self.triples["tail_type"][idx]
-            positive_sample = [head + self.entity_dict[head_type][0], relation, tail + self.entity_dict[tail_type][0]]
-        else:
-            positive_sample = [head, relation, tail]
-            head_type, tail_type = None, None
+        positive_sample = torch.from_numpy(np.stack(self._positive_columns(np.array([idx])), axis=1)[0])
+        negative_sample = self.negative_sample(np.array([idx]))[0]
+        subsampling_weight = torch.from_numpy(self.subsampling_weight[idx : idx + 1])
+        return positive_sample, negative_sample, subsampling_weight, self.mode
+
+    def __getitems__(self, indices: List[int]) -> Tuple[Tensor, Tensor, Tensor, str]:
+        """Build a whole batch at once
 
-        negative_sample, subsampling_weight = self.negative_sample(head, relation, tail, head_type, tail_type)
-        positive_sample = torch.LongTensor(positive_sample)
+        :param indices: indices of the triples in the batch
+        :returns: (Tuple[Tensor, Tensor, Tensor, str]) positive_sample, negative_sample, subsample_weight, mode
+        """
+        idx = np.asarray(indices, dtype=np.int64)
+        positive_sample = torch.from_numpy(np.stack(self._positive_columns(idx), axis=1))
+        negative_sample = self.negative_sample(idx)
+        subsampling_weight = torch.from_numpy(self.subsampling_weight[idx])
         return positive_sample, negative_sample, subsampling_weight, self.mode
 
     @staticmethod
-    def collate_fn(data: List[Any]) -> Tuple[Tensor, Tensor, Tensor, str]:
+    def collate_fn(data: Union[List[Any], Tuple[Tensor, Tensor, Tensor, str]]) -> Tuple[Tensor, Tensor, Tensor, str]:
         """Collate
 
-        :param data: data to collate
+        :param data: data to collate, either a list of samples or a batch already built by ``__getitems__``
         :returns: (Tuple[Tensor, Tensor, Tensor, str]) positive_sample, negative_sample, subsample_weight, mode
         """
+        if isinstance(data, tuple):
+            return data
         positive_sample = torch.stack([_[0] for _ in data], dim=0)
         negative_sample = torch.stack([_[1] for _ in data], dim=0)
         subsample_weight = torch.cat([_[2] for _ in data], dim=0)
@@ -89,8 +192,19 @@ class TrainDataset(Dataset):
         return positive_sample, negative_sample, subsample_weight, mode
 
 
+def _int_column(column: Any) -> NDArray:
+    """Integer column as an array, without copying an integer NumPy array or memory map"""
+    if isinstance(column, np.ndarray) and column.dtype.kind in "iu":
+        return column
+    return np.asarray(column, dtype=np.int64)
+
+
 class TestDataset(Dataset):
-    """Dataset with test data"""
+    """Dataset with test data
+
+    Triples may come from :func:`redkg.triple_format.load_triples`: negative candidates are
+    then fixed-width memory mapped matrices and ``__getitems__`` reads a whole batch of rows at once.
+    """
 
     def __init__(self, triples: Dict[str, Any], args: Any, mode: str, random_sampling: bool):
         self.len = len(triples["head"])
@@ -128,13 +242,40 @@ class TestDataset(Dataset):
 
         return positive_sample, negative_sample, self.mode
 
+    def __getitems__(self, indices: List[int]) -> Tuple[Tensor, Tensor, str]:
+        """Build a whole batch at once
+
+        :param indices: indices of the triples in the batch
+        :returns: (Tuple[Tensor, Tensor, str]) positive_sample, negative_sample, mode
+        """
+        if self.mode not in ("head-batch", "tail-batch"):
+            raise ValueError(f"Not supported mode: {self.mode}")
+        idx = np.asarray(indices, dtype=np.int64)
+        head, relation, tail = (np.asarray(self.triples[column])[idx] for column in ("head", "relation", "tail"))
+        positive_sample = torch.from_numpy(np.stack([head, relation, tail], axis=1).astype(np.int64))
+
+        target = head if self.mode == "head-batch" else tail
+        if self.random_sampling:
+            candidates = torch.randint(0, self.nentity, size=(len(idx), self.neg_size))
+        else:
+            column = self.triples["head_neg" if self.mode == "head-batch" else "tail_neg"]
+            if isinstance(column, np.ndarray) and column.ndim == 2:
+                rows = column[idx]
+            else:
+                rows = np.stack([np.asarray(column[i]) for i in indices])
+            candidates = torch.from_numpy(rows.astype(np.int64, copy=False))
+        negative_sample = torch.cat([torch.from_numpy(target.astype(np.int64)).unsqueeze(1), candidates], dim=1)
+        return positive_sample, negative_sample, self.mode
+
     @staticmethod
-    def collate_fn(data: List[Any]) -> Tuple[Tensor, Tensor, str]:
+    def collate_fn(data: Union[List[Any], Tuple[Tensor, Tensor, str]]) -> Tuple[Tensor, Tensor, str]:
         """Collate
 
-        :param data: data to collate
+        :param data: data to collate, either a list of samples or a batch already built by ``__getitems__``
         :returns: (Tuple[Tensor, Tensor, Tensor, str]) positive_sample, negative_sample, mode
         """
+        if isinstance(data, tuple):
+            return data
         positive_sample = torch.stack([_[0] for _ in data], dim=0)
         negative_sample = torch.stack([_[1] for _ in data], dim=0)
         mode = data[0][2]
@@ -178,7 +319,10 @@ def get_info(
 
     :param dataset: Dataset
     :param triples: (Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]) Dicts with triples splitted by train test and validation
-    :returns: Tuple[number of entities, numbers of relations, volume train, volume validdation, volume_test, info_log]
+    :returns: Tuple[number of entities, numbers of relations, volume train, volume validdation, volume_test, info_log];
+        with a dataset, a Dict with the numbers of entities and relations, the entity types and
+        a ``TripleStore`` with the triple statistics; 'count', 'true_head' and 'true_tail' are
+        read-only views of the store in place of the former dicts
     """
     if dataset is None:
         train, test, valid = triples
@@ -205,25 +349,15 @@ def get_info(
         nentity = dataset.nentity
         nrelation = dataset.nrelation
 
-    count, true_head, true_tail = defaultdict(lambda: 4), defaultdict(list), defaultdict(list)  # type: ignore
-    for i in range(len(triples["head"])):  # type: ignore
-        head, relation, tail = triples["head"][i], triples["relation"][i], triples["tail"][i]  # type: ignore
-        if do_count:
-            head_type, tail_type = triples["head_type"][i], triples["tail_type"][i]  # type: ignore
-            count[(head, relation, head_type)] += 1
-            count[(tail, -relation - 1, tail_type)] += 1
-        else:
-            count[(head, relation)] += 1  # type: ignore
-            count[(tail, -relation - 1)] += 1  # type: ignore
-        true_head[(relation, tail)].append(head)
-        true_tail[(head, relation)].append(tail)
+    triple_store = TripleStore.from_triples(triples, nentity, nrelation, entity_dict)  # type: ignore
 
     info = {
         "nentity": nentity,
         "nrelation": nrelation,
-        "count": count,
-        "true_head": true_head,
-        "true_tail": true_tail,
+        "triple_store": triple_store,
+        "count": CountView(triple_store, entity_dict),
+        "true_head": KnownEntitiesView(triple_store, "head"),
+        "true_tail": KnownEntitiesView(triple_store, "tail"),
         "entity_dict": entity_dict,
     }
 
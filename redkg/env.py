@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from numpy.typing import NDArray
@@ -7,39 +7,199 @@ from redkg.config import Config
 from redkg.utils import pickle_load
 
 
+class RatingStore:
+    """Ratings of all users in flat arrays grouped by user
+
+    Items and rates of the user in row ``u`` are ``items[offsets[u]:offsets[u + 1]]`` and
+    ``rates[offsets[u]:offsets[u + 1]]`` in interaction order. The same ranges of
+    ``sorted_items`` and ``sorted_rates`` hold them sorted by item for binary search.
+
+    :param user_ids: (NDArray) user id of every row
+    :param offsets: (NDArray) start of every user's range, shape (num_users + 1,)
+    :param items: (NDArray) item ids
+    :param rates: (NDArray) rates
+    """
+
+    def __init__(self, user_ids: NDArray, offsets: NDArray, items: NDArray, rates: NDArray) -> None:
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.items = items
+        self.rates = rates
+        self.user_rows = {user_id: row for row, user_id in enumerate(user_ids.tolist())}
+
+        rows = np.repeat(np.arange(len(user_ids)), np.diff(offsets))
+        # Stable, so the first interaction with a repeated item comes first
+        order = np.lexsort((items, rows))
+        self.sorted_items = items[order]
+        self.sorted_rates = rates[order]
+        # (row, item) pairs folded into one sorted int64 key for batched lookups
+        self._key_base = int(items.max()) + 1 if len(items) else 1
+        self._keys = rows[order] * self._key_base + self.sorted_items
+        self._user_order = np.argsort(user_ids, kind="stable")
+
+    @classmethod
+    def from_rating_dict(cls, rating_dict: Dict[int, List[List]]) -> "RatingStore":
+        """Build the store from a dict of user id -> [item, rate, ...] records
+
+        :param rating_dict: (Dict[int, List[List]]) records of every user
+        :returns: (RatingStore) store
+        """
+        lengths = np.fromiter((len(records) for records in rating_dict.values()), dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        items = np.fromiter(
+            (record[0] for records in rating_dict.values() for record in records), dtype=np.int64, count=offsets[-1]
+        )
+        rates = np.fromiter(
+            (record[1] for records in rating_dict.values() for record in records), dtype=np.float64, count=offsets[-1]
+        )
+        return cls(np.fromiter(rating_dict.keys(), dtype=np.int64), offsets, items, rates)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def user_range(self, user_id: int) -> Tuple[int, int]:
+        """Range of a user's ratings in the flat arrays"""
+        row = self.user_rows[user_id]
+        return int(self.offsets[row]), int(self.offsets[row + 1])
+
+    def rate(self, user_id: int, item_id: int) -> float:
+        """Rate given by a user to an item, 0 if the user did not interact with it"""
+        start, end = self.user_range(user_id)
+        position = start + int(np.searchsorted(self.sorted_items[start:end], item_id))
+        if position < end and self.sorted_items[position] == item_id:
+            return float(self.sorted_rates[position])
+        return 0
+
+    def user_rows_of(self, user_ids: NDArray) -> NDArray:
+        """Rows of many users at once, -1 for unknown users"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if not len(self.user_ids):
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.user_ids, user_ids, sorter=self._user_order), len(self.user_ids) - 1)
+        rows = self._user_order[position]
+        return np.where(self.user_ids[rows] == user_ids, rows, -1)
+
+    def rate_batch(self, user_ids: NDArray, item_ids: NDArray) -> NDArray:
+        """Rates of many (user, item) pairs with one binary search over the composite keys
+
+        :param user_ids: (NDArray) user ids
+        :param item_ids: (NDArray) item ids
+        :returns: (NDArray) rates, 0 where the user did not interact with the item
+        """
+        rows, item_ids = self.user_rows_of(user_ids), np.asarray(item_ids, dtype=np.int64)
+        if not len(self._keys):
+            return np.zeros(len(item_ids))
+        valid = (rows >= 0) & (item_ids >= 0) & (item_ids < self._key_base)
+        keys = np.where(valid, rows * self._key_base + item_ids, -1)
+        position = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        return np.where(valid & (self._keys[position] == keys), self.sorted_rates[position], 0.0)
+
+
 class Simulator:
     """Custom Environment that follows gym interface"""
 
     def __init__(self, config: Config, mode: str) -> None:
-        self.rating_dict = pickle_load(f"{config.preprocess_results_dir}/{mode}_data_dict.pkl")
-        self.user_ids = list(self.rating_dict.keys())
+        self.ratings = RatingStore.from_rating_dict(
+            pickle_load(f"{config.preprocess_results_dir}/{mode}_data_dict.pkl")
+        )
+        self.user_ids = self.ratings.user_ids
         self.num_users = len(self.user_ids)
 
     def __len__(self) -> int:
-        return len(self.rating_dict)
+        return self.num_users
 
     def get_user_data(self, user_idx: int) -> Tuple[int, NDArray, NDArray]:
         """Get user data by user index
 
         :param user_idx: (int) index of user
-        :returns: (Tuple[int, NDArray, NDArray]) User ID, Array with items, Array with Rates
+        :returns: (Tuple[int, NDArray, NDArray]) User ID, Array with items, Array with Rates, as views of the store
         """
-        user_id = self.user_ids[user_idx % self.num_users]
-        user_ratings = np.array(self.rating_dict[user_id])
-        item_ids, rates = user_ratings[:, 0].astype(np.int), user_ratings[:, 1].astype(np.float)
-        return user_id, item_ids, rates
+        user_id = int(self.user_ids[user_idx % self.num_users])
+        start, end = self.ratings.user_range(user_id)
+        return user_id, self.ratings.items[start:end], self.ratings.rates[start:end]
 
-    def step(self, user_id: int, recommended_item_id: int) -> int:
+    def step(self, user_id: int, recommended_item_id: int) -> float:
         """Executes a step in the environment by applying an action. Returns the new observation and reward.
 
         :param user_id: Current agent (user)
         :param recommended_item_id: Action (selected item)
         :return: reward (0 if not interaction, attribute otherwise)
         """
-        user_ratings = np.array(self.rating_dict[user_id])
-        item_ids, rates = user_ratings[:, 0].astype(np.int), user_ratings[:, 1].astype(np.float)
-        try:
-            t = np.where(item_ids == recommended_item_id)[0][0]
-            return rates[t]
-        except IndexError:  # User did not interacted with recommended item
-            return 0
+        return self.ratings.rate(user_id, recommended_item_id)
+
+    def step_batch(self, user_ids: NDArray, recommended_item_ids: NDArray) -> NDArray:
+        """Executes a step for many users at once
+
+        :param user_ids: (NDArray) agents (users)
+        :param recommended_item_ids: (NDArray) actions (selected items), one per user
+        :return: (NDArray) rewards (0 if not interaction, attribute otherwise)
+        """
+        return self.ratings.rate_batch(user_ids, recommended_item_ids)
+
+
+class VectorSimulator:
+    """Runs sessions of ``num_envs`` users side by side over one :class:`Simulator`
+
+    Every slot replays the history of one user. A session ends after as many steps as the
+    user has ratings; the slot then moves on to the next user, cycling over all users.
+    Users without ratings have no session and are skipped.
+
+    :param simulator: (Simulator) environment with the ratings
+    :param num_envs: (int) number of concurrent sessions
+    :param user_indices: (Optional[NDArray]) indices of the users to cycle over, all users if not given
+    :raises ValueError: if none of the users has ratings
+    """
+
+    def __init__(self, simulator: Simulator, num_envs: int, user_indices: Optional[NDArray] = None) -> None:
+        self.simulator = simulator
+        self.num_envs = num_envs
+        self.lengths = np.diff(simulator.ratings.offsets)
+        user_indices = np.arange(simulator.num_users) if user_indices is None else np.asarray(user_indices)
+        self.user_indices = user_indices[self.lengths[user_indices] > 0]
+        if not len(self.user_indices):
+            raise ValueError("No user with ratings to simulate")
+        self.user_idx = np.zeros(num_envs, dtype=np.int64)
+        self.t = np.zeros(num_envs, dtype=np.int64)
+        self._next_user = 0
+
+    def reset(self) -> NDArray:
+        """Start sessions of the next ``num_envs`` users
+
+        :returns: (NDArray) user ids of the slots
+        """
+        self._assign(np.arange(self.num_envs))
+        return self.user_ids
+
+    def _assign(self, slots: NDArray) -> None:
+        num_users = len(self.user_indices)
+        self.user_idx[slots] = self.user_indices[(self._next_user + np.arange(len(slots))) % num_users]
+        self.t[slots] = 0
+        self._next_user = (self._next_user + len(slots)) % num_users
+
+    @property
+    def user_ids(self) -> NDArray:
+        """User id of every slot"""
+        return self.simulator.user_ids[self.user_idx]
+
+    def observe(self) -> Tuple[NDArray, NDArray, NDArray]:
+        """Current interaction of every session
+
+        :returns: (Tuple[NDArray, NDArray, NDArray]) user ids, item ids and rates
+        """
+        position = self.simulator.ratings.offsets[self.user_idx] + self.t
+        return self.user_ids, self.simulator.ratings.items[position], self.simulator.ratings.rates[position]
+
+    def step(self, recommended_item_ids: NDArray) -> Tuple[NDArray, NDArray]:
+        """Recommend one item in every session and advance all of them
+
+        Finished sessions are restarted with the next users before returning.
+
+        :param recommended_item_ids: (NDArray) one item per slot
+        :returns: (Tuple[NDArray, NDArray]) rewards and done flags of the step
+        """
+        rewards = self.simulator.step_batch(self.user_ids, recommended_item_ids)
+        self.t += 1
+        dones = self.t >= self.lengths[self.user_idx]
+        self._assign(np.flatnonzero(dones))
+        return rewards, dones
@@ -1,27 +1,188 @@
-from typing import Any, Dict, List, Tuple
+import warnings
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union, overload
 
+import numpy as np
 import torch
+from numpy.typing import NDArray
+from torch import Tensor
+
+TIE_MODES = ("optimistic", "pessimistic", "realistic")
+# Rank of a positive among equal scores unless stated otherwise, the mean of the optimistic and pessimistic ranks
+DEFAULT_TIES = "realistic"
+# Cut-offs of the Hits@K metrics unless stated otherwise
+DEFAULT_HITS_AT = (1, 3, 10)
+
+
+class _ClassCallable:
+    """Instance method that can still be called on the class, as a deprecated staticmethod
+
+    On the class the method is bound to ``owner(**class_kwargs)`` and a DeprecationWarning is emitted.
+    """
+
+    def __init__(self, method: Callable[..., Any], **class_kwargs: Any) -> None:
+        self.method = method
+        self.class_kwargs = class_kwargs
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance: Any, owner: type) -> Callable[..., Any]:
+        if instance is None:
+            warnings.warn(
+                f"Calling {owner.__name__}.{self.method.__name__} on the class is deprecated, "
+                "call it on an instance. The class call keeps the former behaviour with "
+                + ", ".join(f"{name}={value!r}" for name, value in self.class_kwargs.items()),
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            instance = owner(**self.class_kwargs)
+        return self.method.__get__(instance, owner)
 
 
 class Evaluator:
-    """Evaluates model results"""
+    """Evaluates model results
 
-    @staticmethod
-    def eval(input_dict: Dict[str, Any]) -> Tuple[List[float], List[float], List[float], List[float]]:
+    :param ties: (str) how negatives scored equal to the positive are ranked: 'optimistic' puts the
+        positive first, 'pessimistic' last and 'realistic' in the middle of them
+    :param hits_at: (Sequence[int]) cut-offs of the Hits@K metrics
+    """
+
+    def __init__(self, ties: str = DEFAULT_TIES, hits_at: Sequence[int] = DEFAULT_HITS_AT) -> None:
+        if ties not in TIE_MODES:
+            raise ValueError("ties mode %s not supported" % ties)
+        self.ties = ties
+        self.hits_at = tuple(hits_at)
+
+    def eval(self, input_dict: Dict[str, Any]) -> Tuple[Tensor, ...]:
         """Evaluate results
 
+        ``Evaluator.eval(input_dict)`` on the class is deprecated: it was a staticmethod ranking
+        ties optimistically, and still does so with a DeprecationWarning. Instances rank ties
+        with their ``ties`` mode, 'realistic' by default.
+
         :param input_dict: Dict with prediction results
-        :returns: (Tuple[List[float], List[float], List[float], List[float]]) MRR and Hits1-3-10 metrics
+        :returns: (Tuple[Tensor, ...]) MRR and Hits@K metrics, one per cut-off of ``hits_at``
+        """
+        return Evaluator.metrics_from_ranking(
+            Evaluator.rank(input_dict["y_pred_pos"], input_dict["y_pred_neg"], self.ties), self.hits_at
+        )
+
+    eval = _ClassCallable(eval, ties="optimistic")  # type: ignore[assignment]
+
+    @staticmethod
+    def rank(y_pred_pos: Tensor, y_pred_neg: Tensor, ties: str = DEFAULT_TIES) -> Tensor:
+        """Rank the positive score of every row among its negatives with one comparison pass
+
+        :param y_pred_pos: (Tensor) positive scores, shape (batch,)
+        :param y_pred_neg: (Tensor) negative scores, shape (batch, num_negatives)
+        :param ties: (str) 'optimistic', 'pessimistic' or 'realistic'
+        :raises ValueError: if the ties mode is not supported
+        :returns: (Tensor) 1-based ranks, float for the 'realistic' mode
+        """
+        y_pred_pos = y_pred_pos.view(-1, 1)
+        ranking_list = (y_pred_neg > y_pred_pos).sum(dim=1) + 1
+        if ties == "optimistic":
+            return ranking_list
+        num_equal = (y_pred_neg == y_pred_pos).sum(dim=1)
+        if ties == "pessimistic":
+            return ranking_list + num_equal
+        if ties == "realistic":
+            return ranking_list + num_equal / 2
+        raise ValueError("ties mode %s not supported" % ties)
+
+    @staticmethod
+    def metrics_from_ranking(ranking_list: Tensor, hits_at: Sequence[int] = DEFAULT_HITS_AT) -> Tuple[Tensor, ...]:
+        """Turn ranks of the positive samples into per-query metrics
+
+        Floating point ranks keep their dtype, integer ranks give float32 metrics.
+
+        :param ranking_list: (Tensor) 1-based ranks of the positive samples
+        :param hits_at: (Sequence[int]) cut-offs of the Hits@K metrics
+        :returns: (Tuple[Tensor, ...]) MRR and Hits@K metrics, one per cut-off of ``hits_at``
         """
-        y_pred_pos, y_pred_neg = input_dict["y_pred_pos"], input_dict["y_pred_neg"]
-        y_pred = torch.cat([y_pred_pos.view(-1, 1), y_pred_neg], dim=1)
-        argsort = torch.argsort(y_pred, dim=1, descending=True)
-        ranking_list = torch.nonzero(argsort == 0, as_tuple=False)
-        ranking_list = ranking_list[:, 1] + 1
-
-        hits1_list = (ranking_list <= 1).to(torch.float)
-        hits3_list = (ranking_list <= 3).to(torch.float)
-        hits10_list = (ranking_list <= 10).to(torch.float)
-        mrr_list = 1.0 / ranking_list.to(torch.float)
-
-        return mrr_list, hits1_list, hits3_list, hits10_list
+        if not ranking_list.is_floating_point():
+            ranking_list = ranking_list.to(torch.float)
+        hits_lists = ((ranking_list <= k).to(ranking_list.dtype) for k in hits_at)
+        mrr_list = 1.0 / ranking_list
+
+        return (mrr_list, *hits_lists)
+
+
+class RankAccumulator:
+    """Running sums of ranking metrics over a stream of batches
+
+    Keeps a count, the sum of reciprocal ranks and the Hits@K counts for every
+    (mode, relation) group seen, instead of the per-query metric tensors, so memory does
+    not grow with the number of evaluated queries. Accumulators of disjoint parts of the
+    test set, e.g. built by worker processes, are combined with :meth:`merge`.
+
+    :param hits_at: (Sequence[int]) cut-offs of the Hits@K metrics
+    """
+
+    def __init__(self, hits_at: Sequence[int] = DEFAULT_HITS_AT) -> None:
+        self.hits_at = tuple(hits_at)
+        self.metrics = ("mrr_list", *(f"hits@{k}_list" for k in self.hits_at))
+        # (mode, relation) -> [count, sum of reciprocal ranks, Hits@K counts...], relation -1 if not given
+        self.stats: Dict[Tuple[str, int], NDArray] = {}
+
+    def update(self, ranking_list: Tensor, relation: Optional[Tensor] = None, mode: str = "all") -> None:
+        """Add the ranks of a batch
+
+        :param ranking_list: (Tensor) 1-based ranks of the positive samples
+        :param relation: (Optional[Tensor]) relation of every query, for per-relation results
+        :param mode: (str) group of the batch, e.g. 'head-batch' or 'tail-batch'
+        """
+        ranks = ranking_list.detach().to(torch.float64).cpu()
+        values = torch.stack([torch.ones_like(ranks), *Evaluator.metrics_from_ranking(ranks, self.hits_at)], dim=1)
+        if relation is None:
+            relations, inverse = torch.tensor([-1]), torch.zeros(len(ranks), dtype=torch.long)
+        else:
+            relations, inverse = torch.unique(relation.detach().cpu(), return_inverse=True)
+        sums = torch.zeros(len(relations), values.shape[1], dtype=torch.float64).index_add_(0, inverse, values)
+        for group_relation, group_sums in zip(relations.tolist(), sums.numpy()):
+            key = (mode, group_relation)
+            self.stats[key] = self.stats[key] + group_sums if key in self.stats else group_sums.copy()
+
+    def merge(self, other: "RankAccumulator") -> "RankAccumulator":
+        """Add the sums of another accumulator
+
+        :param other: (RankAccumulator) accumulator with the same Hits@K cut-offs
+        :raises ValueError: if the cut-offs differ
+        :returns: (RankAccumulator) this accumulator
+        """
+        if other.hits_at != self.hits_at:
+            raise ValueError(f"Cannot merge Hits@K cut-offs {other.hits_at} into {self.hits_at}")
+        for key, group_sums in other.stats.items():
+            self.stats[key] = self.stats[key] + group_sums if key in self.stats else group_sums.copy()
+        return self
+
+    @property
+    def count(self) -> int:
+        """Number of added queries"""
+        return int(sum(group_sums[0] for group_sums in self.stats.values()))
+
+    def _means(self, group_sums: NDArray) -> Dict[str, float]:
+        return {metric: float(total / max(group_sums[0], 1)) for metric, total in zip(self.metrics, group_sums[1:])}
+
+    @overload
+    def result(self, group_by: None = None) -> Dict[str, float]: ...
+
+    @overload
+    def result(self, group_by: str) -> Dict[Any, Dict[str, float]]: ...
+
+    def result(self, group_by: Optional[str] = None) -> Union[Dict[str, float], Dict[Any, Dict[str, float]]]:
+        """Mean metrics over all added ranks, optionally broken down by group
+
+        :param group_by: (Optional[str]) None for overall means, 'mode', 'relation' or 'mode_relation'
+        :raises ValueError: if the grouping is not supported
+        :returns: (Union[Dict[str, float], Dict[Any, Dict[str, float]]]) Dict metric name -> mean value,
+            or Dict group -> such a Dict
+        """
+        if group_by is None:
+            return self._means(sum(self.stats.values(), np.zeros(len(self.metrics) + 1)))
+        if group_by not in ("mode", "relation", "mode_relation"):
+            raise ValueError("grouping %s not supported" % group_by)
+
+        grouped: Dict[Any, NDArray] = {}
+        for (mode, relation), group_sums in self.stats.items():
+            key = {"mode": mode, "relation": relation, "mode_relation": (mode, relation)}[group_by]
+            grouped[key] = grouped[key] + group_sums if key in grouped else group_sums
+        return {key: self._means(group_sums) for key, group_sums in sorted(grouped.items())}
@@ -1,17 +1,19 @@
 from abc import ABC
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from numpy.typing import NDArray
 from torch import Tensor
+from torch.nn.utils.rnn import pack_sequence
 
 from redkg.config import Config
 from redkg.evaluator import Evaluator
-from redkg.models.graph_convolution import GraphConvolution
+from redkg.models.graph_convolution import GraphConvolution, load_adjacency
 from redkg.models.kge import KGEModel
-from redkg.utils import pickle_load
+from redkg.n_hop_index import NHopIndex
 
 
 class AbstractLayer(nn.Module, ABC):
@@ -23,18 +25,25 @@ class AbstractLayer(nn.Module, ABC):
         self.entity_max = max(entity_vocab.values())
         self.relation_max = max(relation_vocab.values())
         self.nfeat = nfeat
-        self.n_hop_kg = pickle_load(f"{config.preprocess_results_dir}/n_hop_kg.pkl")
+        self.n_hop_kg = NHopIndex.load(f"{config.preprocess_results_dir}/n_hop_kg")
 
-        self.gc1 = GraphConvolution(nfeat, nfeat)
-        self.gc2 = GraphConvolution(nfeat, nfeat)
+        adj = load_adjacency(config.adj_path)
+        self.gc1 = GraphConvolution(nfeat, nfeat, adj=adj)
+        self.gc2 = GraphConvolution(nfeat, nfeat, adj=adj)
 
-    def get_n_hop(self, entity_id: int) -> Dict[int, List[int]]:
+        # Propagated entity table, valid until the training loop calls refresh_gcn_cache
+        self._gcn_cache: Optional[Tensor] = None
+
+        # Hidden states of concurrent user sessions, shape (layers, num_users, hidden)
+        self.sessions: Optional[Tensor] = None
+
+    def get_n_hop(self, entity_id: int) -> Dict[int, NDArray]:
         """Get n_hops from entity
 
         :param entity_id: id of entity
-        :returns: Dict with N-hop neighbours
+        :returns: Dict with N-hop neighbours as views of the memory mapped index
         """
-        return self.n_hop_kg[entity_id]
+        return self.n_hop_kg.get(entity_id)
 
     def distance(self, triplets: Tensor) -> Tensor:
         """Get distance between triples
@@ -46,11 +55,45 @@ class AbstractLayer(nn.Module, ABC):
         heads = triplets[:, 0]
         relations = triplets[:, 1]
         tails = triplets[:, 2]
-        return (
-            self.kge_model.entity_embedding.weight[heads]
-            + self.relation_emb.weight[relations]
-            - self.kge_model.entity_embedding.weight[tails]
-        ).norm(p=1, dim=1)
+        entity_table = self._entity_table()
+        return (entity_table[heads] + self.relation_emb.weight[relations] - entity_table[tails]).norm(p=1, dim=1)
+
+    def _entity_table(self) -> Tensor:
+        """Entity embedding table of the KGE model, stored as a Parameter or an Embedding"""
+        embedding = self.kge_model.entity_embedding
+        return embedding.weight if isinstance(embedding, nn.Embedding) else embedding
+
+    def _propagate(self) -> Tensor:
+        out = F.relu(self.gc1(self._entity_table()))
+        out = self.gc2(out)
+        return F.log_softmax(out, dim=1)
+
+    def gcn_table(self) -> Tensor:
+        """Propagated representations of all entities
+
+        The table is propagated once per parameter update: it is cached until
+        :meth:`refresh_gcn_cache` is called, which the training loop does after every optimizer
+        step. A table cached with autograd enabled keeps its graph, so all the lookups of a step
+        share one propagation and reach the parameters through one backward pass. With autograd
+        disabled the cached table is returned detached.
+
+        :returns: (Tensor) table of shape (nentity, nfeat)
+        """
+        if self._gcn_cache is None or (torch.is_grad_enabled() and not self._gcn_cache.requires_grad):
+            self._gcn_cache = self._propagate()
+        return self._gcn_cache if torch.is_grad_enabled() else self._gcn_cache.detach()
+
+    def refresh_gcn_cache(self) -> None:
+        """Drop the cached table, to be called after every update of the entity embeddings or GCN weights"""
+        self._gcn_cache = None
+
+    def precompute_gcn(self) -> Tensor:
+        """Compute the table once for inference
+
+        :returns: (Tensor) table of shape (nentity, nfeat)
+        """
+        with torch.no_grad():
+            return self.gcn_table()
 
     def forward_gcn(self, x: Tensor) -> Tensor:
         """Forward  GCN
@@ -58,10 +101,57 @@ class AbstractLayer(nn.Module, ABC):
         :param x: Tensor
         :returns: Tensor
         """
-        out = F.relu(self.gc1(self.kge_model.entity_embedding.weight))
-        out = self.gc2(out)
-        out = F.log_softmax(out, dim=1)[x]
-        return out
+        return self.gcn_table()[x]
+
+    def item_features(self, x: Tensor) -> Tensor:
+        """Input features of the recurrent layer for items
+
+        :param x: (Tensor) item entity ids
+        :returns: (Tensor) features, one row per id
+        """
+        return self.forward_gcn(x)
+
+    def init_sessions(self, num_users: int) -> Tensor:
+        """Start empty sessions for ``num_users`` users
+
+        :param num_users: (int) number of users
+        :returns: (Tensor) zero hidden states, shape (layers, num_users, hidden)
+        """
+        self.sessions = torch.zeros(self.gru.num_layers, num_users, self.gru.hidden_size)
+        return self.sessions
+
+    def _session_state(self, users: Optional[Tensor], batch_size: int) -> Tensor:
+        if users is None:
+            return torch.zeros(self.gru.num_layers, batch_size, self.gru.hidden_size)
+        if self.sessions is None:
+            raise RuntimeError("Sessions are not initialized, call init_sessions first")
+        return self.sessions[:, users]
+
+    def step_sessions(self, users: Tensor, items: Tensor) -> Tensor:
+        """Advance the sessions of a batch of users by their next items in one recurrent call
+
+        :param users: (Tensor) unique user indices, shape (batch,)
+        :param items: (Tensor) next item entity ids, shape (batch,)
+        :returns: (Tensor) user states, shape (batch, hidden)
+        """
+        out, hidden = self.gru(self.item_features(items).unsqueeze(0), self._session_state(users, len(users)))
+        self.sessions[:, users] = hidden.detach()  # type: ignore[index]
+        return out.squeeze(0)
+
+    def encode_histories(self, histories: List[Tensor], users: Optional[Tensor] = None) -> Tensor:
+        """Encode variable-length item histories of many users in one packed recurrent call
+
+        :param histories: (List[Tensor]) item entity ids of every user, in interaction order
+        :param users: (Optional[Tensor]) unique user indices, the encoding continues and updates their sessions
+            if given, otherwise it starts from zero states
+        :returns: (Tensor) user states after the last item, shape (batch, hidden)
+        """
+        packed = pack_sequence(histories, enforce_sorted=False)
+        packed = packed._replace(data=self.item_features(packed.data))
+        _, hidden = self.gru(packed, self._session_state(users, len(histories)))
+        if users is not None:
+            self.sessions[:, users] = hidden.detach()  # type: ignore[index]
+        return hidden[-1]
 
 
 class GCNGRU(AbstractLayer):
@@ -94,9 +184,7 @@ class GCNGRU(AbstractLayer):
         :returns: Tensor
         """
         # GCN
-        out = F.relu(self.gc1(self.kge_model.entity_embedding.weight))
-        out = self.gc2(out)
-        out = F.log_softmax(out, dim=1)[x].reshape(1, 1, -1)
+        out = self.gcn_table()[x].reshape(1, 1, -1)
 
         # GRU
         out, self.h = self.gru(out, self.h)
@@ -122,6 +210,14 @@ class GRU(AbstractLayer):
 
         self.criterion = nn.MarginRankingLoss(margin=1.0)
 
+    def item_features(self, x: Tensor) -> Tensor:
+        """Input features of the recurrent layer for items: their entity embeddings
+
+        :param x: (Tensor) item entity ids
+        :returns: (Tensor) features, one row per id
+        """
+        return self._entity_table()[x]
+
     def transe_forward(self, pos_triplet: Tensor, neg_triplet: Tensor) -> Tensor:
         """Forward with KGE model
 
@@ -133,6 +229,8 @@ class GRU(AbstractLayer):
         self.kge_model.entity_embedding.weight.data[:-1, :].div_(
             self.kge_model.entity_embedding.weight.data[:-1, :].norm(p=2, dim=1, keepdim=True)
         )
+        # Writes through .data do not bump the version counter
+        self.refresh_gcn_cache()
 
         pos_distance = self.distance(pos_triplet)
         neg_distance = self.distance(neg_triplet)
@@ -147,7 +245,7 @@ class GRU(AbstractLayer):
         :param x: Tensor
         :returns: Tensor
         """
-        x = self.kge_model.entity_embedding.weight[x]
+        x = self.item_features(x)
         x = x.reshape(1, 1, -1)
 
         # GRU
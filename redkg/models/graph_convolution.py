@@ -1,15 +1,71 @@
 import math
+import os
+from typing import Dict, Optional, Tuple
 
 import numpy as np
+import scipy.sparse as sp
 import torch
 import torch.nn as nn
 from torch import Tensor
 
+DEFAULT_ADJ_PATH = "./data/movie/kg_adj_mat.npz"
+
+# Adjacency tensors loaded by load_adjacency, keyed by absolute path and normalization
+_ADJACENCY_REGISTRY: Dict[Tuple[str, bool], Tensor] = {}
+
+
+def normalize_adjacency(adj: sp.spmatrix) -> sp.csr_matrix:
+    """Renormalize an adjacency matrix as D^-1/2 (A + I) D^-1/2
+
+    :param adj: (sp.spmatrix) square adjacency matrix
+    :returns: (sp.csr_matrix) normalized matrix
+    """
+    adj = sp.csr_matrix(adj, dtype=np.float32) + sp.identity(adj.shape[0], dtype=np.float32, format="csr")
+    inv_sqrt_degree = np.power(np.asarray(adj.sum(axis=1)).ravel(), -0.5)
+    scale = sp.diags(inv_sqrt_degree.astype(np.float32))
+    return (scale @ adj @ scale).tocsr()
+
+
+def to_sparse_tensor(adj: sp.spmatrix) -> Tensor:
+    """Convert a SciPy sparse matrix to a coalesced float32 COO tensor
+
+    :param adj: (sp.spmatrix) sparse matrix
+    :returns: (Tensor) sparse tensor
+    """
+    adj = adj.tocoo()
+    indices = torch.from_numpy(np.vstack([adj.row, adj.col]).astype(np.int64))
+    values = torch.from_numpy(adj.data.astype(np.float32))
+    return torch.sparse_coo_tensor(indices, values, adj.shape, check_invariants=False).coalesce()
+
+
+def load_adjacency(path: str = DEFAULT_ADJ_PATH, normalize: bool = True) -> Tensor:
+    """Load a KG adjacency saved with ``sp.save_npz`` once per process
+
+    Later calls with the same path return the same tensor, so every layer shares one copy.
+
+    :param path: (str) path to the .npz file
+    :param normalize: (bool) whether to apply :func:`normalize_adjacency`
+    :returns: (Tensor) sparse adjacency tensor
+    """
+    key = (os.path.abspath(path), normalize)
+    if key not in _ADJACENCY_REGISTRY:
+        adj = sp.load_npz(path)
+        _ADJACENCY_REGISTRY[key] = to_sparse_tensor(normalize_adjacency(adj) if normalize else adj)
+    return _ADJACENCY_REGISTRY[key]
+
 
 class GraphConvolution(nn.Module):
-    """GCN graph convolution layer"""
+    """GCN graph convolution layer
+
+    :param in_features: (int) size of input features
+    :param out_features: (int) size of output features
+    :param adj: (Optional[Tensor]) sparse adjacency tensor, loaded from ``adj_path`` if not given
+    :param adj_path: (str) path to the adjacency saved with ``sp.save_npz``
+    """
 
-    def __init__(self, in_features: int, out_features: int) -> None:
+    def __init__(
+        self, in_features: int, out_features: int, adj: Optional[Tensor] = None, adj_path: str = DEFAULT_ADJ_PATH
+    ) -> None:
         super(GraphConvolution, self).__init__()
         self.in_features = in_features
         self.out_features = out_features
@@ -22,7 +78,7 @@ class GraphConvolution(nn.Module):
             self.register_parameter('bias', None)
         self.reset_parameters()
         """
-        self.adj = torch.FloatTensor(np.load("./data/movie/kg_adj_mat.npy"))
+        self.adj = adj if adj is not None else load_adjacency(adj_path)
 
     def reset_parameters(self) -> None:
         """Reset model parameters"""
@@ -39,7 +95,7 @@ class GraphConvolution(nn.Module):
         """
         # support = torch.mm(input, self.weight)
         support = self.weight(x)
-        output = torch.spmm(self.adj, support)
+        output = torch.sparse.mm(self.adj, support)
         return output
         """
         if self.bias is not None:
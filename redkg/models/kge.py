@@ -1,10 +1,13 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
-from collections import defaultdict
-from typing import Any, Callable, Dict
+import queue
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import numpy as np
+import pandas as pd
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
@@ -12,7 +15,11 @@ from torch.optim import Optimizer
 from torch.utils.data import DataLoader
 
 from redkg.dataloader import BidirectionalOneShotIterator, TestDataset
-from redkg.evaluator import Evaluator
+from redkg.evaluator import Evaluator, RankAccumulator
+from redkg.models.kge_quantization import QuantizedTable
+from redkg.models.kge_scoring import build_query, rank_against_table, score_block
+from redkg.triple_format import CategoricalColumn
+from redkg.triple_store import TripleStore, global_entity_ids
 
 
 class KGEModel(nn.Module):
@@ -31,6 +38,8 @@ class KGEModel(nn.Module):
         evaluator: Evaluator,
         double_entity_embedding: bool = False,
         double_relation_embedding: bool = False,
+        score_chunk_size: Optional[int] = None,
+        sparse: bool = False,
     ) -> None:
         super(KGEModel, self).__init__()
         """Initialize KGE model.
@@ -42,6 +51,10 @@ class KGEModel(nn.Module):
         :evaluator: The entity
         :double_entity_embedding: The entity
         :double_relation_embedding: The entity
+        :score_chunk_size: number of negative candidates scored at once in the 'head-batch'
+            and 'tail-batch' modes; all of them in one block if None
+        :sparse: gather embedding rows with sparse gradients, so that an optimizer from
+            :meth:`make_optimizer` and the regularization of :meth:`train_step` only touch the rows of a batch
 
         :raises ValueError: _description_
         :raises ValueError: _description_
@@ -52,6 +65,8 @@ class KGEModel(nn.Module):
         self.nrelation = nrelation
         self.hidden_dim = hidden_dim
         self.epsilon = 2.0
+        self.score_chunk_size = score_chunk_size
+        self.sparse = sparse
 
         self.gamma = nn.Parameter(torch.Tensor([gamma]), requires_grad=False)
 
@@ -79,6 +94,8 @@ class KGEModel(nn.Module):
             raise ValueError("ComplEx should use --double_entity_embedding and --double_relation_embedding")
 
         self.evaluator = evaluator
+        # Reduced precision copy of entity_embedding used by the full ranking, see quantize_entities
+        self.inference_entity_table: Optional[QuantizedTable] = None
 
     def forward(self, sample: Tensor, mode: str = "single") -> Tensor:
         """Forward function that calculate the score of a batch of triples.
@@ -89,6 +106,7 @@ class KGEModel(nn.Module):
         And the second part is the entities in the negative samples.
         Because negative samples and positive samples usually share two elements
         in their triple ((head, relation) or (relation, tail)).
+        Both batch modes are scored by :meth:`score_candidates`.
 
         :param sample: _description_
         :type sample: _type_
@@ -99,36 +117,24 @@ class KGEModel(nn.Module):
         :return: _description_
         :rtype: _type_
         """
+        if self.entity_embedding is None:
+            raise RuntimeError(
+                "The float32 entity table was released by load_entities, only the full ranking is served"
+            )
         if mode == "single":
-            head = torch.index_select(self.entity_embedding, dim=0, index=sample[:, 0]).unsqueeze(1)
+            head = self.rows(self.entity_embedding, sample[:, 0]).unsqueeze(1)
 
-            relation = torch.index_select(self.relation_embedding, dim=0, index=sample[:, 1]).unsqueeze(1)
+            relation = self.rows(self.relation_embedding, sample[:, 1]).unsqueeze(1)
 
-            tail = torch.index_select(self.entity_embedding, dim=0, index=sample[:, 2]).unsqueeze(1)
+            tail = self.rows(self.entity_embedding, sample[:, 2]).unsqueeze(1)
 
         elif mode == "head-batch":
             tail_part, head_part = sample
-            batch_size, negative_sample_size = head_part.size(0), head_part.size(1)
-
-            head = torch.index_select(self.entity_embedding, dim=0, index=head_part.view(-1)).view(
-                batch_size, negative_sample_size, -1
-            )
-
-            relation = torch.index_select(self.relation_embedding, dim=0, index=tail_part[:, 1]).unsqueeze(1)
-
-            tail = torch.index_select(self.entity_embedding, dim=0, index=tail_part[:, 2]).unsqueeze(1)
+            return self.score_candidates(tail_part[:, 2], tail_part[:, 1], head_part, mode)
 
         elif mode == "tail-batch":
             head_part, tail_part = sample
-            batch_size, negative_sample_size = tail_part.size(0), tail_part.size(1)
-
-            head = torch.index_select(self.entity_embedding, dim=0, index=head_part[:, 0]).unsqueeze(1)
-
-            relation = torch.index_select(self.relation_embedding, dim=0, index=head_part[:, 1]).unsqueeze(1)
-
-            tail = torch.index_select(self.entity_embedding, dim=0, index=tail_part.view(-1)).view(
-                batch_size, negative_sample_size, -1
-            )
+            return self.score_candidates(head_part[:, 0], head_part[:, 1], tail_part, mode)
 
         else:
             raise ValueError("mode %s not supported" % mode)
@@ -147,6 +153,64 @@ class KGEModel(nn.Module):
 
         return score
 
+    def rows(self, table: Tensor, index: Tensor) -> Tensor:
+        """Gather rows of an embedding table, with a sparse gradient in the sparse mode
+
+        :param table: (Tensor) ``entity_embedding`` or ``relation_embedding``
+        :param index: (Tensor) row ids, shape (n,)
+        :returns: (Tensor) rows, shape (n, dim)
+        """
+        if self.sparse:
+            return F.embedding(index, table, sparse=True)
+        return torch.index_select(table, dim=0, index=index)
+
+    def make_optimizer(self, learning_rate: float) -> Optimizer:
+        """Adam over the trainable parameters, SparseAdam in the sparse mode
+
+        SparseAdam keeps the dense moment buffers but only reads and updates the rows
+        present in the gradient, so a step costs as much as the batch, not the table.
+
+        :param learning_rate: (float) learning rate
+        :returns: (Optimizer) optimizer
+        """
+        parameters = [p for p in self.parameters() if p.requires_grad]
+        if self.sparse:
+            return torch.optim.SparseAdam(parameters, lr=learning_rate)
+        return torch.optim.Adam(parameters, lr=learning_rate)
+
+    def score_candidates(self, anchor: Tensor, relation: Tensor, candidates: Tensor, mode: str) -> Tensor:
+        """Score negative candidates block by block without broadcasting the full batch.
+
+        The anchor (head in the 'tail-batch' mode, tail in the 'head-batch' mode) and the
+        relation are folded into one query vector, then candidates are gathered and reduced
+        ``score_chunk_size`` columns at a time, so at most (batch, score_chunk_size, dim)
+        embeddings are alive at once.
+
+        :param anchor: (Tensor) ids of the anchor entities, shape (batch,)
+        :param relation: (Tensor) ids of the relations, shape (batch,)
+        :param candidates: (Tensor) ids of the candidate entities, shape (batch, negative_sample_size)
+        :param mode: (str) 'head-batch' or 'tail-batch'
+        :returns: (Tensor) scores, shape (batch, negative_sample_size)
+        """
+        query = build_query(
+            self.model_name,
+            self.rows(self.entity_embedding, anchor),
+            self.rows(self.relation_embedding, relation),
+            mode,
+            self.embedding_range.item(),
+        )
+        batch_size, negative_sample_size = candidates.size(0), candidates.size(1)
+        chunk_size = self.score_chunk_size or negative_sample_size
+
+        scores = []
+        for start in range(0, negative_sample_size, chunk_size):
+            chunk = candidates[:, start : start + chunk_size]
+            candidate_embedding = self.rows(self.entity_embedding, chunk.reshape(-1)).view(
+                batch_size, chunk.size(1), -1
+            )
+            scores.append(score_block(self.model_name, query, candidate_embedding, self.gamma.item()))
+        return torch.cat(scores, dim=1)
+
     def TransE(self, head: Tensor, relation: Tensor, tail: Tensor, mode: str) -> Tensor:
         """Apply TransE model
 
@@ -244,6 +308,42 @@ class KGEModel(nn.Module):
         score = self.gamma.item() - score.sum(dim=2)
         return score
 
+    def quantize_entities(self, dtype: Optional[str] = "int8") -> Optional[QuantizedTable]:
+        """Export the entity table in a reduced precision for inference
+
+        The full ranking of :meth:`test_step` then builds queries and scores candidates from the
+        exported table, dequantizing one block of entities at a time. The export is a snapshot,
+        call it again after further training.
+
+        The float32 table is kept for training, use :meth:`load_entities` to serve from the
+        exported table alone.
+
+        :param dtype: (Optional[str]) 'float16', 'bfloat16' or 'int8', None to go back to the float32 table
+        :raises RuntimeError: if the float32 table was released by :meth:`load_entities`
+        :returns: (Optional[QuantizedTable]) exported table
+        """
+        if self.entity_embedding is None:
+            raise RuntimeError("The float32 entity table was released by load_entities")
+        self.inference_entity_table = None if dtype is None else QuantizedTable.quantize(self.entity_embedding, dtype)
+        return self.inference_entity_table
+
+    def load_entities(self, table: QuantizedTable) -> None:
+        """Serve the model from a reduced precision entity table and release the float32 one
+
+        The ``entity_embedding`` parameter is set to None, so it leaves ``parameters()`` and
+        ``state_dict()`` and only the table of :meth:`quantize_entities` or
+        :meth:`QuantizedTable.load` stays in memory. The model is then inference only: the full
+        ranking of :meth:`test_step` and :class:`redkg.models.kge_retrieval.KGERetriever` read
+        the table, :meth:`forward` and :meth:`train_step` raise.
+
+        :param table: (QuantizedTable) entity table, shape (nentity, entity_dim)
+        :raises ValueError: if the table does not match the entity table shape
+        """
+        if tuple(table.shape) != (self.nentity, self.entity_dim):
+            raise ValueError("Table of shape %s does not match the entity table" % (tuple(table.shape),))
+        self.inference_entity_table = table
+        self.register_parameter("entity_embedding", None)
+
     @staticmethod
     def train_step(
         model: nn.Module, optimizer: Optimizer, train_iterator: BidirectionalOneShotIterator, model_parameters: Any
@@ -289,9 +389,15 @@ class KGEModel(nn.Module):
 
         if model_parameters.regularization != 0.0:
             # Use L3 regularization for ComplEx and DistMult
-            regularization = model_parameters.regularization * (
-                model.entity_embedding.norm(p=3) ** 3 + model.relation_embedding.norm(p=3).norm(p=3) ** 3
-            )
+            if model.sparse:
+                # Only the rows the batch touched, once each, so the gradient stays sparse
+                entities = torch.cat([positive_sample[:, 0], positive_sample[:, 2], negative_sample.reshape(-1)])
+                entity_norm = model.rows(model.entity_embedding, torch.unique(entities)).norm(p=3)
+                relation_norm = model.rows(model.relation_embedding, torch.unique(positive_sample[:, 1])).norm(p=3)
+            else:
+                entity_norm = model.entity_embedding.norm(p=3)
+                relation_norm = model.relation_embedding.norm(p=3).norm(p=3)
+            regularization = model_parameters.regularization * (entity_norm**3 + relation_norm**3)
             loss = loss + regularization
             regularization_log = {"regularization": regularization.item()}
         else:
@@ -311,7 +417,16 @@ class KGEModel(nn.Module):
         return log
 
     @staticmethod
-    def test_step(model: nn.Module, test_triples: Tensor, args: Any, random_sampling: bool = False) -> Dict[str, float]:
+    def test_step(
+        model: nn.Module,
+        test_triples: Tensor,
+        args: Any,
+        random_sampling: bool = False,
+        full_ranking: bool = False,
+        info: Optional[Dict[str, Any]] = None,
+        entity_block_size: int = 65536,
+        accumulator: Optional[RankAccumulator] = None,
+    ) -> Dict[str, float]:
         """Evaluate the model on tests or valid datasets
 
         :param model: _description_
@@ -322,11 +437,20 @@ class KGEModel(nn.Module):
         :type args: _type_
         :param random_sampling: _description_, defaults to False
         :type random_sampling: bool, optional
+        :param full_ranking: rank every test triple against all entities instead of its negative samples
+        :param info: dataset info from ``get_info``; triples of its ``triple_store`` are filtered out
+            in the full ranking mode
+        :param entity_block_size: number of entities scored at once in the full ranking mode
+        :param accumulator: collects the ranks by mode and relation, a new one with Hits@1, 3 and 10 if None;
+            pass one to read per-relation results or to use other Hits@K cut-offs
         :return: _description_
         :rtype: _type_
         """
         model.eval()
 
+        if full_ranking:
+            return KGEModel._test_step_full_ranking(model, test_triples, args, info, entity_block_size, accumulator)
+
         # Prepare dataloader for evaluation
         test_dataloader_head = DataLoader(
             TestDataset(test_triples, args, "head-batch", random_sampling),
@@ -344,7 +468,7 @@ class KGEModel(nn.Module):
 
         test_dataset_list = [test_dataloader_head, test_dataloader_tail]
 
-        test_logs = defaultdict(list)
+        accumulator = accumulator if accumulator is not None else RankAccumulator()
 
         step = 0
         total_steps = sum([len(dataset) for dataset in test_dataset_list])
@@ -358,17 +482,238 @@ class KGEModel(nn.Module):
 
                     score = model((positive_sample, negative_sample), mode)
 
-                    batch_results = model.evaluator.eval({"y_pred_pos": score[:, 0], "y_pred_neg": score[:, 1:]})
-                    for metric in batch_results:
-                        test_logs[metric].append(batch_results[metric])
+                    accumulator.update(
+                        Evaluator.rank(score[:, 0], score[:, 1:], model.evaluator.ties), positive_sample[:, 1], mode
+                    )
 
                     if step % args.test_log_steps == 0:
                         logging.info("Evaluating the model... (%d/%d)" % (step, total_steps))
 
                     step += 1
 
-            metrics = {}
-            for metric in test_logs:
-                metrics[metric] = torch.cat(test_logs[metric]).mean().item()
+        return accumulator.result()
+
+    @staticmethod
+    def test_step_sharded(
+        model: nn.Module,
+        test_triples: Any,
+        args: Any,
+        num_workers: int,
+        random_sampling: bool = False,
+        full_ranking: bool = False,
+        info: Optional[Dict[str, Any]] = None,
+        entity_block_size: int = 65536,
+        accumulator: Optional[RankAccumulator] = None,
+        timeout: float = 1.0,
+    ) -> Dict[str, float]:
+        """Evaluate the model with :meth:`test_step` on contiguous shards of the test triples in parallel
+
+        The parameters are moved to shared memory, so every process scores its shard against
+        the same entity and relation tables without copying them. The move is in place and
+        is not undone: the caller's model keeps its parameters in shared memory. Each process
+        returns its accumulator and the states are merged. Forked workers cannot use CUDA, so
+        the evaluation runs on CPU only.
+
+        :param model: model to evaluate
+        :param test_triples: DataFrame or Dict of columns with the test triples
+        :param args: evaluation parameters of :meth:`test_step`
+        :param num_workers: (int) number of processes
+        :param random_sampling: see :meth:`test_step`
+        :param full_ranking: see :meth:`test_step`
+        :param info: see :meth:`test_step`
+        :param entity_block_size: see :meth:`test_step`
+        :param accumulator: receives the merged ranks, a new one with Hits@1, 3 and 10 if None
+        :param timeout: (float) seconds to wait for a result before checking that the workers are alive
+        :raises ValueError: if ``args.cuda`` is set
+        :raises RuntimeError: if a worker process fails or exits without a result
+        :returns: Dict with mean metrics
+        """
+        if args.cuda:
+            raise ValueError("Sharded evaluation runs on CPU, use test_step for CUDA models")
+        accumulator = accumulator if accumulator is not None else RankAccumulator()
+        num_triples = len(test_triples["head"])
+        bounds = np.linspace(0, num_triples, min(num_workers, num_triples) + 1).astype(int)
+        model.share_memory()
+
+        results = mp.Queue()
+        workers = [
+            mp.Process(
+                target=_test_shard,
+                args=(
+                    model,
+                    _shard_triples(test_triples, start, end),
+                    args,
+                    random_sampling,
+                    full_ranking,
+                    info,
+                    entity_block_size,
+                    accumulator.hits_at,
+                    results,
+                ),
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        for worker in workers:
+            worker.start()
+        # Read the results before joining, a worker only exits once its result left the queue
+        shard_accumulators: List[RankAccumulator] = []
+        try:
+            while len(shard_accumulators) < len(workers):
+                # Checked before waiting: a worker that exited has flushed its result to the queue
+                alive = any(worker.is_alive() for worker in workers)
+                try:
+                    shard_accumulator = results.get(timeout=timeout)
+                except queue.Empty:
+                    if not alive:
+                        raise RuntimeError("Evaluation workers exited without a result")
+                    continue
+                if isinstance(shard_accumulator, BaseException):
+                    raise RuntimeError("Evaluation worker failed") from shard_accumulator
+                shard_accumulators.append(shard_accumulator)
+        finally:
+            for worker in workers:
+                if len(shard_accumulators) < len(workers):
+                    worker.terminate()
+                worker.join()
+        for shard_accumulator in shard_accumulators:
+            accumulator.merge(shard_accumulator)
+        return accumulator.result()
+
+    @staticmethod
+    def _test_step_full_ranking(
+        model: nn.Module,
+        test_triples: Any,
+        args: Any,
+        info: Optional[Dict[str, Any]],
+        entity_block_size: int,
+        accumulator: Optional[RankAccumulator] = None,
+    ) -> Dict[str, float]:
+        """Filtered 1-vs-all evaluation: rank every test triple against the whole entity table
+
+        :param model: model to evaluate
+        :param test_triples: Dict with 'head', 'relation' and 'tail' columns, and 'head_type', 'tail_type'
+            for typed entities
+        :param args: evaluation parameters
+        :param info: dataset info from ``get_info``, no filtering if None; its 'entity_dict' maps typed
+            entities to global ids
+        :param entity_block_size: number of entities scored at once
+        :param accumulator: collects the ranks by mode and relation, a new one if None
+        :returns: Dict with mean metrics
+        """
+        # Typed entities are moved to global ids, as in TrainDataset and the TripleStore
+        entity_dict = info.get("entity_dict") if info is not None else None
+        heads, relations, tails = (torch.from_numpy(ids) for ids in global_entity_ids(test_triples, entity_dict))
+        triple_store = info["triple_store"] if info is not None else None
+        entity_table = model.inference_entity_table
+        if entity_table is None:
+            entity_table = model.entity_embedding
+        elif args.cuda:
+            entity_table = entity_table.to("cuda")
+
+        accumulator = accumulator if accumulator is not None else RankAccumulator()
+
+        step = 0
+        total_steps = 2 * ((len(heads) + args.test_batch_size - 1) // args.test_batch_size)
+
+        with torch.no_grad():
+            for mode in ("head-batch", "tail-batch"):
+                anchors, targets = (tails, heads) if mode == "head-batch" else (heads, tails)
+                for start in range(0, len(heads), args.test_batch_size):
+                    anchor = anchors[start : start + args.test_batch_size]
+                    relation = relations[start : start + args.test_batch_size]
+                    target = targets[start : start + args.test_batch_size]
+                    filter_rows, filter_cols = _filter_index(anchor, relation, target, triple_store, mode)
+                    if args.cuda:
+                        anchor, relation, target = anchor.cuda(), relation.cuda(), target.cuda()
+                        filter_rows, filter_cols = filter_rows.cuda(), filter_cols.cuda()
+
+                    query = build_query(
+                        model.model_name,
+                        entity_table[anchor],
+                        model.relation_embedding[relation],
+                        mode,
+                        model.embedding_range.item(),
+                    )
+                    positive_score = score_block(
+                        model.model_name, query, entity_table[target].unsqueeze(1), model.gamma.item()
+                    ).squeeze(1)
+                    ranking_list = rank_against_table(
+                        model.model_name,
+                        query,
+                        positive_score,
+                        entity_table,
+                        model.gamma.item(),
+                        entity_block_size,
+                        filter_rows,
+                        filter_cols,
+                        model.evaluator.ties,
+                    )
+
+                    accumulator.update(ranking_list, relation, mode)
 
-        return metrics
+                    if step % args.test_log_steps == 0:
+                        logging.info("Evaluating the model... (%d/%d)" % (step, total_steps))
+
+                    step += 1
+
+        return accumulator.result()
+
+
+def _filter_index(
+    anchor: Tensor, relation: Tensor, target: Tensor, triple_store: Optional[TripleStore], mode: str
+) -> Tuple[Tensor, Tensor]:
+    """Collect the (row, entity) pairs to exclude from the full ranking of a batch, sorted by entity
+
+    The target itself is always excluded, its score is compared separately.
+
+    :param anchor: (Tensor) tails in the 'head-batch' mode, heads in the 'tail-batch' mode
+    :param relation: (Tensor) relations of the batch
+    :param target: (Tensor) entities to rank
+    :param triple_store: (Optional[TripleStore]) known triples
+    :param mode: (str) 'head-batch' or 'tail-batch'
+    :returns: (Tuple[Tensor, Tensor]) rows and entity ids
+    """
+    rows, cols = np.arange(len(target)), target.numpy()
+    if triple_store is not None:
+        known_rows, known_cols = triple_store.filter_index(anchor.numpy(), relation.numpy(), mode)
+        rows, cols = np.concatenate([rows, known_rows]), np.concatenate([cols, known_cols])
+    order = np.argsort(cols, kind="stable")
+    return torch.from_numpy(rows[order]), torch.from_numpy(cols[order].astype(np.int64))
+
+
+def _shard_triples(triples: Any, start: int, end: int) -> Any:
+    """Rows [start, end) of a DataFrame or a Dict of columns"""
+    if isinstance(triples, pd.DataFrame):
+        # TestDataset reads list columns by label, so every shard starts from 0
+        return triples.iloc[start:end].reset_index(drop=True)
+    return {
+        name: (
+            CategoricalColumn(column.codes[start:end], column.categories)
+            if isinstance(column, CategoricalColumn)
+            else column[start:end]
+        )
+        for name, column in triples.items()
+    }
+
+
+def _test_shard(
+    model: nn.Module,
+    test_triples: Any,
+    args: Any,
+    random_sampling: bool,
+    full_ranking: bool,
+    info: Optional[Dict[str, Any]],
+    entity_block_size: int,
+    hits_at: Tuple[int, ...],
+    results: Any,
+) -> None:
+    """Evaluate one shard in a worker process and put its accumulator, or the raised exception, to ``results``"""
+    torch.set_num_threads(1)
+    try:
+        accumulator = RankAccumulator(hits_at)
+        KGEModel.test_step(
+            model, test_triples, args, random_sampling, full_ranking, info, entity_block_size, accumulator
+        )
+        results.put(accumulator)
+    except Exception as error:
+        results.put(error)
@@ -0,0 +1,107 @@
+from typing import Any, Optional
+
+import torch
+from torch import Tensor
+
+QUANTIZED_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "int8": torch.int8}
+
+_INT8_MAX = 127
+
+
+class QuantizedTable:
+    """Entity table stored in a reduced precision and dequantized to float32 on read
+
+    ``float16`` and ``bfloat16`` tables are cast back on read. ``int8`` tables are quantized
+    symmetrically per row: a row is stored as ``round(row / scale)`` with ``scale`` its largest
+    absolute value divided by 127. Indexing returns float32 rows, so a table can be passed
+    as ``entity_table`` to :func:`redkg.models.kge_scoring.rank_against_table` and only one
+    block of entities is dequantized at a time.
+
+    :param data: (Tensor) stored values, shape (nentity, dim)
+    :param scale: (Optional[Tensor]) float32 scale of every row for int8 tables, shape (nentity,)
+    """
+
+    def __init__(self, data: Tensor, scale: Optional[Tensor] = None) -> None:
+        if data.dtype == torch.int8 and scale is None:
+            raise ValueError("int8 tables need per-row scales")
+        self.data = data
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, table: Tensor, dtype: str = "int8") -> "QuantizedTable":
+        """Convert a float table
+
+        :param table: (Tensor) entity embeddings, shape (nentity, dim)
+        :param dtype: (str) 'float16', 'bfloat16' or 'int8'
+        :raises ValueError: if the dtype is not supported
+        :returns: (QuantizedTable) table
+        """
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError("dtype %s not supported" % dtype)
+        table = table.detach().float()
+        if dtype != "int8":
+            return cls(table.to(QUANTIZED_DTYPES[dtype]))
+        scale = table.abs().amax(dim=1) / _INT8_MAX
+        # All-zero rows are stored as zeros whatever the scale
+        scale[scale == 0] = 1.0
+        data = torch.round(table / scale.unsqueeze(1)).clamp_(-_INT8_MAX, _INT8_MAX).to(torch.int8)
+        return cls(data, scale)
+
+    @property
+    def dtype(self) -> str:
+        """Name of the storage dtype"""
+        return next(name for name, dtype in QUANTIZED_DTYPES.items() if dtype == self.data.dtype)
+
+    @property
+    def shape(self) -> torch.Size:
+        """Shape of the table"""
+        return self.data.shape
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the stored values and scales"""
+        nbytes = self.data.numel() * self.data.element_size()
+        if self.scale is not None:
+            nbytes += self.scale.numel() * self.scale.element_size()
+        return nbytes
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, idx: Any) -> Tensor:
+        rows = self.data[idx].float()
+        if self.scale is None:
+            return rows
+        return rows * self.scale[idx].unsqueeze(-1)
+
+    def dequantize(self) -> Tensor:
+        """Whole table as float32
+
+        :returns: (Tensor) entity embeddings, shape (nentity, dim)
+        """
+        return self[:]
+
+    def to(self, device: Any) -> "QuantizedTable":
+        """Copy of the table on a device
+
+        :param device: target device
+        :returns: (QuantizedTable) table
+        """
+        return QuantizedTable(self.data.to(device), None if self.scale is None else self.scale.to(device))
+
+    def save(self, path: str) -> None:
+        """Save the table with ``torch.save``
+
+        :param path: (str) file to write
+        """
+        torch.save({"data": self.data, "scale": self.scale}, path)
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedTable":
+        """Open a table saved by :meth:`save`
+
+        :param path: (str) file with the table
+        :returns: (QuantizedTable) table
+        """
+        state = torch.load(path)
+        return cls(state["data"], state["scale"])
@@ -0,0 +1,437 @@
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from torch import Tensor
+
+from redkg.models.kge_quantization import QuantizedTable
+from redkg.models.kge_scoring import build_query, score_block
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is an optional backend
+    faiss = None
+
+# Metric space of the queries built by build_query in the 'tail-batch' mode
+MODEL_METRICS = {"TransE": "l1", "DistMult": "ip", "ComplEx": "ip", "RotatE": "complex_l2"}
+
+# score_block computes every metric as a similarity when gamma is 0
+_METRIC_MODELS = {"l1": "TransE", "ip": "DistMult", "complex_l2": "RotatE"}
+
+
+def _check_metric(metric: str) -> None:
+    if metric not in _METRIC_MODELS:
+        raise ValueError("metric %s not supported" % metric)
+
+
+def _interleave(vectors: NDArray) -> NDArray:
+    """Reorder [re..., im...] halves into (re, im) pairs, so that contiguous slices hold whole complex numbers"""
+    re, im = np.split(vectors, 2, axis=-1)
+    return np.stack([re, im], axis=-1).reshape(vectors.shape)
+
+
+def similarity(metric: str, queries: NDArray, vectors: NDArray) -> NDArray:
+    """Similarity of every query to every vector, higher is closer
+
+    ``complex_l2`` expects vectors laid out by :func:`_interleave`.
+
+    :param metric: (str) 'l1', 'ip' or 'complex_l2'
+    :param queries: (NDArray) shape (num_queries, dim)
+    :param vectors: (NDArray) shape (num_vectors, dim)
+    :returns: (NDArray) shape (num_queries, num_vectors)
+    """
+    if metric == "ip":
+        return queries @ vectors.T
+    diff = queries[:, None, :] - vectors[None, :, :]
+    if metric == "l1":
+        return -np.abs(diff).sum(axis=-1)
+    if metric == "complex_l2":
+        return -np.sqrt((diff.reshape(*diff.shape[:2], -1, 2) ** 2).sum(axis=-1)).sum(axis=-1)
+    raise ValueError("metric %s not supported" % metric)
+
+
+def paired_similarity(metric: str, queries: NDArray, vectors: NDArray) -> NDArray:
+    """Similarity of every query to its own candidate vectors, higher is closer
+
+    :param metric: (str) 'l1', 'ip' or 'complex_l2'
+    :param queries: (NDArray) shape (num_queries, dim)
+    :param vectors: (NDArray) candidates of every query, shape (num_queries, num_candidates, dim)
+    :returns: (NDArray) shape (num_queries, num_candidates)
+    """
+    if metric == "ip":
+        return np.einsum("qd,qnd->qn", queries, vectors)
+    diff = queries[:, None, :] - vectors
+    if metric == "l1":
+        return -np.abs(diff).sum(axis=-1)
+    if metric == "complex_l2":
+        return -np.sqrt((diff.reshape(*diff.shape[:2], -1, 2) ** 2).sum(axis=-1)).sum(axis=-1)
+    raise ValueError("metric %s not supported" % metric)
+
+
+def _top_k(scores: NDArray, ids: NDArray, k: int) -> Tuple[NDArray, NDArray]:
+    """Best ``k`` candidates of every query row in descending order, padded with -inf and -1
+
+    :param scores: (NDArray) candidate scores, -inf for padding, shape (num_queries, num_candidates)
+    :param ids: (NDArray) candidate ids, shape (num_queries, num_candidates)
+    :param k: (int) number of results
+    :returns: (Tuple[NDArray, NDArray]) scores and ids, shape (num_queries, k)
+    """
+    top_scores = np.full((len(scores), k), -np.inf, dtype=np.float32)
+    top_ids = np.full((len(scores), k), -1, dtype=np.int64)
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = np.take_along_axis(scores, best, axis=1), np.take_along_axis(ids, best, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    scores, ids = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    found = scores.shape[1]
+    top_scores[:, :found] = scores
+    top_ids[:, :found] = np.where(np.isneginf(scores), -1, ids)
+    return top_scores, top_ids
+
+
+def kmeans(vectors: NDArray, num_clusters: int, num_iterations: int = 20, seed: int = 0) -> NDArray:
+    """Lloyd's k-means with L2 assignment
+
+    :param vectors: (NDArray) training vectors, shape (num_vectors, dim)
+    :param num_clusters: (int) number of centroids
+    :param num_iterations: (int) number of iterations
+    :param seed: (int) random seed of the initialization
+    :returns: (NDArray) centroids, shape (num_clusters, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=len(vectors) < num_clusters)].copy()
+    for _ in range(num_iterations):
+        assignment = _nearest_l2(vectors, centroids)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+def _nearest_l2(vectors: NDArray, centroids: NDArray, block_size: int = 65536) -> NDArray:
+    """Index of the nearest centroid of every vector by L2 distance"""
+    centroid_norms = (centroids**2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start : start + block_size]
+        assignment[start : start + block_size] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignment
+
+
+class ExactIndex:
+    """Brute force search over all vectors, ``block_size`` vectors at a time
+
+    :param metric: (str) 'l1', 'ip' or 'complex_l2'
+    :param block_size: (int) number of vectors scored at once
+    """
+
+    def __init__(self, metric: str, block_size: int = 65536) -> None:
+        _check_metric(metric)
+        self.metric = metric
+        self.block_size = block_size
+        self.vectors: Union[Tensor, QuantizedTable] = torch.zeros(0)
+
+    def add(self, vectors: Union[NDArray, Tensor, QuantizedTable]) -> None:
+        """Index vectors, a quantized table is kept as is and dequantized one block at a time
+
+        :param vectors: (Union[NDArray, Tensor, QuantizedTable]) shape (num_vectors, dim)
+        """
+        if isinstance(vectors, QuantizedTable):
+            self.vectors = vectors
+        else:
+            self.vectors = torch.as_tensor(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def search(self, queries: NDArray, k: int) -> Tuple[NDArray, NDArray]:
+        """Find the ``k`` most similar vectors of every query
+
+        :param queries: (NDArray) shape (num_queries, dim)
+        :param k: (int) number of results
+        :returns: (Tuple[NDArray, NDArray]) similarities and ids, shape (num_queries, k), best first
+        """
+        queries_tensor = torch.as_tensor(np.asarray(queries, dtype=np.float32))
+        best_scores = torch.full((len(queries_tensor), 0), float("-inf"))
+        best_ids = torch.zeros((len(queries_tensor), 0), dtype=torch.long)
+        with torch.no_grad():
+            for start in range(0, len(self.vectors), self.block_size):
+                scores = score_block(
+                    _METRIC_MODELS[self.metric], queries_tensor, self.vectors[start : start + self.block_size], 0.0
+                )
+                ids = torch.arange(start, start + scores.shape[1]).expand_as(scores)
+                best_scores, position = torch.cat([best_scores, scores], dim=1).topk(
+                    min(k, best_scores.shape[1] + scores.shape[1]), dim=1
+                )
+                best_ids = torch.cat([best_ids, ids], dim=1).gather(1, position)
+        top_scores = np.full((len(queries_tensor), k), -np.inf, dtype=np.float32)
+        top_ids = np.full((len(queries_tensor), k), -1, dtype=np.int64)
+        top_scores[:, : best_scores.shape[1]], top_ids[:, : best_ids.shape[1]] = best_scores.numpy(), best_ids.numpy()
+        return top_scores, top_ids
+
+
+class IVFPQIndex:
+    """Inverted file index with product quantized residuals in NumPy
+
+    Vectors are assigned to ``num_lists`` k-means centroids and the residual to their
+    centroid is split into ``num_subspaces`` slices, each encoded as the id of one of
+    ``2 ** num_bits`` sub-centroids. A query scans the ``nprobe`` nearest lists and scores
+    codes with per-subspace lookup tables. All three metrics decompose over subspaces, so
+    the tables are exact for the quantized vectors. With ``refine`` > 1 the raw vectors are
+    kept and the best ``refine * k`` candidates are re-scored exactly.
+
+    :param metric: (str) 'l1', 'ip' or 'complex_l2'
+    :param num_lists: (int) number of inverted lists
+    :param num_subspaces: (int) number of product quantizer subspaces, must divide the dimension
+    :param num_bits: (int) bits per subspace code, at most 8
+    :param nprobe: (int) number of lists scanned per query
+    :param refine: (int) candidates re-scored exactly per result, 0 or 1 to disable
+    :param train_size: (int) maximum number of vectors used to train the quantizers
+    :param seed: (int) random seed
+    """
+
+    def __init__(
+        self,
+        metric: str,
+        num_lists: int = 1024,
+        num_subspaces: int = 8,
+        num_bits: int = 8,
+        nprobe: int = 16,
+        refine: int = 0,
+        train_size: int = 100000,
+        seed: int = 0,
+    ) -> None:
+        _check_metric(metric)
+        if num_bits > 8:
+            raise ValueError("num_bits must be at most 8")
+        self.metric = metric
+        self.num_lists = num_lists
+        self.num_subspaces = num_subspaces
+        self.num_codes = 2**num_bits
+        self.nprobe = nprobe
+        self.refine = refine
+        self.train_size = train_size
+        self.seed = seed
+
+    def _layout(self, vectors: NDArray) -> NDArray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return _interleave(vectors) if self.metric == "complex_l2" else vectors
+
+    def add(self, vectors: NDArray) -> None:
+        """Train the quantizers on a sample of the vectors and index all of them
+
+        :param vectors: (NDArray) shape (num_vectors, dim)
+        """
+        vectors = self._layout(vectors)
+        dim = vectors.shape[1]
+        self.sub_dim = dim // self.num_subspaces
+        if self.sub_dim * self.num_subspaces != dim or (self.metric == "complex_l2" and self.sub_dim % 2):
+            raise ValueError(f"num_subspaces={self.num_subspaces} does not split dimension {dim} into whole slices")
+
+        rng = np.random.default_rng(self.seed)
+        sample = vectors[rng.choice(len(vectors), min(self.train_size, len(vectors)), replace=False)]
+        self.centroids = kmeans(sample, min(self.num_lists, len(sample)), seed=self.seed)
+        sample_residuals = sample - self.centroids[_nearest_l2(sample, self.centroids)]
+        self.codebooks = np.stack(
+            [
+                kmeans(self._subspace(sample_residuals, j), min(self.num_codes, len(sample)), seed=self.seed + j)
+                for j in range(self.num_subspaces)
+            ]
+        )
+
+        assignment = _nearest_l2(vectors, self.centroids)
+        residuals = vectors - self.centroids[assignment]
+        codes = np.stack(
+            [_nearest_l2(self._subspace(residuals, j), self.codebooks[j]) for j in range(self.num_subspaces)], axis=1
+        ).astype(np.uint8)
+        order = np.argsort(assignment, kind="stable")
+        self.list_offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(self.centroids)), out=self.list_offsets[1:])
+        self.list_ids = order
+        self.codes = codes[order]
+        self.vectors = vectors if self.refine > 1 else None
+
+    def _subspace(self, vectors: NDArray, j: int) -> NDArray:
+        return vectors[:, j * self.sub_dim : (j + 1) * self.sub_dim]
+
+    def _tables(self, query: NDArray) -> NDArray:
+        """Similarity of every query slice to every sub-centroid, shape (num_queries, num_subspaces, num_codes)"""
+        return np.stack(
+            [similarity(self.metric, self._subspace(query, j), self.codebooks[j]) for j in range(self.num_subspaces)],
+            axis=1,
+        )
+
+    def search(self, queries: NDArray, k: int) -> Tuple[NDArray, NDArray]:
+        """Find approximately the ``k`` most similar vectors of every query
+
+        :param queries: (NDArray) shape (num_queries, dim)
+        :param k: (int) number of results
+        :returns: (Tuple[NDArray, NDArray]) similarities and ids, shape (num_queries, k), best first
+        """
+        queries = self._layout(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        if self.metric == "ip":
+            centroid_scores = queries @ self.centroids.T
+        else:
+            centroid_scores = -((queries[:, None, :] - self.centroids[None]) ** 2).sum(axis=-1)
+        probes = np.argsort(-centroid_scores, axis=1)[:, :nprobe]
+        num_candidates = k * self.refine if self.vectors is not None else k
+
+        # Every (query, probed list) pair with its lookup tables and bias. Inner product is
+        # linear, so one table of the query serves every list
+        if self.metric == "ip":
+            tables = self._tables(queries)
+            pair_tables = np.repeat(np.arange(len(queries)), nprobe)
+            pair_biases = np.take_along_axis(centroid_scores, probes, axis=1).ravel()
+        else:
+            residuals = queries[:, None, :] - self.centroids[probes]
+            tables = self._tables(residuals.reshape(-1, queries.shape[1]))
+            pair_tables = np.arange(len(queries) * nprobe)
+            pair_biases = np.zeros(len(queries) * nprobe, dtype=np.float32)
+
+        # Codes of all the probed lists, scored by one gather over the tables
+        starts = self.list_offsets[probes].ravel()
+        lengths = self.list_offsets[probes + 1].ravel() - starts
+        pairs = np.repeat(np.arange(len(starts)), lengths)
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[pairs]
+        codes = self.codes[positions].astype(np.int64)
+        lookups = tables[pair_tables[pairs][:, None], np.arange(self.num_subspaces), codes]
+        scores = pair_biases[pairs] + lookups.sum(axis=1)
+
+        # Candidates of a query are contiguous, pad them into one row per query
+        query_lengths = lengths.reshape(len(queries), nprobe).sum(axis=1)
+        queries_of = pairs // nprobe
+        columns = np.arange(len(pairs)) - np.repeat(np.cumsum(query_lengths) - query_lengths, query_lengths)
+        width = max(int(query_lengths.max(initial=0)), 1)
+        candidate_scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        candidate_ids = np.full((len(queries), width), -1, dtype=np.int64)
+        candidate_scores[queries_of, columns] = scores
+        candidate_ids[queries_of, columns] = self.list_ids[positions]
+        candidate_scores, candidate_ids = _top_k(candidate_scores, candidate_ids, num_candidates)
+
+        if self.vectors is not None:
+            exact = paired_similarity(self.metric, queries, self.vectors[np.maximum(candidate_ids, 0)])
+            candidate_scores = np.where(candidate_ids >= 0, exact, -np.inf).astype(np.float32)
+        return _top_k(candidate_scores, candidate_ids, k)
+
+
+class FaissIndex:
+    """Index backed by faiss, built with ``faiss.index_factory``
+
+    Requires the optional ``faiss-cpu`` package. faiss has no metric for the summed complex
+    moduli of RotatE, so only 'l1' and 'ip' are supported. faiss only computes L1 distances
+    on raw vectors, so 'l1' needs a factory with a flat encoding, e.g. 'Flat' or 'IVF1024,Flat'.
+
+    :param metric: (str) 'l1' or 'ip'
+    :param factory: (str) faiss index factory string, e.g. 'Flat' or 'IVF1024,PQ16'
+    :param nprobe: (Optional[int]) number of lists scanned by IVF indexes
+    :raises ValueError: if the metric is not supported or 'l1' is used with a compressed encoding
+    :raises ImportError: if faiss is not installed
+    """
+
+    def __init__(self, metric: str, factory: str = "Flat", nprobe: Optional[int] = None) -> None:
+        if metric not in ("l1", "ip"):
+            raise ValueError("metric %s not supported by faiss" % metric)
+        if metric == "l1" and factory.split(",")[-1].strip() != "Flat":
+            raise ValueError("faiss supports the l1 metric with flat encodings only, got factory %s" % factory)
+        if faiss is None:
+            raise ImportError("FaissIndex requires faiss, install it with `pip install faiss-cpu`")
+        self.metric = metric
+        self.factory = factory
+        self.nprobe = nprobe
+        self.index: Any = None
+
+    def add(self, vectors: NDArray) -> None:
+        """Train the index if needed and add the vectors
+
+        :param vectors: (NDArray) shape (num_vectors, dim)
+        """
+        assert faiss is not None
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        faiss_metric = faiss.METRIC_INNER_PRODUCT if self.metric == "ip" else faiss.METRIC_L1
+        self.index = faiss.index_factory(vectors.shape[1], self.factory, faiss_metric)
+        if not self.index.is_trained:
+            self.index.train(vectors)
+        if self.nprobe is not None:
+            faiss.ParameterSpace().set_index_parameter(self.index, "nprobe", self.nprobe)
+        self.index.add(vectors)
+
+    def search(self, queries: NDArray, k: int) -> Tuple[NDArray, NDArray]:
+        """Find the ``k`` most similar vectors of every query
+
+        :param queries: (NDArray) shape (num_queries, dim)
+        :param k: (int) number of results
+        :returns: (Tuple[NDArray, NDArray]) similarities and ids, shape (num_queries, k), best first
+        """
+        distances, ids = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        return (distances if self.metric == "ip" else -distances), ids
+
+
+Index = Union[ExactIndex, IVFPQIndex, FaissIndex]
+
+BACKENDS: Dict[str, Any] = {"exact": ExactIndex, "ivfpq": IVFPQIndex, "faiss": FaissIndex}
+
+
+class KGERetriever:
+    """Top-k tail retrieval for (head, relation) queries of a trained :class:`KGEModel`
+
+    The entity table is exported into an index in the metric space of the model: L1 for
+    TransE, inner product for DistMult and ComplEx and summed complex moduli for RotatE.
+    A table exported by :meth:`KGEModel.quantize_entities` is used instead of the float32 one,
+    the exact backend then scores it without dequantizing it whole.
+    Queries are the vectors of :func:`build_query` in the 'tail-batch' mode, so the returned
+    scores are the model scores of the triples.
+
+    :param model: (KGEModel) trained model
+    :param backend: (str) 'exact', 'ivfpq' or 'faiss'
+    :param index_kwargs: arguments of the backend index
+    """
+
+    def __init__(self, model: Any, backend: str = "exact", **index_kwargs: Any) -> None:
+        if backend not in BACKENDS:
+            raise ValueError("backend %s not supported" % backend)
+        self.model_name = model.model_name
+        self.metric = MODEL_METRICS[model.model_name]
+        self.gamma = model.gamma.item()
+        self.embedding_range = model.embedding_range.item()
+        self.entity_embedding: Union[Tensor, QuantizedTable]
+        if model.inference_entity_table is not None:
+            self.entity_embedding = model.inference_entity_table.to("cpu")
+        else:
+            self.entity_embedding = model.entity_embedding.detach().cpu()
+        self.relation_embedding = model.relation_embedding.detach().cpu()
+        self.index: Index = BACKENDS[backend](self.metric, **index_kwargs)
+        if isinstance(self.index, ExactIndex):
+            self.index.add(self.entity_embedding)
+        else:
+            self.index.add(self.entity_embedding[:].numpy())
+
+    def query(self, head: Tensor, relation: Tensor) -> Tensor:
+        """Query vectors of (head, relation) pairs
+
+        :param head: (Tensor) head ids
+        :param relation: (Tensor) relation ids
+        :returns: (Tensor) query vectors, shape (batch, entity_dim)
+        """
+        return build_query(
+            self.model_name,
+            self.entity_embedding[head],
+            self.relation_embedding[relation],
+            "tail-batch",
+            self.embedding_range,
+        )
+
+    def top_k(self, head: Tensor, relation: Tensor, k: int) -> Tuple[Tensor, Tensor]:
+        """Best scoring tails of (head, relation) pairs
+
+        :param head: (Tensor) head ids, shape (batch,)
+        :param relation: (Tensor) relation ids, shape (batch,)
+        :param k: (int) number of tails
+        :returns: (Tuple[Tensor, Tensor]) scores and tail ids, shape (batch, k), best first
+        """
+        with torch.no_grad():
+            similarities, ids = self.index.search(self.query(head, relation).numpy(), k)
+        scores = torch.from_numpy(np.asarray(similarities, dtype=np.float32))
+        if self.metric != "ip":
+            scores = self.gamma + scores
+        return scores, torch.from_numpy(np.asarray(ids, dtype=np.int64))
@@ -0,0 +1,148 @@
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+
+from redkg.evaluator import DEFAULT_TIES, TIE_MODES
+
+PI = 3.14159265358979323846
+
+SUPPORTED_MODELS = ("TransE", "DistMult", "ComplEx", "RotatE")
+
+
+def build_query(model_name: str, anchor: Tensor, relation: Tensor, mode: str, embedding_range: float) -> Tensor:
+    """Fold the fixed part of a triple into a single query vector per row.
+
+    In the 'tail-batch' mode the anchor is the head and the candidates are tails,
+    in the 'head-batch' mode the anchor is the tail and the candidates are heads.
+    The query is built so that :func:`score_block` of the query and a candidate
+    equals the score of the full triple.
+
+    :param model_name: (str) name of KGE model
+    :param anchor: (Tensor) anchor entity embeddings, shape (batch, entity_dim)
+    :param relation: (Tensor) relation embeddings, shape (batch, relation_dim)
+    :param mode: (str) 'head-batch' or 'tail-batch'
+    :param embedding_range: (float) embedding range of the model, used by RotatE to get phases
+    :raises ValueError: if the model or the mode is not supported
+    :returns: (Tensor) query embeddings, shape (batch, entity_dim)
+    """
+    if mode not in ("head-batch", "tail-batch"):
+        raise ValueError("mode %s not supported" % mode)
+
+    if model_name == "TransE":
+        return anchor - relation if mode == "head-batch" else anchor + relation
+
+    if model_name == "DistMult":
+        return anchor * relation
+
+    if model_name == "ComplEx":
+        re_anchor, im_anchor = torch.chunk(anchor, 2, dim=-1)
+        re_relation, im_relation = torch.chunk(relation, 2, dim=-1)
+    elif model_name == "RotatE":
+        re_anchor, im_anchor = torch.chunk(anchor, 2, dim=-1)
+        # Make phases of relations uniformly distributed in [-pi, pi]
+        phase_relation = relation / (embedding_range / PI)
+        re_relation, im_relation = torch.cos(phase_relation), torch.sin(phase_relation)
+    else:
+        raise ValueError("model %s not supported" % model_name)
+
+    if mode == "head-batch":
+        re_query = re_relation * re_anchor + im_relation * im_anchor
+        im_query = re_relation * im_anchor - im_relation * re_anchor
+    else:
+        re_query = re_anchor * re_relation - im_anchor * im_relation
+        im_query = re_anchor * im_relation + im_anchor * re_relation
+    return torch.cat([re_query, im_query], dim=-1)
+
+
+def _pair(query: Tensor, candidates: Tensor) -> Tuple[Tensor, Tensor]:
+    """Align queries and candidates for broadcasting: (batch, 1, dim) against (1 | batch, block, dim)"""
+    if candidates.dim() == 2:
+        return query.unsqueeze(1), candidates.unsqueeze(0)
+    return query.unsqueeze(1), candidates
+
+
+def score_block(model_name: str, query: Tensor, candidates: Tensor, gamma: float) -> Tensor:
+    """Score a block of candidates against the queries built by :func:`build_query`.
+
+    Candidates are either shared by every query, shape (block, dim), or given per
+    query, shape (batch, block, dim). DistMult and ComplEx are reduced with a single
+    matrix product, TransE with an L1 ``cdist``, so no (batch, block, dim)
+    intermediate is created for them. RotatE still needs one per block.
+
+    :param model_name: (str) name of KGE model
+    :param query: (Tensor) query embeddings, shape (batch, dim)
+    :param candidates: (Tensor) candidate entity embeddings
+    :param gamma: (float) margin of distance based models
+    :raises ValueError: if the model is not supported
+    :returns: (Tensor) scores, shape (batch, block)
+    """
+    if model_name in ("DistMult", "ComplEx"):
+        if candidates.dim() == 2:
+            return query @ candidates.t()
+        return torch.bmm(candidates, query.unsqueeze(2)).squeeze(2)
+
+    if model_name == "TransE":
+        if candidates.dim() == 2:
+            return gamma - torch.cdist(query, candidates, p=1)
+        return gamma - torch.cdist(query.unsqueeze(1), candidates, p=1).squeeze(1)
+
+    if model_name == "RotatE":
+        query, candidates = _pair(query, candidates)
+        re_query, im_query = torch.chunk(query, 2, dim=-1)
+        re_candidates, im_candidates = torch.chunk(candidates, 2, dim=-1)
+        score = torch.stack([re_query - re_candidates, im_query - im_candidates], dim=0)
+        return gamma - score.norm(dim=0).sum(dim=-1)
+
+    raise ValueError("model %s not supported" % model_name)
+
+
+def rank_against_table(
+    model_name: str,
+    query: Tensor,
+    positive_score: Tensor,
+    entity_table: Tensor,
+    gamma: float,
+    block_size: int,
+    filter_rows: Optional[Tensor] = None,
+    filter_cols: Optional[Tensor] = None,
+    ties: str = DEFAULT_TIES,
+) -> Tensor:
+    """Rank the positive score of every query among all entities of the table.
+
+    The table is scanned once, ``block_size`` entities at a time, with one
+    :func:`score_block` call per block. Filtered entities are given as a sparse
+    (row, entity) index list sorted by entity and are excluded from the ranking.
+
+    :param model_name: (str) name of KGE model
+    :param query: (Tensor) query embeddings, shape (batch, dim)
+    :param positive_score: (Tensor) scores of the true triples, shape (batch,)
+    :param entity_table: (Tensor) entity embeddings, shape (nentity, dim); anything sliceable by rows works,
+        e.g. a :class:`redkg.models.kge_quantization.QuantizedTable` dequantized block by block
+    :param gamma: (float) margin of distance based models
+    :param block_size: (int) number of entities scored at once
+    :param filter_rows: (Optional[Tensor]) query rows of the filtered entities
+    :param filter_cols: (Optional[Tensor]) ids of the filtered entities, sorted in ascending order
+    :param ties: (str) rank of the positive among equal scores, see :meth:`redkg.evaluator.Evaluator.rank`
+    :raises ValueError: if the ties mode is not supported
+    :returns: (Tensor) ranks of the positive scores, shape (batch,)
+    """
+    if ties not in TIE_MODES:
+        raise ValueError("ties mode %s not supported" % ties)
+    nentity = len(entity_table)
+    ranking_list = torch.ones_like(positive_score, dtype=torch.long)
+    num_equal = torch.zeros_like(positive_score, dtype=torch.long)
+    for start in range(0, nentity, block_size):
+        end = min(start + block_size, nentity)
+        scores = score_block(model_name, query, entity_table[start:end], gamma)
+        if filter_rows is not None and filter_cols is not None:
+            lo, hi = torch.searchsorted(filter_cols, torch.tensor([start, end], device=filter_cols.device)).tolist()
+            scores[filter_rows[lo:hi], filter_cols[lo:hi] - start] = float("-inf")
+        ranking_list += (scores > positive_score.unsqueeze(1)).sum(dim=1)
+        if ties != "optimistic":
+            num_equal += (scores == positive_score.unsqueeze(1)).sum(dim=1)
+    if ties == "pessimistic":
+        return ranking_list + num_equal
+    if ties == "realistic":
+        return ranking_list + num_equal / 2
+    return ranking_list
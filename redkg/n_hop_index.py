@@ -0,0 +1,120 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+from numpy.typing import NDArray
+
+
+class NHopIndex:
+    """Neighbours of every entity at hop distances 1..k stored as CSR arrays
+
+    Hop ``h`` of an entity lists, in ascending order, the entities at shortest path
+    distance exactly ``h`` from it, so every entity appears in at most one hop of
+    another. Each hop is an (offsets, neighbors) pair indexed directly by entity id;
+    :meth:`save` writes them as .npy files that :meth:`load` memory maps.
+
+    :param offsets: (List[NDArray]) per hop, neighbours of entity ``e`` are ``neighbors[e]`` between
+        ``offsets[e]`` and ``offsets[e + 1]``
+    :param neighbors: (List[NDArray]) per hop, neighbours grouped by entity
+    """
+
+    def __init__(self, offsets: List[NDArray], neighbors: List[NDArray]) -> None:
+        self.offsets = offsets
+        self.neighbors = neighbors
+
+    @property
+    def hops(self) -> int:
+        """Number of hops in the index"""
+        return len(self.offsets)
+
+    @property
+    def num_entities(self) -> int:
+        """Number of entity rows in the index"""
+        return len(self.offsets[0]) - 1 if self.offsets else 0
+
+    @classmethod
+    def build(cls, adjacency: sp.csr_matrix, hops: int, row_block: int = 4096) -> "NHopIndex":
+        """Expand the BFS rings of all entities, ``row_block`` source entities at a time
+
+        :param adjacency: (sp.csr_matrix) square adjacency matrix of the undirected graph
+        :param hops: (int) number of hops
+        :param row_block: (int) number of source entities expanded at once
+        :returns: (NHopIndex) index
+        """
+        num_entities = adjacency.shape[0]
+        adjacency = adjacency.tocsr()
+        value_dtype = np.int32 if num_entities <= np.iinfo(np.int32).max else np.int64
+        counts: List[List[NDArray]] = [[] for _ in range(hops)]
+        neighbors: List[List[NDArray]] = [[] for _ in range(hops)]
+        for start in range(0, num_entities, row_block):
+            end = min(start + row_block, num_entities)
+            rows = np.arange(end - start)
+            frontier = sp.csr_matrix((np.ones(len(rows)), (rows, rows + start)), shape=(len(rows), num_entities))
+            visited = frontier
+            for hop in range(hops):
+                reached = frontier @ adjacency
+                reached.data[:] = 1
+                ring = (reached - reached.multiply(visited)).tocsr()
+                ring.eliminate_zeros()
+                ring.sort_indices()
+                counts[hop].append(np.diff(ring.indptr))
+                neighbors[hop].append(ring.indices.astype(value_dtype))
+                visited, frontier = visited + ring, ring
+
+        hop_offsets = []
+        for hop_counts in counts:
+            offsets = np.zeros(num_entities + 1, dtype=np.int64)
+            np.cumsum(np.concatenate(hop_counts) if hop_counts else [], out=offsets[1:])
+            hop_offsets.append(offsets)
+        hop_neighbors = [np.concatenate(chunks) if chunks else np.zeros(0, dtype=value_dtype) for chunks in neighbors]
+        return cls(hop_offsets, hop_neighbors)
+
+    def neighbors_of(self, entity: int, hop: int) -> NDArray:
+        """Neighbours of an entity at one hop as a view, empty for an unknown entity
+
+        :param entity: (int) entity id
+        :param hop: (int) hop distance starting from 1
+        :returns: (NDArray) sorted entity ids
+        """
+        offsets, neighbors = self.offsets[hop - 1], self.neighbors[hop - 1]
+        if not 0 <= entity < len(offsets) - 1:
+            return neighbors[:0]
+        return neighbors[offsets[entity] : offsets[entity + 1]]
+
+    def get(self, entity: int) -> Dict[int, NDArray]:
+        """Neighbours of an entity at every hop
+
+        :param entity: (int) entity id
+        :returns: (Dict[int, NDArray]) hop distance -> sorted entity ids
+        """
+        return {hop: self.neighbors_of(entity, hop) for hop in range(1, self.hops + 1)}
+
+    def save(self, path: str) -> None:
+        """Save the index as a directory of .npy files
+
+        :param path: (str) directory to write
+        """
+        os.makedirs(path, exist_ok=True)
+        for hop in range(1, self.hops + 1):
+            np.save(os.path.join(path, f"hop{hop}_offsets.npy"), self.offsets[hop - 1])
+            np.save(os.path.join(path, f"hop{hop}_neighbors.npy"), self.neighbors[hop - 1])
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"hops": self.hops}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "NHopIndex":
+        """Open an index saved by :meth:`save`
+
+        :param path: (str) directory with the index
+        :param mmap_mode: memory map mode passed to ``np.load``, None to read into memory
+        :returns: (NHopIndex) index
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            hops = json.load(f)["hops"]
+        offsets, neighbors = [], []
+        for hop in range(1, hops + 1):
+            offsets.append(np.load(os.path.join(path, f"hop{hop}_offsets.npy"), mmap_mode=mmap_mode))
+            neighbors.append(np.load(os.path.join(path, f"hop{hop}_neighbors.npy"), mmap_mode=mmap_mode))
+        return cls(offsets, neighbors)
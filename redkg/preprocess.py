@@ -1,14 +1,19 @@
+import io
 import os
 import random
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from numpy.typing import NDArray
 
 from redkg.config import Config
-from redkg.utils import pickle_dump
+from redkg.n_hop_index import NHopIndex
+from redkg.stage_cache import StageCache
+from redkg.utils import pickle_dump, pickle_load
 
 random.seed(14)
 np.random.seed(14)
@@ -20,6 +25,9 @@ class DataPreprocessor:
     :params config: Config instance
     """
 
+    # Number of entities whose 2-hop neighbourhoods are computed with one sparse product
+    _ROW_BLOCK = 4096
+
     def __init__(self, config: Config) -> None:
         self._config = config
 
@@ -40,144 +48,103 @@ class DataPreprocessor:
                 entity_vocab[entity] = len(entity_vocab)
 
     def _read_attribute_file(
-        self, attribute_path: str, user_vocab: Dict, item_vocab: Dict, entity_vocab: Dict
+        self, attribute_df: pd.DataFrame, user_vocab: Dict, item_vocab: Dict, entity_vocab: Dict
     ) -> Tuple[Dict, Dict, Dict]:
-        print(f"Logging Info - Reading attribute file: {attribute_path}")
+        print("Logging Info - Converting attribute file...")
         assert len(user_vocab) == 0 and len(item_vocab) > 0
-        user_attribute = defaultdict(list)
-
-        # Save attribute datas into user_attribute dict
-        with open(attribute_path, encoding="utf8") as reader:
-            for idx, line in enumerate(reader):
-                if idx == 0:  # Ignore first line
-                    continue
-                user, item, attribute, timestamp = line.strip().split(self._config.separator)[:4]
-                user, item, attribute = int(user), int(item), float(attribute)
-                if item in item_vocab:  # Ignore item not in KG
-                    user_attribute[user].append((item_vocab[item], attribute, timestamp))
-
-        # Remove user who has less interaction than 200 (minimum_interactions)
-        # # of remained users has to be 16,525
-        users2remove = []
-        for k, v in user_attribute.items():
-            if len(v) < self._config.minimum_interactions:
-                users2remove.append(k)
-        for user2remove in users2remove:
-            del user_attribute[user2remove]
-
-        # Split train : val : tests = 8 : 1 : 1
-        remained_users = list(user_attribute.keys())
-        total_users = len(remained_users)
-        random.shuffle(remained_users)
+        # The first four columns are user, item, attribute and timestamp
+        df = attribute_df.iloc[:, :4].copy()
+        df.columns = ["user", "item", "attribute", "timestamp"]
+
+        # Ignore items not in KG
+        item_index = pd.Index(list(item_vocab.keys()))
+        item_values = np.fromiter(item_vocab.values(), dtype=np.int64, count=len(item_vocab))
+        item_pos = item_index.get_indexer(df["item"].to_numpy())
+        df = df[item_pos >= 0]
+        df["item"] = item_values[item_pos[item_pos >= 0]]
+
+        # Sort by user id and timestamp, remove users who have less interactions than minimum_interactions
+        df = df.sort_values(by=["user", "timestamp"], kind="stable")
+        df = df[df.groupby("user")["item"].transform("size") >= self._config.minimum_interactions]
+
+        # Split train : val : tests = 8 : 1 : 1 over a permutation of the remained users
+        users, user_starts = np.unique(df["user"].to_numpy(), return_index=True)
+        total_users = len(users)
         train_last_index = int(total_users * self._config.train_proportion)
         validation_last_index = int(total_users * (self._config.train_proportion + self._config.validation_proportion))
-        train_users = remained_users[:train_last_index]
-        val_users = remained_users[train_last_index:validation_last_index]
+        split = np.full(total_users, 2)
+        permutation = np.random.default_rng(self._config.split_seed).permutation(total_users)
+        split[permutation[:train_last_index]] = 0
+        split[permutation[train_last_index:validation_last_index]] = 1
 
-        # # of interactions has to be 6,711,013
-        print("Logging Info - Converting attribute file...")
         train_attribute_dict: Dict[int, List[List]] = {}
         valid_attribute_dict: Dict[int, List[List]] = {}
         test_attribute_dict: Dict[int, List[List]] = {}
-        unwatched_item_id_set = set(item_vocab.values())
-        for user, rated_items_by_user in user_attribute.items():
-            if user in train_users:
-                target_dict = train_attribute_dict
-            elif user in val_users:
-                target_dict = valid_attribute_dict
-            else:
-                target_dict = test_attribute_dict
-
-            user_vocab[user] = len(user_vocab)
-            user_id = user_vocab[user]
-
-            target_dict[user_id] = []
-            for item_id, rate, timestamp in rated_items_by_user:
-                if item_id in unwatched_item_id_set:
-                    unwatched_item_id_set.remove(item_id)
-                target_dict[user_id].append([item_id, rate, timestamp])
+        target_dicts = (train_attribute_dict, valid_attribute_dict, test_attribute_dict)
+        records = list(
+            map(list, zip(df["item"].tolist(), df["attribute"].astype(float).tolist(), df["timestamp"].tolist()))
+        )
+        user_ends = np.append(user_starts[1:], len(records))
+        for user_id, (user, start, end, target) in enumerate(
+            zip(users.tolist(), user_starts.tolist(), user_ends.tolist(), split.tolist())
+        ):
+            user_vocab[user] = user_id
+            target_dicts[target][user_id] = records[start:end]
 
         # Remove unrated items
-        # # of remained items has to be 16,426
-        items2remove = []
-        entities2remove = []
-        for k, v in item_vocab.items():
-            if v in unwatched_item_id_set:
-                items2remove.append(k)
-        for k, v in entity_vocab.items():
-            if v in unwatched_item_id_set:
-                entities2remove.append(k)
-
-        for i in range(len(items2remove)):
-            del item_vocab[items2remove[i]]
-            del entity_vocab[entities2remove[i]]
+        watched_item_ids = set(np.unique(df["item"].to_numpy()).tolist())
+        for vocab in (item_vocab, entity_vocab):
+            for key in [k for k, v in vocab.items() if v not in watched_item_ids]:
+                del vocab[key]
 
         print(f"Logging Info - num of users: {len(user_vocab)}, num of items: {len(item_vocab)}")
-        return train_attribute_dict, test_attribute_dict, valid_attribute_dict
+        return train_attribute_dict, valid_attribute_dict, test_attribute_dict
 
     def _read_kg(
         self, entity_vocab: Dict, relation_vocab: Dict, user_vocab: Dict, item_vocab: Dict
-    ) -> Tuple[Dict[int, Dict[int, List[int]]], NDArray]:
+    ) -> Tuple[NHopIndex, sp.csr_matrix]:
         print(f"Logging Info - Reading kg file: {self._config.kg_path}")
-
-        kg = defaultdict(list)
         print("# user:", len(user_vocab), "# item:", len(item_vocab), "# entity:", len(entity_vocab))
 
-        entity_freq = {}
-        with open(self._config.kg_path, encoding="utf8") as reader:
-            lines = reader.readlines()
-
-        for line in lines:
-            head, relation, tail = line.strip().split("\t")
-            head, tail = int(head), int(tail)
-            if tail not in entity_freq:
-                entity_freq[tail] = 0
-            else:
-                entity_freq[tail] += 1
+        # Parse kg.txt once into integer columns
+        kg_df = self._read_table(
+            self._config.kg_path,
+            header=False,
+            sep="\t",
+            names=["head", "relation", "tail"],
+            dtype={"head": np.int64, "relation": "category", "tail": np.int64},
+        )
+        heads, tails = kg_df["head"].to_numpy(), kg_df["tail"].to_numpy()
+        relations = kg_df["relation"].astype("category")
 
         max_entity_val = max(entity_vocab.values()) + 1
-        while True:
-            if len(entity_vocab) == 30000:
-                break
-            max_value = max(entity_freq.values())
-            for k, v in entity_freq.items():
-                if v == max_value:
-                    entity_vocab[k] = max_entity_val
-                    max_entity_val += 1
-                    del entity_freq[k]
-                    break
-
-        for line in lines:
-            head_str, relation, tail_str = line.strip().split("\t")
-            head, tail = int(head_str), int(tail_str)
-            if head not in entity_vocab or tail not in entity_vocab:
-                continue
-            else:
-                if relation not in relation_vocab:
-                    relation_vocab[relation] = len(relation_vocab)
-
-            # Undirected graph
-            kg[entity_vocab[head]].append(entity_vocab[tail])
-            kg[entity_vocab[tail]].append(entity_vocab[head])
+        num_new_entities = self._config.entity_vocab_size - len(entity_vocab)
+        for entity in self._most_frequent_entities(tails, entity_vocab, num_new_entities).tolist():
+            entity_vocab[entity] = max_entity_val
+            max_entity_val += 1
+
+        # Map raw entity ids to vocab ids, -1 for entities out of the vocab
+        vocab_index = pd.Index(list(entity_vocab.keys()))
+        vocab_values = np.fromiter(entity_vocab.values(), dtype=np.int64, count=len(entity_vocab))
+        head_pos, tail_pos = vocab_index.get_indexer(heads), vocab_index.get_indexer(tails)
+        kept = (head_pos >= 0) & (tail_pos >= 0)
+        head_ids, tail_ids = vocab_values[head_pos[kept]], vocab_values[tail_pos[kept]]
+
+        for relation in pd.unique(relations[kept].astype(str)):
+            if relation not in relation_vocab:
+                relation_vocab[relation] = len(relation_vocab)
 
         print("# user:", len(user_vocab), "# item:", len(item_vocab), "# entity:", len(entity_vocab))
+        # Same index layout as the former dense matrix: vocab id i is stored at row/column i - 1
         max_entity = max(entity_vocab.values())
-        adj_mat = np.zeros((max_entity, max_entity))
-
-        for line in lines:
-            head_str, relation, tail_str = line.strip().split("\t")
-            head, tail = int(head_str), int(tail_str)
-            if head in entity_vocab and tail in entity_vocab:
-                adj_mat[entity_vocab[head] - 1][entity_vocab[tail] - 1] = 1
-                adj_mat[entity_vocab[tail] - 1][entity_vocab[head] - 1] = 1
-
-        n_hop_kg: Dict[int, Dict[int, List[int]]] = {}
-        for entity in entity_vocab.values():
-            n_hop_kg[entity] = {1: [], 2: []}
-            n_hop_kg[entity][1] = kg[entity]
-            for t in kg[entity]:
-                n_hop_kg[entity][2].extend(kg[t])
-            n_hop_kg[entity][2] = list(set(n_hop_kg[entity][2]) - set(n_hop_kg[entity][1]))
+        adj_mat = self._undirected_adjacency(
+            np.mod(head_ids - 1, max_entity), np.mod(tail_ids - 1, max_entity), max_entity
+        )
+
+        # Undirected graph
+        n_hop_kg = NHopIndex.build(
+            self._undirected_adjacency(head_ids, tail_ids, max_entity + 1), self._config.hops, self._ROW_BLOCK
+        )
 
         print(
             f"Logging Info - num of entities: {len(entity_vocab)}, num of relations: {len(relation_vocab)}",
@@ -186,33 +153,171 @@ class DataPreprocessor:
         )
         return n_hop_kg, adj_mat
 
+    @staticmethod
+    def _most_frequent_entities(entities: NDArray, exclude: Dict, k: int) -> NDArray:
+        """Select the k most frequent entities in one pass over a count array
+
+        Ties are broken by the first occurrence of the entity, so the selection is deterministic.
+
+        :param entities: (NDArray) non-negative raw entity ids, one per occurrence
+        :param exclude: (Dict) entities that cannot be selected
+        :param k: (int) number of entities to select
+        :returns: (NDArray) selected entities, most frequent first
+        """
+        counts = np.bincount(entities)
+        first_occurrence = np.full(len(counts), len(entities), dtype=np.int64)
+        first_occurrence[entities[::-1]] = np.arange(len(entities) - 1, -1, -1)
+
+        candidates = np.flatnonzero(counts)
+        excluded = np.fromiter(exclude.keys(), dtype=np.int64, count=len(exclude))
+        candidates = candidates[~np.isin(candidates, excluded)]
+        k = min(max(k, 0), len(candidates))
+        if k == 0:
+            return candidates[:0]
+        if k < len(candidates):
+            candidate_counts = counts[candidates]
+            threshold = np.partition(candidate_counts, len(candidates) - k)[len(candidates) - k]
+            ties = candidates[candidate_counts == threshold]
+            num_ties = k - int((candidate_counts > threshold).sum())
+            ties = ties[np.argpartition(first_occurrence[ties], num_ties - 1)[:num_ties]]
+            candidates = np.concatenate([candidates[candidate_counts > threshold], ties])
+        order = np.lexsort((first_occurrence[candidates], -counts[candidates]))
+        return candidates[order]
+
+    @staticmethod
+    def _undirected_adjacency(heads: NDArray, tails: NDArray, size: int) -> sp.csr_matrix:
+        """Binary symmetric CSR adjacency matrix of the given edges
+
+        :param heads: (NDArray) first ends of the edges
+        :param tails: (NDArray) second ends of the edges
+        :param size: (int) number of rows and columns
+        :returns: (sp.csr_matrix) adjacency matrix
+        """
+        rows, cols = np.concatenate([heads, tails]), np.concatenate([tails, heads])
+        adj_mat = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(size, size))
+        adj_mat.data[:] = 1
+        return adj_mat
+
+    def _read_table(self, path: str, header: bool, **read_kwargs: Any) -> pd.DataFrame:
+        """Read a delimited text file, in line-aligned chunks across a process pool if ``num_workers`` > 1
+
+        :param path: (str) path to the file
+        :param header: (bool) whether the first line holds the column names
+        :param read_kwargs: arguments passed to ``pd.read_csv``
+        :returns: (pd.DataFrame) parsed table
+        """
+        num_workers = self._config.num_workers
+        if num_workers <= 1:
+            return pd.read_csv(path, header=0 if header else None, **read_kwargs)
+
+        start = 0
+        if header:
+            read_kwargs["names"] = pd.read_csv(path, nrows=0, **read_kwargs).columns
+            with open(path, "rb") as f:
+                start = len(f.readline())
+        num_chunks = max(num_workers, -(-os.path.getsize(path) // self._config.chunk_size))
+        ranges = _line_aligned_ranges(path, start, num_chunks)
+        with ProcessPoolExecutor(num_workers) as pool:
+            frames = list(
+                pool.map(_read_csv_range, repeat(path), *zip(*ranges), repeat({**read_kwargs, "header": None}))
+            )
+        return pd.concat(frames, ignore_index=True)
+
     def process_data(self) -> None:
-        """Run preprocessing pipeline and save results to dir specified in config"""
-        os.makedirs(self._config.preprocess_results_dir, exist_ok=True)
-
-        # Sort attribute file based on user id and timestamp
-        df = pd.read_csv(self._config.attribute_path, delimiter=self._config.separator)
-        df = df.sort_values(by=["userId", "timestamp"], ascending=[True, True])
-        sorted_attribute_path = f"{self._config.raw_data_dir}/{self._config.dataset_name}/sorted.csv"
-        df.to_csv(sorted_attribute_path, index=False)
-
-        user_vocab: Dict[int, Any] = {}
-        item_vocab: Dict[int, Any] = {}
-        entity_vocab: Dict[int, Any] = {}
-        relation_vocab: Dict[int, Any] = {}
-
-        self._read_item2entity_file(item_vocab, entity_vocab)
-        train_data_dict, val_data_dict, test_data_dict = self._read_attribute_file(
-            sorted_attribute_path, user_vocab, item_vocab, entity_vocab
+        """Run preprocessing pipeline and save results to dir specified in config
+
+        Each stage is skipped if its inputs and the config fields it depends on did not change since its last run.
+        """
+        results_dir = self._config.preprocess_results_dir
+        os.makedirs(results_dir, exist_ok=True)
+        cache = StageCache(results_dir)
+
+        attribute_outputs = {
+            name: f"{results_dir}/{name}.pkl"
+            for name in (
+                "user_vocab",
+                "item_vocab",
+                "item_entity_vocab",
+                "train_data_dict",
+                "val_data_dict",
+                "test_data_dict",
+            )
+        }
+        attribute_key = cache.stage_key(
+            "attribute",
+            [self._config.item2entity_path, self._config.attribute_path],
+            {
+                "separator": self._config.separator,
+                "minimum_interactions": self._config.minimum_interactions,
+                "proportions": [self._config.train_proportion, self._config.validation_proportion],
+                "split_seed": self._config.split_seed,
+            },
+        )
+        if self._config.use_stage_cache and cache.is_fresh(
+            "attribute", attribute_key, list(attribute_outputs.values())
+        ):
+            print("Logging Info - Attribute stage is up to date, loading its results")
+            user_vocab = pickle_load(attribute_outputs["user_vocab"])
+            item_vocab = pickle_load(attribute_outputs["item_vocab"])
+            entity_vocab = pickle_load(attribute_outputs["item_entity_vocab"])
+        else:
+            print(f"Logging Info - Reading attribute file: {self._config.attribute_path}")
+            attribute_df = self._read_table(self._config.attribute_path, header=True, sep=self._config.separator)
+
+            user_vocab, item_vocab, entity_vocab = {}, {}, {}
+            self._read_item2entity_file(item_vocab, entity_vocab)
+            train_data_dict, val_data_dict, test_data_dict = self._read_attribute_file(
+                attribute_df, user_vocab, item_vocab, entity_vocab
+            )
+            pickle_dump(attribute_outputs["user_vocab"], user_vocab)
+            pickle_dump(attribute_outputs["item_vocab"], item_vocab)
+            pickle_dump(attribute_outputs["item_entity_vocab"], entity_vocab)
+            pickle_dump(attribute_outputs["train_data_dict"], train_data_dict)
+            pickle_dump(attribute_outputs["val_data_dict"], val_data_dict)
+            pickle_dump(attribute_outputs["test_data_dict"], test_data_dict)
+            cache.commit("attribute", attribute_key)
+
+        kg_outputs = {
+            "entity_vocab": f"{results_dir}/entity_vocab.pkl",
+            "relation_vocab": f"{results_dir}/relation_vocab.pkl",
+            "n_hop_kg": f"{results_dir}/n_hop_kg/meta.json",
+            "kg_adj_mat": f"{results_dir}/kg_adj_mat.npz",
+        }
+        kg_key = cache.stage_key(
+            "kg",
+            [self._config.kg_path],
+            {"entity_vocab_size": self._config.entity_vocab_size, "hops": self._config.hops},
+            upstream=[attribute_key],
         )
-        pickle_dump(f"{self._config.preprocess_results_dir}/user_vocab.pkl", user_vocab)
-        pickle_dump(f"{self._config.preprocess_results_dir}/item_vocab.pkl", item_vocab)
-        pickle_dump(f"{self._config.preprocess_results_dir}/train_data_dict.pkl", train_data_dict)
-        pickle_dump(f"{self._config.preprocess_results_dir}/val_data_dict.pkl", val_data_dict)
-        pickle_dump(f"{self._config.preprocess_results_dir}/test_data_dict.pkl", test_data_dict)
+        if self._config.use_stage_cache and cache.is_fresh("kg", kg_key, list(kg_outputs.values())):
+            print("Logging Info - KG stage is up to date")
+            return
 
+        relation_vocab: Dict[str, int] = {}
         n_hop_kg, adj_mat = self._read_kg(entity_vocab, relation_vocab, user_vocab, item_vocab)
-        pickle_dump(f"{self._config.preprocess_results_dir}/entity_vocab.pkl", entity_vocab)
-        pickle_dump(f"{self._config.preprocess_results_dir}/relation_vocab.pkl", relation_vocab)
-        pickle_dump(f"{self._config.preprocess_results_dir}/n_hop_kg.pkl", n_hop_kg)
-        np.save(f"{self._config.preprocess_results_dir}/kg_adj_mat.npy", adj_mat)
+        pickle_dump(kg_outputs["entity_vocab"], entity_vocab)
+        pickle_dump(kg_outputs["relation_vocab"], relation_vocab)
+        n_hop_kg.save(f"{results_dir}/n_hop_kg")
+        sp.save_npz(kg_outputs["kg_adj_mat"], adj_mat)
+        cache.commit("kg", kg_key)
+
+
+def _line_aligned_ranges(path: str, start: int, num_chunks: int) -> List[Tuple[int, int]]:
+    """Split a file after ``start`` into byte ranges that begin and end at line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [start]
+    with open(path, "rb") as f:
+        for i in range(1, num_chunks):
+            f.seek(max(start + (size - start) * i // num_chunks, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+
+
+def _read_csv_range(path: str, start: int, end: int, read_kwargs: Dict[str, Any]) -> pd.DataFrame:
+    """Parse the lines of a file between two byte offsets"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return pd.read_csv(io.BytesIO(data), **read_kwargs)
@@ -0,0 +1,188 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from torch import Tensor
+
+Transitions = Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+
+
+class ReplayBuffer:
+    """Preallocated ring buffer of DQN transitions
+
+    States, actions, rewards, next states and done flags live in five tensors of
+    ``capacity`` rows. New transitions overwrite the oldest ones and a sample is one
+    vectorized gather per tensor, so no Python objects are built per transition.
+
+    :param capacity: (int) maximum number of stored transitions
+    :param state_dim: (int) size of a state vector
+    """
+
+    def __init__(self, capacity: int, state_dim: int) -> None:
+        self.capacity = capacity
+        self.states = torch.zeros(capacity, state_dim)
+        self.actions = torch.zeros(capacity, dtype=torch.long)
+        self.rewards = torch.zeros(capacity)
+        self.next_states = torch.zeros(capacity, state_dim)
+        self.dones = torch.zeros(capacity, dtype=torch.bool)
+        self._next = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, state: Tensor, action: int, reward: float, next_state: Tensor, done: bool) -> None:
+        """Store one transition
+
+        :param state: (Tensor) state, shape (state_dim,)
+        :param action: (int) index of the taken action
+        :param reward: (float) reward
+        :param next_state: (Tensor) state after the action, shape (state_dim,)
+        :param done: (bool) whether the episode ended
+        """
+        self.add_batch(
+            torch.as_tensor(state).reshape(1, -1),
+            torch.tensor([action]),
+            torch.tensor([reward], dtype=torch.float),
+            torch.as_tensor(next_state).reshape(1, -1),
+            torch.tensor([done]),
+        )
+
+    def add_batch(self, states: Tensor, actions: Tensor, rewards: Tensor, next_states: Tensor, dones: Tensor) -> Tensor:
+        """Store a batch of transitions, the oldest rows are overwritten once the buffer is full
+
+        :param states: (Tensor) states, shape (batch, state_dim)
+        :param actions: (Tensor) action indices, shape (batch,)
+        :param rewards: (Tensor) rewards, shape (batch,)
+        :param next_states: (Tensor) next states, shape (batch, state_dim)
+        :param dones: (Tensor) done flags, shape (batch,)
+        :returns: (Tensor) rows the transitions were written to
+        """
+        rows = (self._next + torch.arange(len(states))) % self.capacity
+        self.states[rows] = states.detach().float()
+        self.actions[rows] = actions.long()
+        self.rewards[rows] = rewards.float()
+        self.next_states[rows] = next_states.detach().float()
+        self.dones[rows] = dones.bool()
+        self._next = (self._next + len(states)) % self.capacity
+        self._size = min(self._size + len(states), self.capacity)
+        return rows
+
+    def transitions(self, rows: Tensor) -> Transitions:
+        """Gather stored transitions into contiguous tensors
+
+        :param rows: (Tensor) rows to read
+        :returns: (Transitions) states, actions, rewards, next states and done flags
+        """
+        return self.states[rows], self.actions[rows], self.rewards[rows], self.next_states[rows], self.dones[rows]
+
+    def sample(self, batch_size: int) -> Transitions:
+        """Sample transitions uniformly with replacement
+
+        :param batch_size: (int) number of transitions
+        :returns: (Transitions) states, actions, rewards, next states and done flags
+        """
+        return self.transitions(torch.randint(self._size, (batch_size,)))
+
+
+class SumTree:
+    """Binary tree over leaf priorities where every node holds the sum of its children
+
+    Leaves are stored in ``tree[size:]`` with ``size`` the capacity rounded up to a power
+    of two, so the parent of node ``i`` is ``i // 2``. Updates and prefix-sum searches are
+    done for a whole batch at once, one tree level per step.
+
+    :param capacity: (int) number of leaves
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.size = 1 << max(0, (capacity - 1).bit_length())
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        """Sum of all priorities"""
+        return float(self.tree[1])
+
+    def update(self, leaves: NDArray, priorities: NDArray) -> None:
+        """Set the priorities of leaves
+
+        :param leaves: (NDArray) leaf indices
+        :param priorities: (NDArray) new priorities
+        """
+        nodes = np.asarray(leaves, dtype=np.int64) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values: NDArray) -> NDArray:
+        """Find the leaves whose cumulative priority interval contains the values
+
+        :param values: (NDArray) values in [0, total)
+        :returns: (NDArray) leaf indices
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.0)
+            nodes = left + go_right
+        return nodes - self.size
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer sampling transitions proportionally to priority ** alpha
+
+    New transitions get the highest priority seen so far. Samples come with importance
+    sampling weights ``(N * P(i)) ** -beta`` normalized by their maximum.
+
+    :param capacity: (int) maximum number of stored transitions
+    :param state_dim: (int) size of a state vector
+    :param alpha: (float) how much the priorities skew sampling, 0 is uniform
+    :param beta: (float) strength of the importance sampling correction
+    :param eps: (float) added to the absolute TD errors so no transition gets zero priority
+    """
+
+    def __init__(self, capacity: int, state_dim: int, alpha: float = 0.6, beta: float = 0.4, eps: float = 1e-6) -> None:
+        super().__init__(capacity, state_dim)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self._max_priority = 1.0
+
+    def add_batch(self, states: Tensor, actions: Tensor, rewards: Tensor, next_states: Tensor, dones: Tensor) -> Tensor:
+        """Store a batch of transitions with the highest priority seen so far, see :meth:`ReplayBuffer.add_batch`"""
+        rows = super().add_batch(states, actions, rewards, next_states, dones)
+        self.tree.update(rows.numpy(), np.full(len(rows), self._max_priority**self.alpha))
+        return rows
+
+    def sample_prioritized(self, batch_size: int, beta: Optional[float] = None) -> Tuple[Transitions, Tensor, Tensor]:
+        """Sample transitions proportionally to their priorities, one value per equal segment of the total
+
+        :param batch_size: (int) number of transitions
+        :param beta: (Optional[float]) importance sampling exponent, ``self.beta`` if not given
+        :returns: (Tuple[Transitions, Tensor, Tensor]) transitions, their rows and importance sampling weights
+        """
+        beta = self.beta if beta is None else beta
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        rows = np.minimum(self.tree.find(values), self._size - 1)
+        probabilities = self.tree.tree[rows + self.tree.size] / self.tree.total
+        weights = (self._size * probabilities) ** -beta
+        rows_tensor = torch.from_numpy(rows)
+        return self.transitions(rows_tensor), rows_tensor, torch.from_numpy(weights / weights.max()).float()
+
+    def update_priorities(self, rows: Tensor, td_errors: Tensor) -> None:
+        """Set the priorities of sampled transitions from their TD errors
+
+        :param rows: (Tensor) rows returned by :meth:`sample_prioritized`
+        :param td_errors: (Tensor) TD errors of the transitions
+        """
+        priorities = td_errors.detach().abs().cpu().numpy().astype(np.float64) + self.eps
+        self._max_priority = max(self._max_priority, float(priorities.max()))
+        self.tree.update(rows.numpy(), priorities**self.alpha)
@@ -0,0 +1,90 @@
+import copy
+from typing import Any
+
+import numpy as np
+import torch
+import torch.nn as nn
+from numpy.typing import NDArray
+
+from redkg.config import Config
+from redkg.env import Simulator, VectorSimulator
+
+
+def recommend(model: Any, items: NDArray, actions: NDArray) -> NDArray:
+    """Map Q network actions to items: action ``a`` picks the ``a``-th 1-hop KG neighbour of the current item
+
+    :param model: layer with ``get_n_hop``
+    :param items: (NDArray) current item of every session
+    :param actions: (NDArray) chosen action of every session
+    :returns: (NDArray) recommended items, the current item if it has too few neighbours
+    """
+    recommended = items.copy()
+    for slot, (item, action) in enumerate(zip(items.tolist(), actions.tolist())):
+        candidates = model.get_n_hop(item)[1]
+        if action < len(candidates):
+            recommended[slot] = candidates[action]
+    return recommended
+
+
+def rollout_worker(
+    rank: int,
+    num_workers: int,
+    config: Config,
+    model: Any,
+    policy_net: nn.Module,
+    transitions: Any,
+    stop_event: Any,
+    mode: str = "train",
+    seed: int = 0,
+) -> None:
+    """Actor loop: play the sessions of one user shard and push transition batches to the learner
+
+    The actor replays the users ``rank::num_workers`` in ``config.rollout_envs`` concurrent
+    sessions, encoding each session with the recurrent state of ``model``. Actions are
+    epsilon greedy over a local copy of the shared ``policy_net``, refreshed every
+    ``config.policy_sync_interval`` steps.
+
+    :param rank: (int) index of the actor
+    :param num_workers: (int) number of actors
+    :param config: (Config) config
+    :param model: layer with the session API of :class:`redkg.models.gcn_gru_layers.AbstractLayer`
+    :param policy_net: (nn.Module) policy network in shared memory, updated by the learner
+    :param transitions: queue receiving (states, actions, rewards, next_states, dones) batches of NumPy arrays
+    :param stop_event: event set by the learner to stop the actors
+    :param mode: (str) split of the ratings to replay
+    :param seed: (int) base random seed
+    """
+    torch.set_num_threads(1)
+    torch.manual_seed(seed + rank)
+    rng = np.random.default_rng(seed + rank)
+
+    simulator = Simulator(config=config, mode=mode)
+    shard = np.arange(rank, simulator.num_users, num_workers)
+    if not len(shard):
+        return
+    env = VectorSimulator(simulator, min(config.rollout_envs, len(shard)), user_indices=shard)
+    env.reset()
+    local_policy = copy.deepcopy(policy_net)
+    # Sessions are kept per slot, so the rows passed to step_sessions are always unique
+    slots = torch.arange(env.num_envs)
+    model.init_sessions(env.num_envs)
+
+    step = 0
+    with torch.no_grad():
+        while not stop_event.is_set():
+            if step % config.policy_sync_interval == 0:
+                local_policy.load_state_dict(policy_net.state_dict())
+            _, items, _ = env.observe()
+            states = model.sessions[-1].clone()
+            q_values = local_policy(states)
+            actions = q_values.argmax(dim=1).numpy()
+            explore = rng.random(env.num_envs) < config.epsilon
+            actions[explore] = rng.integers(q_values.shape[1], size=int(explore.sum()))
+
+            rewards, dones = env.step(recommend(model, items, actions))
+            next_states = model.step_sessions(slots, torch.from_numpy(items))
+            # NumPy arrays are pickled by value, so a batch outlives the actor that produced it
+            transitions.put((states.numpy(), actions, rewards.astype(np.float32), next_states.numpy(), dones))
+            # Slots of finished sessions start the next user from an empty state
+            model.sessions[:, torch.from_numpy(dones)] = 0
+            step += 1
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+MANIFEST_FILE = "stage_cache.json"
+_BLOCK_SIZE = 1 << 20
+
+
+class StageCache:
+    """Manifest of preprocessing stages keyed by a content hash of their inputs
+
+    A stage is skipped when its key, built from the digests of its input files, its
+    parameters and the keys of the stages it depends on, matches the key recorded after
+    its last successful run and all of its outputs still exist. File digests are
+    remembered together with the file size and modification time, so an unchanged
+    input is not read again to be hashed.
+
+    :param cache_dir: (str) directory with the stage outputs and the manifest
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+        self.manifest: Dict[str, Dict[str, Any]] = {"stages": {}, "files": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def file_digest(self, path: str) -> str:
+        """Content hash of a file
+
+        :param path: (str) path to the file
+        :returns: (str) hex digest
+        """
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = self.manifest["files"].get(os.path.abspath(path))
+        if known is not None and known["signature"] == signature:
+            return known["digest"]
+
+        digest = hashlib.blake2b()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                digest.update(block)
+        self.manifest["files"][os.path.abspath(path)] = {"signature": signature, "digest": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def stage_key(
+        self, stage: str, input_paths: List[str], params: Dict[str, Any], upstream: Optional[List[str]] = None
+    ) -> str:
+        """Key of a stage run
+
+        :param stage: (str) name of the stage
+        :param input_paths: (List[str]) files read by the stage
+        :param params: (Dict[str, Any]) config fields the stage depends on
+        :param upstream: (Optional[List[str]]) keys of the stages whose outputs are read by the stage
+        :returns: (str) hex digest
+        """
+        description = {
+            "stage": stage,
+            "inputs": [self.file_digest(path) for path in input_paths],
+            "params": params,
+            "upstream": upstream or [],
+        }
+        return hashlib.blake2b(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_fresh(self, stage: str, key: str, output_paths: List[str]) -> bool:
+        """Check whether the outputs of a stage are up to date
+
+        :param stage: (str) name of the stage
+        :param key: (str) key from :meth:`stage_key`
+        :param output_paths: (List[str]) files written by the stage
+        :returns: (bool) True if the stage can be skipped
+        """
+        return self.manifest["stages"].get(stage) == key and all(os.path.exists(path) for path in output_paths)
+
+    def commit(self, stage: str, key: str) -> None:
+        """Record a successful stage run
+
+        :param stage: (str) name of the stage
+        :param key: (str) key from :meth:`stage_key`
+        """
+        self.manifest["stages"][stage] = key
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
@@ -1,18 +1,21 @@
 # type: ignore
+import queue
 import random
-from collections import deque
-from typing import Deque, Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torch.optim as optim
 from torch import Tensor
 from torch.functional import F
 from torch.utils.data import DataLoader
 
+from redkg.candidate_set import CandidateSet
 from redkg.dataloader import BidirectionalOneShotIterator, TrainDataset
 from redkg.env import Simulator
 from redkg.models.basic_models import Net
+from redkg.replay_buffer import PrioritizedReplayBuffer, ReplayBuffer, Transitions
+from redkg.rollout import rollout_worker
 
 # flake8: noqa
 
@@ -48,19 +51,20 @@ def train_gnn_model(model, optimizer, subgraph, positive_edges, negative_edges):
 def train_kge_model(kge_model, train_pars, info, train_triples, valid_triples, max_steps=10):
     """Trainin pipeline for model"""
     print("Training...")
-    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, kge_model.parameters()), lr=train_pars.learning_rate)
+    optimizer = kge_model.make_optimizer(train_pars.learning_rate)
 
+    train_dataset_head = TrainDataset(
+        triples=train_triples,
+        nentity=info["nentity"],
+        nrelation=info["nrelation"],
+        negative_sample_size=train_pars.negative_sample_size,
+        mode="head-batch",
+        count=info["triple_store"],
+        entity_dict=info["entity_dict"],
+        negative_mode=train_pars["negative_mode"],
+    )
     train_dataloader_head = DataLoader(
-        TrainDataset(
-            triples=train_triples,
-            nentity=info["nentity"],
-            nrelation=info["nrelation"],
-            negative_sample_size=train_pars.negative_sample_size,
-            mode="head-batch",
-            count=info["count"],
-            entity_dict=info["entity_dict"],
-            negative_mode=train_pars["negative_mode"],
-        ),
+        train_dataset_head,
         batch_size=train_pars.train_batch_size,
         shuffle=True,
         num_workers=max(1, train_pars.cpu_num // 2),
@@ -74,15 +78,17 @@ def train_kge_model(kge_model, train_pars, info, train_triples, valid_triples, m
             nrelation=info["nrelation"],
             negative_sample_size=train_pars.negative_sample_size,
             mode="tail-batch",
-            count=info["count"],
+            count=info["triple_store"],
             entity_dict=info["entity_dict"],
             negative_mode=train_pars["negative_mode"],
+            subsampling_weight=train_dataset_head.subsampling_weight,
         ),
         batch_size=train_pars.train_batch_size,
         shuffle=True,
         num_workers=max(1, train_pars.cpu_num // 2),
         collate_fn=TrainDataset.collate_fn,
     )
+
     train_iterator = BidirectionalOneShotIterator(train_dataloader_head, train_dataloader_tail)
 
     training_logs = []
@@ -103,73 +109,159 @@ def train_kge_model(kge_model, train_pars, info, train_triples, valid_triples, m
 class TrainPipeline:
     def __init__(self, config, item_vocab, model, optimizer):
         self.config = config
-        self.memory: Deque = deque(maxlen=10000)
+        self.model = model
+        if config.prioritized_replay:
+            self.memory = PrioritizedReplayBuffer(
+                capacity=config.replay_capacity,
+                state_dim=config.state_embed_dim,
+                alpha=config.replay_alpha,
+                beta=config.replay_beta,
+            )
+        else:
+            self.memory = ReplayBuffer(capacity=config.replay_capacity, state_dim=config.state_embed_dim)
         self.policy_net = Net()
         self.target_net = Net()
-        self.TARGET_UPDATE = 100
-        self.BATCH_SIZE = 10
-
-    def tmp_Q_eps_greedy(self, state, actions):
-        epsilon = 0.3
-        state = torch.tensor(state, dtype=torch.float)
-        out = self.policy_net.forward(state)
-        out = out.detach().numpy()
-        coin = random.random()
-        if coin < epsilon:
-            return actions[np.random.choice(range(len(actions)))]
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+        self.TARGET_UPDATE = config.target_update
+        self.BATCH_SIZE = config.replay_batch_size
+        # Kept across optimization steps so RMSprop accumulates its running averages
+        self.dqn_optimizer = optim.RMSprop(self.policy_net.parameters())
+
+    def tmp_Q_eps_greedy(
+        self, state: Tensor, candidates_embeddings: Tensor, item_embedding: Tensor
+    ) -> Optional[Tuple[int, int]]:
+        """Pick a candidate with an epsilon greedy policy over the Q network actions
+
+        The Q network has a fixed number of actions: action ``a`` recommends the ``a``-th candidate
+        closest to the current item by the inner product of their GCN embeddings. Only the actions
+        that map to a candidate are considered.
+
+        :param state: (Tensor) user state
+        :param candidates_embeddings: (Tensor) GCN embeddings of the candidates, shape (num_candidates, dim)
+        :param item_embedding: (Tensor) GCN embedding of the current item, shape (dim,)
+        :returns: (Optional[Tuple[int, int]]) Q network action and position of its candidate, None without candidates
+        """
+        if not len(candidates_embeddings):
+            return None
+        with torch.no_grad():
+            q_values = self.policy_net(torch.as_tensor(state, dtype=torch.float))
+            num_actions = min(q_values.shape[-1], len(candidates_embeddings))
+            ranked = torch.topk(candidates_embeddings @ item_embedding, num_actions).indices
+        if random.random() < self.config.epsilon:
+            action = random.randrange(num_actions)
         else:
-            return actions[np.argmax(out)]
-
-    def memory_sampling(self, memory: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
-        mini_batch = random.sample(memory, self.BATCH_SIZE)
-        s_lst, a_lst, r_lst, s_prime_lst, done_mask_lst = [], [], [], [], []
-
-        for transition in mini_batch:
-            t_state, t_action, t_reward, t_next_state, t_done = transition
-            s_lst.append(t_state)
-            a_lst.append([t_action])
-            r_lst.append([t_reward])
-            s_prime_lst.append(t_next_state)
-            done_mask_lst.append([t_done])
-        return (
-            torch.tensor(s_lst, dtype=torch.float),
-            torch.tensor(a_lst),
-            torch.tensor(r_lst),
-            torch.tensor(s_prime_lst, dtype=torch.float),
-            torch.tensor(done_mask_lst),
-        )
+            action = int(q_values[..., :num_actions].argmax())
+        return action, int(ranked[action])
+
+    def memory_sampling(self, memory: ReplayBuffer) -> Tuple[Transitions, Optional[Tensor], Optional[Tensor]]:
+        """Sample a batch of transitions, with their rows and importance sampling weights if prioritized
 
-    def optimize_model(self, memory: Tensor):
-        GAMMA = 0.1
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.memory_sampling(memory)
+        :param memory: (ReplayBuffer) buffer to sample from
+        :returns: (Tuple[Transitions, Optional[Tensor], Optional[Tensor]]) transitions, rows and weights,
+            rows and weights are None for uniform sampling
+        """
+        if isinstance(memory, PrioritizedReplayBuffer):
+            return memory.sample_prioritized(self.BATCH_SIZE)
+        return memory.sample(self.BATCH_SIZE), None, None
+
+    def optimize_model(self, memory: ReplayBuffer) -> float:
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), rows, weights = self.memory_sampling(
+            memory
+        )
         state_action_values = self.policy_net(state_batch)
-        next_state_values = self.target_net(next_state_batch)
-        max_val_list = []
-        for next_state_value in next_state_values:
-            max_val = max(next_state_value).tolist()
-            max_val_list.append(max_val)
-        expected_state_action_values = state_action_values.tolist()
-        for i in range(len(state_action_values)):
-            action = action_batch[i]
-            expected_state_action_values[i][action] = (max_val_list[i] * GAMMA) + reward_batch[i]
-        expected_state_action_values = torch.tensor(expected_state_action_values)
-        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values)
-        # print('loss', loss)
-        optimizer = optim.RMSprop(self.policy_net.parameters())
-        optimizer.zero_grad()
+        with torch.no_grad():
+            next_state_values = self.target_net(next_state_batch).max(dim=1).values
+            targets = reward_batch + self.config.discount * next_state_values * (~done_batch)
+        # Only the taken action differs from the prediction, the other entries give zero loss
+        expected_state_action_values = state_action_values.detach().scatter(
+            1, action_batch.unsqueeze(1), targets.unsqueeze(1)
+        )
+        sample_loss = F.smooth_l1_loss(state_action_values, expected_state_action_values, reduction="none").mean(dim=1)
+        loss = sample_loss.mean() if weights is None else (weights * sample_loss).mean()
+        if rows is not None:
+            td_errors = state_action_values.detach().gather(1, action_batch.unsqueeze(1)).squeeze(1) - targets
+            memory.update_priorities(rows, td_errors)
+        self.dqn_optimizer.zero_grad()
         loss.backward()
         for param in self.policy_net.parameters():
             param.grad.data.clamp_(-1, 1)
-        optimizer.step()
+        self.dqn_optimizer.step()
+        return loss.item()
+
+    def update_target(self, step: int) -> None:
+        """Move the target network towards the policy network
+
+        :param step: (int) number of steps taken so far
+        """
+        tau = self.config.target_soft_update
+        if tau > 0:
+            with torch.no_grad():
+                for target_param, param in zip(self.target_net.parameters(), self.policy_net.parameters()):
+                    target_param.lerp_(param, tau)
+        elif step % self.TARGET_UPDATE == 0:
+            self.target_net.load_state_dict(self.policy_net.state_dict())
+
+    def run_parallel(self, num_steps: int, mode: str = "train", seed: int = 0) -> List[float]:
+        """Actor/learner training: rollout processes fill the replay buffer, this process optimizes
+
+        ``config.num_rollout_workers`` actors each run :func:`redkg.rollout.rollout_worker` over
+        a shard of the users with a periodically synced copy of ``policy_net``, whose parameters
+        are moved to shared memory so the learner's updates reach them without copies.
+
+        :param num_steps: (int) number of learner optimization steps
+        :param mode: (str) split of the ratings to replay
+        :param seed: (int) base random seed of the actors
+        :returns: (List[float]) loss of every optimization step
+        """
+        self.policy_net.share_memory()
+        num_workers = self.config.num_rollout_workers
+        transitions = mp.Queue(maxsize=4 * num_workers)
+        stop_event = mp.Event()
+        workers = [
+            mp.Process(
+                target=rollout_worker,
+                args=(rank, num_workers, self.config, self.model, self.policy_net, transitions, stop_event, mode, seed),
+                daemon=True,
+            )
+            for rank in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        losses = []
+        try:
+            while len(losses) < num_steps:
+                try:
+                    batch = transitions.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        raise RuntimeError("All rollout workers exited")
+                    continue
+                self.memory.add_batch(*(torch.from_numpy(array) for array in batch))
+                if len(self.memory) > max(100, self.BATCH_SIZE):
+                    losses.append(self.optimize_model(self.memory))
+                    self.update_target(len(losses))
+        finally:
+            stop_event.set()
+            # Actors may be blocked on a full queue until it is drained
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    transitions.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for worker in workers:
+                worker.join()
+        return losses
 
     def run(self):
         simulator = Simulator(config=self.config, mode="train")
         num_users = len(simulator)
         total_step_count = 0
+        candidates = CandidateSet(num_items=self.model.n_hop_kg.num_entities)
         for e in range(self.config.epochs):
             for u in range(num_users):
                 user_id, item_ids, rates = simulator.get_user_data(u)
-                candidates = []
+                candidates.reset()
                 done = False
                 print("user_id:", user_id)
                 for t, (item_id, rate) in enumerate(zip(item_ids, rates)):
@@ -178,41 +270,48 @@ class TrainPipeline:
                     print("t", t, "item_id", item_id, "rate", rate)
                     # TODO
                     # Embed item using GCN Algorithm1 line 6 ~ 7
+                    # The propagated GCN table is cached until the model parameters are updated, lookups are
+                    # gathers. This loop does not update the model, an optimizer step on it must be followed by
+                    # self.model.refresh_gcn_cache()
                     item_idx = item_id
                     embedded_item_state = self.model.forward_gcn(item_idx)  # (50)
                     embedded_user_state = self.model(item_idx)  # (20)
 
                     # TODO
                     # Candidate selection and embedding
+                    # Consumed items are excluded, new 1-hop neighbours are merged into the set incrementally
+                    candidates.consume([item_id])
                     if rate > self.config.threshold:
-                        n_hop_dict = self.model.get_n_hop(item_id)
-                        candidates.extend(n_hop_dict[1])
-                        candidates = list(set(candidates))  # Need to get rid of recommended items
+                        candidates.add_neighbors(self.model.n_hop_kg, item_id)
 
-                    candidates_embeddings = self.model.forward_gcn(torch.tensor(candidates))
+                    candidates_embeddings = self.model.forward_gcn(candidates.active_tensor())
                     print("candidate shape:", candidates_embeddings.shape)
                     # candidates_embeddings = item_ids  # Embed each item in n_hop_dict using each item's n_hop_dict
                     # candidates_embeddings' shape = (# of candidates, config.item_embed_dim)
 
-                    # Recommendation using epsilon greedy policy
-                    recommend_item_id = self.tmp_Q_eps_greedy(state=embedded_user_state, actions=candidates_embeddings)
+                    # Recommendation using epsilon greedy policy, the session ends once no candidate is left
+                    choice = self.tmp_Q_eps_greedy(embedded_user_state, candidates_embeddings, embedded_item_state)
+                    if choice is None:
+                        break
+                    action, position = choice
+                    recommend_item_id = int(candidates.active_ids()[position])
                     reward = simulator.step(user_id, recommend_item_id)
+                    # A recommended item is never offered again in this session
+                    candidates.consume([recommend_item_id])
 
                     # TODO
                     # Q learning
                     # Store transition to buffer
                     state, action, reward, next_state, done = (
-                        embedded_state,
-                        recommend_item_id,
+                        embedded_user_state.detach(),
+                        action,
                         reward,
                         tmp_state_embed(x.append(recommend_item_id)),
                         done,
                     )
-                    Tuple = (state, action, reward, next_state, done)
-                    self.memory.append(Tuple)
+                    self.memory.add(state, action, reward, next_state, done)
                     # target update
                     total_step_count += 1
-                    if total_step_count % self.TARGET_UPDATE == 0:
-                        self.target_net.load_state_dict(self.policy_net.state_dict())
-                    if len(self.memory) > 100:
+                    self.update_target(total_step_count)
+                    if len(self.memory) > max(100, self.BATCH_SIZE):
                         self.optimize_model(self.memory)
@@ -0,0 +1,179 @@
+import json
+import os
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+META_FILE = "meta.json"
+
+
+class CategoricalColumn:
+    """Read-only string column stored as integer codes and a list of categories
+
+    :param codes: (NDArray) category code of every row
+    :param categories: (NDArray) category values
+    """
+
+    def __init__(self, codes: NDArray, categories: NDArray) -> None:
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, idx: Any) -> Any:
+        return self.categories[self.codes[idx]]
+
+    def __array__(self, dtype: Any = None, copy: Any = None) -> NDArray:
+        values = self.categories[self.codes]
+        return values if dtype is None else values.astype(dtype)
+
+
+class MappedColumn:
+    """Region of a .npy file holding one column, picklable and mapped again by :meth:`open`
+
+    :param filename: (str) path to the file
+    :param dtype: dtype of the array
+    :param shape: shape of the array
+    :param offset: (int) byte offset of the data in the file
+    :param mode: (str) memory map mode
+    :param fortran_order: (bool) whether the data is stored in Fortran order
+    """
+
+    def __init__(
+        self, filename: str, dtype: Any, shape: Tuple[int, ...], offset: int, mode: str, fortran_order: bool = False
+    ) -> None:
+        self.filename = filename
+        self.dtype = dtype
+        self.shape = shape
+        self.offset = offset
+        self.mode = mode
+        self.fortran_order = fortran_order
+
+    @classmethod
+    def from_npy(cls, filename: str, mode: str) -> "MappedColumn":
+        """Read the location of the array from the header of a .npy file
+
+        :param filename: (str) path to the file
+        :param mode: (str) memory map mode
+        :raises ValueError: if the file format version is not supported
+        :returns: (MappedColumn) column
+        """
+        with open(filename, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                raise ValueError(f"npy format version {version} not supported")
+            return cls(filename, dtype, shape, f.tell(), mode, fortran_order)
+
+    def open(self) -> "MappedArray":
+        """Map the file
+
+        :returns: (MappedArray) array with this column as its ``source``
+        """
+        array = MappedArray(
+            self.filename,
+            dtype=self.dtype,
+            mode=self.mode,
+            offset=self.offset,
+            shape=self.shape,
+            order="F" if self.fortran_order else "C",
+        )
+        array.source = self
+        return array
+
+
+class MappedArray(np.memmap):
+    """Memory map of a whole column opened by :func:`load_triples`
+
+    ``source`` is the :class:`MappedColumn` the array was opened from. Slices and other arrays
+    derived from it have no source, so only whole columns can be pickled as their files.
+    """
+
+    source: Optional[MappedColumn] = None
+
+    def __array_finalize__(self, obj: Any) -> None:
+        super().__array_finalize__(obj)
+        self.source = None
+
+
+def factorize(column: Union[CategoricalColumn, Any]) -> Tuple[NDArray, NDArray]:
+    """Encode a column as integer codes and unique values without copying a stored column
+
+    :param column: column to encode
+    :returns: (Tuple[NDArray, NDArray]) codes and unique values
+    """
+    if isinstance(column, CategoricalColumn):
+        return column.codes, column.categories
+    return pd.factorize(np.asarray(column))
+
+
+def _negative_matrix(column: Any) -> NDArray:
+    """Stack per-row negative candidate lists into a fixed-width int64 matrix"""
+    rows = [np.asarray(row, dtype=np.int64) for row in column]
+    widths = {len(row) for row in rows}
+    if len(widths) > 1:
+        raise ValueError(f"Negative candidate lists must have the same length, got lengths {sorted(widths)}")
+    return np.stack(rows) if rows else np.zeros((0, 0), dtype=np.int64)
+
+
+def save_triples(triples: Dict[str, Any], path: str) -> None:
+    """Save triples in the columnar binary format read by :func:`load_triples`
+
+    Every column becomes one .npy file in ``path``: integer and float columns as they are,
+    string columns (entity types) as int32 codes with their categories in ``meta.json``
+    and list columns (negative candidates, e.g. 'head_neg') as fixed-width 2D matrices.
+
+    :param triples: Dict or DataFrame with the 'head', 'relation' and 'tail' columns and optional extra columns
+    :param path: (str) directory to write
+    :raises ValueError: if the negative candidate lists of a column have different lengths
+    """
+    os.makedirs(path, exist_ok=True)
+    meta: Dict[str, Any] = {"num_triples": len(triples["head"]), "columns": {}}
+    for name in triples.keys():
+        column = triples[name]
+        first = next(iter(column), None)
+        if isinstance(first, (list, tuple, np.ndarray)):
+            values = _negative_matrix(column)
+            meta["columns"][name] = {"kind": "matrix"}
+        elif np.asarray(column).dtype.kind in "OUS":
+            codes, categories = pd.factorize(np.asarray(column))
+            values = codes.astype(np.int32)
+            meta["columns"][name] = {"kind": "categorical", "categories": categories.tolist()}
+        else:
+            values = np.asarray(column)
+            meta["columns"][name] = {"kind": "array"}
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+def load_triples(path: str, mmap_mode: Optional[str] = "c") -> Dict[str, Any]:
+    """Open triples saved by :func:`save_triples` without reading them
+
+    Columns are memory mapped, so opening takes constant time and rows are read from the
+    page cache on access. The default copy-on-write mode gives writable arrays that
+    ``torch.from_numpy`` wraps without copying; writes never reach the file. Mapped columns
+    are :class:`MappedArray` and record the file region they were opened from.
+
+    :param path: (str) directory with the triples
+    :param mmap_mode: memory map mode, None to read into memory
+    :returns: Dict with NumPy arrays and :class:`CategoricalColumn` for string columns
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+
+    triples: Dict[str, Any] = {}
+    for name, column in meta["columns"].items():
+        filename = os.path.join(path, f"{name}.npy")
+        values = np.load(filename) if mmap_mode is None else MappedColumn.from_npy(filename, mmap_mode).open()
+        if column["kind"] == "categorical":
+            triples[name] = CategoricalColumn(values, np.asarray(column["categories"], dtype=object))
+        else:
+            triples[name] = values
+    return triples
@@ -0,0 +1,294 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from redkg.triple_format import factorize
+
+# get_info has always started every (head, relation) and (relation, tail) count at 4
+COUNT_OFFSET = 4
+
+
+def global_entity_ids(
+    triples: Dict[str, Any], entity_dict: Optional[Dict[str, Any]] = None
+) -> Tuple[NDArray, NDArray, NDArray]:
+    """Get head, relation and tail columns as int64 arrays
+
+    With typed entities, heads and tails are shifted by the first id of their type in ``entity_dict``.
+
+    :param triples: Dict with 'head', 'relation', 'tail' and, for typed entities, 'head_type', 'tail_type' columns
+    :param entity_dict: mapping from entity type to its [first, last) id range
+    :returns: (Tuple[NDArray, NDArray, NDArray]) heads, relations, tails
+    """
+    head, relation, tail = (np.array(triples[column], dtype=np.int64) for column in ("head", "relation", "tail"))
+    if entity_dict:
+        for column, type_column in ((head, "head_type"), (tail, "tail_type")):
+            codes, uniques = factorize(triples[type_column])
+            column += np.array([entity_dict[t][0] for t in uniques], dtype=np.int64)[codes]
+    return head, relation, tail
+
+
+class CSRIndex:
+    """Sorted integer keys mapped to contiguous runs of values
+
+    :param keys: unique keys in ascending order
+    :param offsets: values of ``keys[i]`` are ``values[offsets[i]:offsets[i + 1]]``
+    :param values: values grouped by key
+    """
+
+    def __init__(self, keys: NDArray, offsets: NDArray, values: NDArray) -> None:
+        self.keys = keys
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def build(cls, keys: NDArray, values: NDArray) -> "CSRIndex":
+        """Group values by key
+
+        :param keys: (NDArray) key of every value
+        :param values: (NDArray) values
+        :returns: (CSRIndex) index
+        """
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        offsets = np.zeros(len(unique_keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(unique_keys, offsets, values[np.argsort(keys, kind="stable")])
+
+    def counts(self, keys: NDArray) -> NDArray:
+        """Number of values of every key, 0 for unknown keys"""
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[found] = self.offsets[position[found] + 1] - self.offsets[position[found]]
+        return counts
+
+    def get(self, key: int) -> NDArray:
+        """Values of one key as a view, empty for an unknown key"""
+        position = np.searchsorted(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return self.values[:0]
+        return self.values[self.offsets[position] : self.offsets[position + 1]]
+
+    def gather(self, keys: NDArray) -> Tuple[NDArray, NDArray]:
+        """Values of many keys at once
+
+        :param keys: (NDArray) keys to look up
+        :returns: (Tuple[NDArray, NDArray]) position of the key in ``keys`` and the value, one pair per value
+        """
+        if not len(self.keys):
+            return np.zeros(0, dtype=np.int64), self.values[:0]
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[position] == keys
+        starts = np.where(found, self.offsets[position], 0)
+        lengths = np.where(found, self.offsets[position + 1] - self.offsets[position], 0)
+        rows = np.repeat(np.arange(len(keys)), lengths)
+        shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return rows, self.values[np.arange(len(rows)) + shift]
+
+
+class TripleStore:
+    """Array-backed statistics of a set of triples
+
+    Replaces the ``count``, ``true_head`` and ``true_tail`` dicts: the triples are kept
+    as int64 columns and grouped into CSR indexes for (head, relation) -> tails and
+    (relation, tail) -> heads. The arrays are plain NumPy buffers, so DataLoader workers
+    forked from the main process share them. A store opened with :meth:`load` is memory
+    mapped and pickles as its path, so spawned workers map the same files as well.
+
+    :param head: (NDArray) heads of the triples
+    :param relation: (NDArray) relations of the triples
+    :param tail: (NDArray) tails of the triples
+    :param nentity: (int) number of entities
+    :param nrelation: (int) number of relations
+    """
+
+    _arrays = ("head", "relation", "tail")
+    _indexes = ("tail_index", "head_index")
+
+    def __init__(
+        self,
+        head: NDArray,
+        relation: NDArray,
+        tail: NDArray,
+        nentity: int,
+        nrelation: int,
+        tail_index: Optional[CSRIndex] = None,
+        head_index: Optional[CSRIndex] = None,
+    ) -> None:
+        self.head, self.relation, self.tail = head, relation, tail
+        self.nentity = nentity
+        self.nrelation = nrelation
+        value_dtype = np.int32 if nentity <= np.iinfo(np.int32).max else np.int64
+        if tail_index is None:
+            tail_index = CSRIndex.build(self._head_key(head, relation), tail.astype(value_dtype))
+        if head_index is None:
+            head_index = CSRIndex.build(self._tail_key(relation, tail), head.astype(value_dtype))
+        self.tail_index, self.head_index = tail_index, head_index
+        self.path: Optional[str] = None
+        self._mmap_mode: Optional[str] = None
+
+    @classmethod
+    def from_triples(
+        cls, triples: Dict[str, Any], nentity: int, nrelation: int, entity_dict: Optional[Dict[str, Any]] = None
+    ) -> "TripleStore":
+        """Build a store from a dict of columns
+
+        :param triples: Dict with 'head', 'relation', 'tail' (and 'head_type', 'tail_type' for typed entities)
+        :param nentity: (int) number of entities
+        :param nrelation: (int) number of relations
+        :param entity_dict: mapping from entity type to its [first, last) id range
+        :returns: (TripleStore) store
+        """
+        head, relation, tail = global_entity_ids(triples, entity_dict)
+        if len(head):
+            nentity = max(nentity, int(head.max()) + 1, int(tail.max()) + 1)
+            nrelation = max(nrelation, int(relation.max()) + 1)
+        return cls(head, relation, tail, nentity, nrelation)
+
+    def __len__(self) -> int:
+        return len(self.head)
+
+    def _head_key(self, head: NDArray, relation: NDArray) -> NDArray:
+        return np.asarray(head, dtype=np.int64) * self.nrelation + relation
+
+    def _tail_key(self, relation: NDArray, tail: NDArray) -> NDArray:
+        return np.asarray(relation, dtype=np.int64) * self.nentity + tail
+
+    def subsampling_weight(self, head: NDArray, relation: NDArray, tail: NDArray) -> NDArray:
+        """Subsampling weights of triples from the (head, relation) and (relation, tail) frequencies
+
+        :param head: (NDArray) heads
+        :param relation: (NDArray) relations
+        :param tail: (NDArray) tails
+        :returns: (NDArray) float32 weights
+        """
+        count = (
+            2 * COUNT_OFFSET
+            + self.tail_index.counts(self._head_key(head, relation))
+            + self.head_index.counts(self._tail_key(relation, tail))
+        )
+        return np.sqrt(1 / count).astype(np.float32)
+
+    def true_tails(self, head: int, relation: int) -> NDArray:
+        """Known tails of (head, relation)"""
+        return self.tail_index.get(int(self._head_key(np.int64(head), np.int64(relation))))
+
+    def true_heads(self, relation: int, tail: int) -> NDArray:
+        """Known heads of (relation, tail)"""
+        return self.head_index.get(int(self._tail_key(np.int64(relation), np.int64(tail))))
+
+    def filter_index(self, anchor: NDArray, relation: NDArray, mode: str) -> Tuple[NDArray, NDArray]:
+        """Known entities of a batch of queries as (row, entity) pairs
+
+        :param anchor: (NDArray) tails in the 'head-batch' mode, heads in the 'tail-batch' mode
+        :param relation: (NDArray) relations
+        :param mode: (str) 'head-batch' or 'tail-batch'
+        :returns: (Tuple[NDArray, NDArray]) query rows and entity ids
+        """
+        if mode == "head-batch":
+            return self.head_index.gather(self._tail_key(relation, anchor))
+        return self.tail_index.gather(self._head_key(anchor, relation))
+
+    def save(self, path: str) -> None:
+        """Save the store as a directory of .npy files
+
+        :param path: (str) directory to write
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self._arrays:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        for name in self._indexes:
+            index = getattr(self, name)
+            for part in ("keys", "offsets", "values"):
+                np.save(os.path.join(path, f"{name}_{part}.npy"), getattr(index, part))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"nentity": self.nentity, "nrelation": self.nrelation}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "TripleStore":
+        """Open a store saved by :meth:`save`
+
+        :param path: (str) directory with the store
+        :param mmap_mode: memory map mode passed to ``np.load``, None to read into memory
+        :returns: (TripleStore) store
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        def _load(name: str) -> NDArray:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        def _load_index(name: str) -> CSRIndex:
+            return CSRIndex(_load(f"{name}_keys"), _load(f"{name}_offsets"), _load(f"{name}_values"))
+
+        store = cls(
+            _load("head"),
+            _load("relation"),
+            _load("tail"),
+            meta["nentity"],
+            meta["nrelation"],
+            tail_index=_load_index("tail_index"),
+            head_index=_load_index("head_index"),
+        )
+        store.path, store._mmap_mode = path, mmap_mode
+        return store
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        if self.path is not None:
+            # Reopen the memory maps instead of copying the arrays into the pickle
+            return TripleStore.load, (self.path, self._mmap_mode)
+        return super().__reduce_ex__(protocol)
+
+
+class CountView:
+    """Read-only stand-in for the former ``count`` dict of ``get_info``
+
+    ``view[(head, relation)]`` and ``view[(tail, -relation - 1)]`` give the number of triples
+    with that (head, relation) or (relation, tail) pair plus ``COUNT_OFFSET``. With typed
+    entities the keys carry the local id and its type as a third element, as before.
+
+    :param store: (TripleStore) store in global entity ids
+    :param entity_dict: mapping from entity type to its [first, last) id range
+    """
+
+    def __init__(self, store: TripleStore, entity_dict: Optional[Dict[str, Any]] = None) -> None:
+        self.store = store
+        self.entity_dict = entity_dict or {}
+
+    def __getitem__(self, key: Tuple[Any, ...]) -> int:
+        entity, relation = int(key[0]), int(key[1])
+        if len(key) > 2:
+            entity += self.entity_dict[key[2]][0]
+        if relation >= 0:
+            index, keys = self.store.tail_index, self.store._head_key(np.array([entity]), np.array([relation]))
+        else:
+            index, keys = self.store.head_index, self.store._tail_key(np.array([-relation - 1]), np.array([entity]))
+        return COUNT_OFFSET + int(index.counts(keys)[0])
+
+
+class KnownEntitiesView:
+    """Read-only stand-in for the former ``true_head`` and ``true_tail`` dicts of ``get_info``
+
+    ``true_head[(relation, tail)]`` and ``true_tail[(head, relation)]`` give the known entities as
+    a list, empty for an unseen pair. Ids are those of the store, global for typed entities.
+
+    :param store: (TripleStore) store
+    :param mode: (str) 'head' for ``true_head``, 'tail' for ``true_tail``
+    """
+
+    def __init__(self, store: TripleStore, mode: str) -> None:
+        if mode not in ("head", "tail"):
+            raise ValueError(f"Not supported mode: {mode}")
+        self.store = store
+        self.mode = mode
+
+    def __getitem__(self, key: Tuple[int, int]) -> List[int]:
+        if self.mode == "head":
+            return self.store.true_heads(*key).tolist()
+        return self.store.true_tails(*key).tolist()
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return len(self[key]) > 0
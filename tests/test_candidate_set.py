@@ -0,0 +1,37 @@
+import numpy as np
+import scipy.sparse as sp
+
+from redkg.candidate_set import CandidateSet
+from redkg.n_hop_index import NHopIndex
+
+
+def test_candidate_set():
+    candidates = CandidateSet(num_items=20)
+
+    assert candidates.add([3, 5, 3, 7]) == 3
+    assert candidates.add(np.array([5, 9])) == 1
+    candidates.consume([5, 11])
+    # Consumed items are not added back
+    assert candidates.add([5, 11, 12]) == 1
+
+    assert candidates.active_ids().tolist() == [3, 7, 9, 12]
+    assert candidates.active_tensor().tolist() == [3, 7, 9, 12]
+    assert len(candidates) == 4 and 7 in candidates and 5 not in candidates
+
+    candidates.consume([3, 7, 9])
+    assert candidates.active_ids().tolist() == [12]
+    assert len(candidates) == 1
+
+    candidates.reset()
+    assert len(candidates) == 0 and not candidates.is_candidate.any() and not candidates.is_consumed.any()
+    assert candidates.add([5]) == 1
+
+
+def test_add_neighbors():
+    adj = sp.csr_matrix(np.eye(6, k=1) + np.eye(6, k=-1))
+    index = NHopIndex.build(adj, hops=2)
+    candidates = CandidateSet(num_items=6)
+    candidates.consume([2])
+
+    assert candidates.add_neighbors(index, 2, hops=(1, 2)) == 4
+    assert sorted(candidates.active_ids().tolist()) == [0, 1, 3, 4]
@@ -0,0 +1,102 @@
+import logging
+from collections import defaultdict
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from redkg.dataloader import TrainDataset, get_info
+from redkg.utils import AttributeDict
+from tests.utils import read_test_data
+
+train, test, valid = read_test_data()
+
+
+@pytest.fixture(autouse=True)
+def keep_global_rng():
+    """Negative sampling draws from the global RNG, which other test modules seed at import"""
+    with torch.random.fork_rng():
+        yield
+
+
+def test_train_batches():
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    dataset = TrainDataset(
+        triples=train,
+        nentity=20,
+        nrelation=2,
+        negative_sample_size=7,
+        mode="tail-batch",
+        count=info["triple_store"],
+        negative_mode="simple",
+    )
+    dataloader = DataLoader(dataset, batch_size=16, shuffle=False, collate_fn=TrainDataset.collate_fn)
+
+    positive_sample, negative_sample, subsampling_weight, mode = next(iter(dataloader))
+
+    assert mode == "tail-batch"
+    assert positive_sample.shape == (16, 3) and positive_sample.is_contiguous()
+    assert negative_sample.shape == (16, 7) and negative_sample.dtype == torch.long
+    assert ((negative_sample >= 0) & (negative_sample < 20)).all()
+    assert positive_sample.tolist() == train[["head", "relation", "tail"]].values[:16].tolist()
+
+    head, relation, tail = train["head"][0], train["relation"][0], train["tail"][0]
+    head_count = ((train["head"] == head) & (train["relation"] == relation)).sum()
+    tail_count = ((train["tail"] == tail) & (train["relation"] == relation)).sum()
+    expected = np.sqrt(1 / (4 + head_count + 4 + tail_count))
+    assert np.isclose(subsampling_weight[0].item(), expected)
+
+
+def test_train_batches_typed_negatives():
+    triples = {
+        "head": np.array([0, 1, 2, 0]),
+        "relation": np.array([0, 1, 0, 1]),
+        "tail": np.array([1, 0, 3, 2]),
+        "head_type": np.array(["drug", "drug", "protein", "protein"]),
+        "tail_type": np.array(["protein", "drug", "drug", "protein"]),
+    }
+    entity_dict = {"drug": (0, 3), "protein": (3, 7)}
+    for mode, types in [("head-batch", triples["head_type"]), ("tail-batch", triples["tail_type"])]:
+        dataset = TrainDataset(triples, 7, 2, 50, mode, count=defaultdict(lambda: 4), entity_dict=entity_dict)
+        positive_sample, negative_sample, subsampling_weight, _ = TrainDataset.collate_fn(
+            dataset.__getitems__([0, 1, 2, 3])
+        )
+
+        assert positive_sample[:, 0].tolist() == [0, 1, 5, 3]
+        assert positive_sample[:, 2].tolist() == [4, 0, 3, 5]
+        for row, entity_type in enumerate(types):
+            low, high = entity_dict[entity_type]
+            assert ((negative_sample[row] >= low) & (negative_sample[row] < high)).all()
+        assert torch.allclose(subsampling_weight, torch.full((4,), 1 / np.sqrt(8)))
+
+
+def test_train_datasets_share_weights():
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    head_dataset = TrainDataset(train, 20, 2, 7, "head-batch", count=info["triple_store"], negative_mode="simple")
+    tail_dataset = TrainDataset(
+        train,
+        20,
+        2,
+        7,
+        "tail-batch",
+        count=info["triple_store"],
+        negative_mode="simple",
+        subsampling_weight=head_dataset.subsampling_weight,
+    )
+
+    assert tail_dataset.subsampling_weight is head_dataset.subsampling_weight
+    assert np.array_equal(
+        head_dataset.subsampling_weight,
+        TrainDataset(train, 20, 2, 7, "tail-batch", count=info["triple_store"]).subsampling_weight,
+    )
+
+
+def test_full_negatives_without_types_warn(caplog):
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    with caplog.at_level(logging.WARNING):
+        dataset = TrainDataset(train, 20, 2, 7, "tail-batch", count=info["triple_store"], negative_mode="full")
+    assert "without entity_dict" in caplog.text
+
+    negatives = dataset.__getitems__(list(range(len(dataset))))[1]
+    assert negatives.min() >= 0 and negatives.max() < 20
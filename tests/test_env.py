@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from redkg.config import Config
+from redkg.env import Simulator, VectorSimulator
+from redkg.utils import pickle_dump
+
+
+def test_simulator(tmp_path):
+    rating_dict = {
+        7: [[30, 4.0, 100], [10, 2.5, 101], [30, 1.0, 102]],
+        3: [[5, 5.0, 100]],
+        9: [[12, 3.0, 100], [2, 4.5, 101]],
+    }
+    pickle_dump(str(tmp_path / "train_data_dict.pkl"), rating_dict)
+    config = Config()
+    config.preprocess_results_dir = str(tmp_path)
+
+    simulator = Simulator(config, mode="train")
+
+    assert len(simulator) == 3
+    user_id, item_ids, rates = simulator.get_user_data(3)
+    assert user_id == 7
+    assert item_ids.tolist() == [30, 10, 30] and rates.tolist() == [4.0, 2.5, 1.0]
+    assert np.shares_memory(item_ids, simulator.ratings.items)
+    for user_id, records in rating_dict.items():
+        for item_id in range(40):
+            expected = next((record[1] for record in records if record[0] == item_id), 0)
+            assert simulator.step(user_id, item_id) == expected
+
+
+def test_step_batch_and_vector_simulator(tmp_path):
+    rng = np.random.default_rng(0)
+    rating_dict = {
+        int(user_id): [[int(item), float(rng.integers(1, 6)), t] for t, item in enumerate(rng.integers(0, 30, length))]
+        for user_id, length in zip(rng.permutation(100)[:20], rng.integers(1, 8, 20))
+    }
+    pickle_dump(str(tmp_path / "train_data_dict.pkl"), rating_dict)
+    config = Config()
+    config.preprocess_results_dir = str(tmp_path)
+    simulator = Simulator(config, mode="train")
+
+    user_ids = rng.choice(list(rating_dict) + [1000], 500)
+    item_ids = rng.integers(-2, 35, 500)
+    expected = [simulator.step(u, i) if u in rating_dict else 0 for u, i in zip(user_ids.tolist(), item_ids.tolist())]
+    assert simulator.step_batch(user_ids, item_ids).tolist() == expected
+
+    env = VectorSimulator(simulator, num_envs=4)
+    assert env.reset().tolist() == list(rating_dict)[:4]
+    sessions = {slot: [] for slot in range(4)}
+    for _ in range(10):
+        users, items, rates = env.observe()
+        rewards, dones = env.step(items)
+        assert rewards.tolist() == [simulator.step(u, i) for u, i in zip(users.tolist(), items.tolist())]
+        for slot in range(4):
+            sessions[slot].append(items[slot])
+            if dones[slot]:
+                # A finished session has replayed the user's whole history
+                assert sessions[slot] == [record[0] for record in rating_dict[users[slot]]]
+                sessions[slot] = []
+
+
+def test_vector_simulator_skips_empty_histories(tmp_path):
+    rating_dict = {7: [[30, 4.0, 100], [10, 2.5, 101]], 3: [], 9: [[12, 3.0, 100]], 5: []}
+    pickle_dump(str(tmp_path / "train_data_dict.pkl"), rating_dict)
+    config = Config()
+    config.preprocess_results_dir = str(tmp_path)
+    simulator = Simulator(config, mode="train")
+
+    env = VectorSimulator(simulator, num_envs=3)
+    assert env.reset().tolist() == [7, 9, 7]
+    for _ in range(5):
+        users, items, _ = env.observe()
+        assert all(item in [record[0] for record in rating_dict[user]] for user, item in zip(users, items))
+        env.step(items)
+
+    with pytest.raises(ValueError):
+        VectorSimulator(simulator, num_envs=2, user_indices=np.flatnonzero(np.diff(simulator.ratings.offsets) == 0))
@@ -1,12 +1,16 @@
+import os
 import random
 import sys
 
 import numpy as np
+import pytest
 import torch
 
 from redkg.dataloader import get_info
-from redkg.evaluator import Evaluator
+from redkg.evaluator import Evaluator, RankAccumulator
+from redkg.models import kge
 from redkg.models.kge import KGEModel
+from redkg.utils import AttributeDict
 from tests.utils import read_test_data
 
 torch.manual_seed(0)
@@ -39,6 +43,89 @@ def test_evaluator():
     metrics = evaluator.eval(in_dict)
     assert round(sum(torch.cat(metrics).tolist()), 3) == 2.333
 
+    # The former staticmethod call still works and ranks ties optimistically
+    in_dict["y_pred_neg"] = torch.tensor([[0.1, 0.1, 0.05]])
+    with pytest.warns(DeprecationWarning):
+        metrics = Evaluator.eval(in_dict)
+    assert torch.equal(torch.cat(metrics), torch.cat(Evaluator(ties="optimistic").eval(in_dict)))
+    assert not torch.equal(torch.cat(metrics), torch.cat(evaluator.eval(in_dict)))
+
+
+def test_rank_ties():
+    generator = torch.Generator().manual_seed(0)
+    y_pred_pos = torch.randn(50, generator=generator)
+    y_pred_neg = torch.randn(50, 200, generator=generator)
+    # Reference: position of the positive after a full descending sort
+    argsort = torch.argsort(torch.cat([y_pred_pos.view(-1, 1), y_pred_neg], dim=1), dim=1, descending=True)
+    reference = torch.nonzero(argsort == 0, as_tuple=False)[:, 1] + 1
+    for ties in ("optimistic", "pessimistic", "realistic"):
+        assert torch.equal(Evaluator.rank(y_pred_pos, y_pred_neg, ties).long(), reference)
+
+    y_pred_neg = torch.tensor([[0.3, 0.5, 0.5, 0.1], [0.5, 0.5, 0.5, 0.5]])
+    y_pred_pos = torch.tensor([0.5, 0.5])
+    assert Evaluator.rank(y_pred_pos, y_pred_neg, "optimistic").tolist() == [1, 1]
+    assert Evaluator.rank(y_pred_pos, y_pred_neg, "pessimistic").tolist() == [3, 5]
+    assert Evaluator.rank(y_pred_pos, y_pred_neg, "realistic").tolist() == [2.0, 3.0]
+    with pytest.raises(ValueError):
+        Evaluator(ties="random")
+
+
+def test_rank_accumulator():
+    accumulator = RankAccumulator()
+    batches = [torch.tensor([1, 4, 2]), torch.tensor([12.5, 3.0]), torch.tensor([], dtype=torch.long)]
+    for ranking_list in batches:
+        accumulator.update(ranking_list)
+
+    expected = Evaluator.metrics_from_ranking(torch.cat([batch.float() for batch in batches]))
+    for metric, values in zip(accumulator.metrics, expected):
+        assert accumulator.result()[metric] == pytest.approx(values.mean().item())
+
+
+def test_hits_at():
+    ranking_list = torch.tensor([1, 4, 2, 30, 7])
+    mrr_list, *hits_lists = Evaluator.metrics_from_ranking(ranking_list, hits_at=(2, 5))
+
+    assert [hits.tolist() for hits in hits_lists] == [[1, 0, 1, 0, 0], [1, 1, 1, 0, 0]]
+    assert torch.allclose(mrr_list, 1.0 / ranking_list)
+    in_dict = {"y_pred_pos": torch.tensor([0.1]), "y_pred_neg": torch.tensor([[0.2, 0.3, 0.05]])}
+    assert [metric.item() for metric in Evaluator(hits_at=(2, 3)).eval(in_dict)] == pytest.approx([1 / 3, 0.0, 1.0])
+
+    accumulator = RankAccumulator(hits_at=(2, 5))
+    accumulator.update(ranking_list)
+    assert accumulator.result() == {
+        "mrr_list": pytest.approx(mrr_list.mean().item()),
+        "hits@2_list": pytest.approx(0.4),
+        "hits@5_list": pytest.approx(0.6),
+    }
+
+
+def test_rank_accumulator_groups():
+    generator = torch.Generator().manual_seed(0)
+    ranks = torch.randint(1, 30, (200,), generator=generator)
+    relations = torch.randint(0, 4, (200,), generator=generator)
+    modes = ["head-batch", "tail-batch"] * 100
+
+    # Two shards accumulated separately and merged equal one pass over everything
+    full, shards = RankAccumulator(hits_at=(1, 5, 20)), [RankAccumulator(hits_at=(1, 5, 20)) for _ in range(2)]
+    for start in range(0, 200, 20):
+        mode = modes[start // 20]
+        full.update(ranks[start : start + 20], relations[start : start + 20], mode)
+        shards[start // 20 % 2].update(ranks[start : start + 20], relations[start : start + 20], mode)
+    merged = shards[0].merge(shards[1])
+
+    assert merged.count == full.count == 200
+    assert merged.result() == pytest.approx(full.result())
+    assert set(full.result()) == {"mrr_list", "hits@1_list", "hits@5_list", "hits@20_list"}
+    by_relation = full.result(group_by="relation")
+    for relation in range(4):
+        relation_ranks = ranks[relations == relation].float()
+        assert by_relation[relation]["mrr_list"] == pytest.approx((1 / relation_ranks).mean().item())
+        assert by_relation[relation]["hits@5_list"] == pytest.approx((relation_ranks <= 5).float().mean().item())
+    assert set(full.result(group_by="mode")) == {"head-batch", "tail-batch"}
+    assert len(full.result(group_by="mode_relation")) == 8
+    with pytest.raises(ValueError):
+        full.merge(RankAccumulator())
+
 
 # score = model_func[self.model_name](head, relation, tail, mode)
 def test_model():
@@ -81,3 +168,163 @@ def test_model():
             3,
         )
     ) == 28.427
+
+
+def test_full_ranking():
+    evaluator = Evaluator()
+    kge_model = KGEModel(model_name="DistMult", nentity=20, nrelation=2, hidden_dim=4, gamma=12, evaluator=evaluator)
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    args = AttributeDict(test_batch_size=8, test_log_steps=100, cuda=False)
+
+    metrics = kge_model.test_step(kge_model, test, args, full_ranking=True, info=info, entity_block_size=6)
+
+    ranks = []
+    with torch.no_grad():
+        for head, relation, tail in zip(test["head"], test["relation"], test["tail"]):
+            positive = torch.tensor([[head, relation, tail]])
+            candidates = torch.arange(20).view(1, -1)
+            for mode, target, known in [
+                ("head-batch", head, info["triple_store"].true_heads(relation, tail)),
+                ("tail-batch", tail, info["triple_store"].true_tails(head, relation)),
+            ]:
+                score = kge_model((positive, candidates), mode=mode)[0]
+                positive_score = score[target].clone()
+                score[torch.from_numpy(known).long()] = float("-inf")
+                score[target] = float("-inf")
+                ranks.append(1 + (score > positive_score).sum().item())
+
+    ranks = torch.tensor(ranks, dtype=torch.float)
+    assert round(metrics["mrr_list"], 5) == round((1 / ranks).mean().item(), 5)
+    assert round(metrics["hits@10_list"], 5) == round((ranks <= 10).float().mean().item(), 5)
+
+
+def test_full_ranking_typed_entities():
+    generator = torch.Generator().manual_seed(0)
+
+    def typed_triples(num_triples):
+        return {
+            "head": torch.randint(5, (num_triples,), generator=generator).numpy(),
+            "relation": torch.randint(2, (num_triples,), generator=generator).numpy(),
+            "tail": torch.randint(5, (num_triples,), generator=generator).numpy(),
+            "head_type": np.array(["drug"] * num_triples),
+            "tail_type": np.array(["protein"] * num_triples),
+        }
+
+    train_typed, test_typed = typed_triples(30), typed_triples(10)
+    info = get_info(triples=train_typed, dataset=[{"num_nodes_dict": {"drug": 5, "protein": 5}}], do_count=True)
+    kge_model = KGEModel(model_name="DistMult", nentity=10, nrelation=2, hidden_dim=4, gamma=12, evaluator=Evaluator())
+    args = AttributeDict(test_batch_size=4, test_log_steps=100, cuda=False)
+
+    accumulator = RankAccumulator()
+    kge_model.test_step(kge_model, test_typed, args, full_ranking=True, info=info, accumulator=accumulator)
+
+    known = {(h, r, t + 5) for h, r, t in zip(train_typed["head"], train_typed["relation"], train_typed["tail"])}
+    reciprocal_ranks = []
+    with torch.no_grad():
+        for head, relation, tail in zip(test_typed["head"], test_typed["relation"], test_typed["tail"] + 5):
+            scores = kge_model((torch.tensor([[head, relation, tail]]), torch.arange(10).view(1, -1)), "tail-batch")[0]
+            candidates = [e for e in range(10) if e != tail and (head, relation, e) not in known]
+            greater = sum(scores[e] > scores[tail] for e in candidates)
+            equal = sum(scores[e] == scores[tail] for e in candidates)
+            reciprocal_ranks.append(1 / (1 + greater + equal / 2))
+    assert accumulator.result(group_by="mode")["tail-batch"]["mrr_list"] == pytest.approx(
+        float(np.mean(reciprocal_ranks))
+    )
+
+
+def test_step_sharded():
+    kge_model = KGEModel(model_name="DistMult", nentity=20, nrelation=2, hidden_dim=4, gamma=12, evaluator=Evaluator())
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    args = AttributeDict(test_batch_size=8, test_log_steps=100, cuda=False)
+
+    expected = RankAccumulator()
+    kge_model.test_step(kge_model, test, args, full_ranking=True, info=info, accumulator=expected)
+    sharded = RankAccumulator()
+    metrics = kge_model.test_step_sharded(
+        kge_model, test, args, num_workers=2, full_ranking=True, info=info, accumulator=sharded
+    )
+
+    assert sharded.count == expected.count
+    for name, value in expected.result().items():
+        assert metrics[name] == pytest.approx(value)
+    for name, value in expected.result(group_by="relation").items():
+        assert sharded.result(group_by="relation")[name] == pytest.approx(value)
+
+
+def test_step_sharded_sampled():
+    kge_model = KGEModel(model_name="DistMult", nentity=20, nrelation=2, hidden_dim=4, gamma=12, evaluator=Evaluator())
+    triples = test.rename(columns={"neg_head": "head_neg", "neg_tail": "tail_neg"})
+    args = AttributeDict(test_batch_size=8, test_log_steps=100, cuda=False, cpu_num=2, nentity=20, nrelation=2)
+
+    expected = kge_model.test_step(kge_model, triples, args)
+    metrics = kge_model.test_step_sharded(kge_model, triples, args, num_workers=2)
+
+    for name, value in expected.items():
+        assert metrics[name] == pytest.approx(value)
+
+
+def test_step_sharded_failures(monkeypatch):
+    kge_model = KGEModel(model_name="DistMult", nentity=20, nrelation=2, hidden_dim=4, gamma=12, evaluator=Evaluator())
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+    args = AttributeDict(test_batch_size=8, test_log_steps=100, cuda=True)
+
+    with pytest.raises(ValueError):
+        kge_model.test_step_sharded(kge_model, test, args, num_workers=2, full_ranking=True, info=info)
+
+    # A worker killed before sending its result does not block the evaluation
+    args.cuda = False
+    monkeypatch.setattr(kge, "_test_shard", lambda *args: os._exit(1))
+    with pytest.raises(RuntimeError):
+        kge_model.test_step_sharded(kge_model, test, args, num_workers=2, full_ranking=True, info=info, timeout=0.1)
+
+
+def test_train_step_sparse():
+    generator = torch.Generator().manual_seed(0)
+    models = [
+        KGEModel(
+            model_name="DistMult", nentity=20, nrelation=2, hidden_dim=4, gamma=12, evaluator=Evaluator(), sparse=s
+        )
+        for s in (False, True)
+    ]
+    models[1].load_state_dict(models[0].state_dict())
+    positive = torch.tensor([[0, 1, 2], [3, 0, 4]])
+    negative = torch.randint(5, 10, (2, 3), generator=generator)
+    args = AttributeDict(
+        cuda=False, negative_adversarial_sampling=False, uni_weight=True, regularization=0.0, learning_rate=0.1
+    )
+
+    # The second batch only reads rows 10 to 19, disjoint from the rows 0 to 9 of the first one
+    second_positive = positive + torch.tensor([10, 0, 10])
+    second_negative = negative + 10
+    optimizers = [model.make_optimizer(args.learning_rate) for model in models]
+    logs, after_first = [], []
+    for model, optimizer in zip(models, optimizers):
+        batch = iter([(positive, negative, torch.ones(2), "tail-batch")])
+        logs.append(model.train_step(model, optimizer, batch, args))
+        after_first.append(model.entity_embedding.detach().clone())
+
+    assert logs[0]["loss"] == pytest.approx(logs[1]["loss"])
+    assert models[1].entity_embedding.grad.is_sparse
+
+    for model, optimizer in zip(models, optimizers):
+        batch = iter([(second_positive, second_negative, torch.ones(2), "tail-batch")])
+        model.train_step(model, optimizer, batch, args)
+
+    first_rows = torch.unique(torch.cat([positive[:, 0], positive[:, 2], negative.reshape(-1)]))
+    second_rows = first_rows + 10
+    # Adam keeps moving the rows of the first batch with their moments, SparseAdam only updates the batch rows
+    assert not torch.equal(models[0].entity_embedding[first_rows], after_first[0][first_rows])
+    assert torch.equal(models[1].entity_embedding[first_rows], after_first[1][first_rows])
+    assert not torch.equal(models[1].entity_embedding[second_rows], after_first[1][second_rows])
+    untouched = torch.arange(10, 20)
+
+    args.regularization = 0.01
+    before = models[1].entity_embedding.detach().clone()
+    before_relation = models[1].relation_embedding.detach().clone()
+    batch = iter([(positive, negative, torch.ones(2), "tail-batch")])
+    log = models[1].train_step(models[1], models[1].make_optimizer(args.learning_rate), batch, args)
+
+    touched = torch.unique(torch.cat([positive[:, 0], positive[:, 2], negative.reshape(-1)]))
+    expected = args.regularization * (before[touched].norm(p=3) ** 3 + before_relation.norm(p=3) ** 3)
+    assert log["regularization"] == pytest.approx(expected.item(), rel=1e-3)
+    assert torch.equal(models[1].entity_embedding[untouched], before[untouched])
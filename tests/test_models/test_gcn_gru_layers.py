@@ -0,0 +1,50 @@
+import torch
+
+from tests.utils import gcn_gru_layer
+
+
+def test_gcn_table_cache(tmp_path):
+    layer = gcn_gru_layer(tmp_path)
+    optimizer = torch.optim.SGD(layer.parameters(), lr=0.1)
+
+    # Every lookup of a training step reads one propagation and backpropagates through it
+    table = layer.gcn_table()
+    assert table.requires_grad
+    assert layer.gcn_table() is table
+    (layer.forward_gcn(torch.tensor([2])).sum() + layer.forward_gcn(torch.tensor([1, 3])).sum()).backward()
+    assert all(param.grad is not None for param in layer.gc1.parameters())
+    optimizer.step()
+
+    # The table is kept until the training loop drops it after the optimizer step
+    assert layer.gcn_table() is table
+    layer.refresh_gcn_cache()
+    with torch.no_grad():
+        refreshed = layer.gcn_table()
+        assert not refreshed.requires_grad
+        assert torch.allclose(refreshed, layer._propagate())
+        assert torch.allclose(layer.forward_gcn(torch.tensor([1, 3])), refreshed[[1, 3]])
+    assert torch.equal(layer.precompute_gcn(), refreshed)
+    # A table cached without autograd is propagated again when gradients are needed
+    assert layer.gcn_table().requires_grad
+
+
+def test_sessions(tmp_path):
+    layer = gcn_gru_layer(tmp_path)
+    layer.gru = torch.nn.GRU(4, 3, 2)
+    histories = [torch.tensor([1, 2, 3]), torch.tensor([4]), torch.tensor([5, 0])]
+
+    with torch.no_grad():
+        layer.init_sessions(num_users=5)
+        users = torch.tensor([4, 0, 2])
+        encoded = layer.encode_histories(histories, users)
+
+        for row, history in enumerate(histories):
+            out, _ = layer.gru(layer.item_features(history).unsqueeze(1))
+            assert torch.allclose(encoded[row], out[-1, 0], atol=1e-6)
+        assert torch.allclose(layer.sessions[-1, users], encoded)
+        assert torch.equal(layer.sessions[:, [1, 3]], torch.zeros(2, 2, 3))
+
+        # Stepping the users one item further matches encoding the extended histories
+        stepped = layer.step_sessions(users, torch.tensor([0, 1, 2]))
+        extended = [torch.cat([history, torch.tensor([item])]) for history, item in zip(histories, [0, 1, 2])]
+        assert torch.allclose(stepped, layer.encode_histories(extended), atol=1e-6)
@@ -1,8 +1,8 @@
-import numpy as np
 import pytest
+import scipy.sparse as sp
 import torch
 
-from redkg.models.graph_convolution import GraphConvolution
+from redkg.models.graph_convolution import GraphConvolution, load_adjacency, normalize_adjacency, to_sparse_tensor
 
 
 @pytest.fixture
@@ -17,29 +17,42 @@ def mock_input():
     return torch.FloatTensor([[1, 2], [3, 4], [5, 6]])
 
 
-def test_initialization(mock_adj_matrix, monkeypatch):
-    """Test initialization of GraphConvolution"""
+@pytest.fixture
+def mock_adj_path(mock_adj_matrix, tmp_path):
+    """Mock adjacency matrix saved as .npz"""
+    path = str(tmp_path / "kg_adj_mat.npz")
+    sp.save_npz(path, sp.csr_matrix(mock_adj_matrix.numpy()))
+    return path
 
-    def mock_load(*args, **kwargs):
-        return mock_adj_matrix.numpy()
 
-    monkeypatch.setattr(np, "load", mock_load)
-    layer = GraphConvolution(2, 3)
+def test_initialization(mock_adj_path):
+    """Test initialization of GraphConvolution"""
+    layer = GraphConvolution(2, 3, adj_path=mock_adj_path)
 
     assert layer.in_features == 2
     assert layer.out_features == 3
     assert layer.adj.shape == (3, 3)
+    assert layer.adj.is_sparse
+    # The adjacency is loaded once and shared by all layers
+    assert GraphConvolution(3, 3, adj_path=mock_adj_path).adj is layer.adj
 
 
-def test_forward(mock_adj_matrix, mock_input, monkeypatch):
+def test_forward(mock_adj_matrix, mock_input):
     """Test forward pass"""
-
-    def mock_load(*args, **kwargs):
-        return mock_adj_matrix.numpy()
-
-    monkeypatch.setattr(np, "load", mock_load)
-    layer = GraphConvolution(2, 3)
+    adj = to_sparse_tensor(normalize_adjacency(sp.csr_matrix(mock_adj_matrix.numpy())))
+    layer = GraphConvolution(2, 3, adj=adj)
 
     output = layer(mock_input)
     assert output.shape == (3, 3)
     assert isinstance(output, torch.FloatTensor)
+    assert torch.allclose(output, adj.to_dense() @ layer.weight(mock_input))
+
+
+def test_normalize_adjacency(mock_adj_matrix, mock_adj_path):
+    """Test renormalization with self loops"""
+    adj = mock_adj_matrix + torch.eye(3)
+    inv_sqrt_degree = adj.sum(dim=1).pow(-0.5)
+    expected = inv_sqrt_degree.unsqueeze(1) * adj * inv_sqrt_degree.unsqueeze(0)
+
+    assert torch.allclose(load_adjacency(mock_adj_path).to_dense(), expected)
+    assert torch.equal(load_adjacency(mock_adj_path, normalize=False).to_dense(), mock_adj_matrix)
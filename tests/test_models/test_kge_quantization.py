@@ -0,0 +1,91 @@
+import pytest
+import torch
+
+from redkg.dataloader import get_info
+from redkg.models.kge_quantization import QuantizedTable
+from redkg.utils import AttributeDict
+from tests.utils import kge_model
+
+NENTITY, NRELATION = 200, 5
+
+
+def _triples(num_triples, generator):
+    return {
+        "head": torch.randint(NENTITY, (num_triples,), generator=generator).numpy(),
+        "relation": torch.randint(NRELATION, (num_triples,), generator=generator).numpy(),
+        "tail": torch.randint(NENTITY, (num_triples,), generator=generator).numpy(),
+    }
+
+
+@pytest.mark.parametrize("dtype, atol", [("float16", 1e-2), ("bfloat16", 5e-2), ("int8", 5e-2)])
+def test_quantize_round_trip(dtype, atol):
+    table = torch.randn(50, 8, generator=torch.Generator().manual_seed(0))
+    table[3] = 0
+
+    quantized = QuantizedTable.quantize(table, dtype)
+
+    assert quantized.dtype == dtype
+    assert quantized.nbytes < table.numel() * table.element_size()
+    assert quantized[4:9].dtype == torch.float32
+    assert torch.equal(quantized[torch.tensor([[1, 2]])], quantized.dequantize()[torch.tensor([[1, 2]])])
+    assert torch.allclose(quantized.dequantize(), table, atol=atol * table.abs().max().item())
+    assert torch.equal(quantized[3], torch.zeros(8))
+
+
+def test_quantize_unknown_dtype():
+    with pytest.raises(ValueError):
+        QuantizedTable.quantize(torch.zeros(2, 2), "int4")
+
+
+def test_save_load(tmp_path):
+    quantized = QuantizedTable.quantize(torch.randn(10, 4, generator=torch.Generator().manual_seed(0)))
+    quantized.save(str(tmp_path / "entities.pt"))
+
+    loaded = QuantizedTable.load(str(tmp_path / "entities.pt"))
+
+    assert torch.equal(loaded.data, quantized.data)
+    assert torch.equal(loaded.scale, quantized.scale)
+
+
+@pytest.mark.parametrize("model_name", ["TransE", "DistMult", "ComplEx", "RotatE"])
+@pytest.mark.parametrize("dtype, tolerance", [("float16", 0.01), ("bfloat16", 0.05), ("int8", 0.05)])
+def test_quantized_mrr_matches_fp32(model_name, dtype, tolerance):
+    generator = torch.Generator().manual_seed(0)
+    model = kge_model(model_name, nentity=NENTITY, nrelation=NRELATION, hidden_dim=16)
+    with torch.no_grad():
+        model.entity_embedding.copy_(torch.randn(model.entity_embedding.shape, generator=generator))
+        model.relation_embedding.copy_(torch.randn(model.relation_embedding.shape, generator=generator))
+    train, test = _triples(400, generator), _triples(100, generator)
+    info = get_info(triples=train, dataset=AttributeDict(nentity=NENTITY, nrelation=NRELATION))
+    args = AttributeDict(test_batch_size=32, test_log_steps=100, cuda=False)
+
+    expected = model.test_step(model, test, args, full_ranking=True, info=info, entity_block_size=64)
+    model.quantize_entities(dtype)
+    metrics = model.test_step(model, test, args, full_ranking=True, info=info, entity_block_size=64)
+    model.quantize_entities(None)
+
+    assert abs(metrics["mrr_list"] - expected["mrr_list"]) <= tolerance * expected["mrr_list"]
+    assert model.test_step(model, test, args, full_ranking=True, info=info, entity_block_size=64) == expected
+
+
+def test_load_entities(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    model = kge_model("DistMult", nentity=NENTITY, nrelation=NRELATION, hidden_dim=16)
+    train, test = _triples(400, generator), _triples(100, generator)
+    info = get_info(triples=train, dataset=AttributeDict(nentity=NENTITY, nrelation=NRELATION))
+    args = AttributeDict(test_batch_size=32, test_log_steps=100, cuda=False)
+    model.quantize_entities("int8").save(str(tmp_path / "entities.pt"))
+    expected = model.test_step(model, test, args, full_ranking=True, info=info)
+
+    served = kge_model("DistMult", nentity=NENTITY, nrelation=NRELATION, hidden_dim=16)
+    served.relation_embedding.data.copy_(model.relation_embedding)
+    served.load_entities(QuantizedTable.load(str(tmp_path / "entities.pt")))
+
+    # Only the int8 table is kept
+    assert "entity_embedding" not in served.state_dict()
+    assert all(param.dtype == torch.float32 and param.numel() < NENTITY for param in served.parameters())
+    assert served.test_step(served, test, args, full_ranking=True, info=info) == expected
+    with pytest.raises(RuntimeError):
+        served(torch.tensor([[0, 0, 1]]))
+    with pytest.raises(ValueError):
+        served.load_entities(QuantizedTable.quantize(torch.zeros(NENTITY, 8)))
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+
+from redkg.models.kge_retrieval import FaissIndex, IVFPQIndex, KGERetriever
+from tests.utils import kge_model
+
+
+def _full_scores(model, head, relation):
+    candidates = torch.arange(model.nentity).expand(len(head), -1)
+    positive = torch.stack([head, relation, torch.zeros_like(head)], dim=1)
+    with torch.no_grad():
+        return model((positive, candidates), mode="tail-batch")
+
+
+@pytest.mark.parametrize("model_name", ["TransE", "DistMult", "ComplEx", "RotatE"])
+def test_exact_retrieval(model_name):
+    torch.manual_seed(0)
+    model = kge_model(model_name, nentity=300)
+    head, relation = torch.randint(300, (5,)), torch.randint(4, (5,))
+
+    scores, ids = KGERetriever(model, backend="exact", block_size=64).top_k(head, relation, k=10)
+
+    expected_scores, expected_ids = _full_scores(model, head, relation).topk(10, dim=1)
+    assert torch.equal(ids, expected_ids)
+    assert torch.allclose(scores, expected_scores, atol=1e-4)
+
+
+def test_quantized_retrieval():
+    torch.manual_seed(0)
+    model = kge_model("DistMult", nentity=300)
+    head, relation = torch.randint(300, (5,)), torch.randint(4, (5,))
+    table = model.quantize_entities("int8")
+    with torch.no_grad():
+        model.entity_embedding.copy_(table.dequantize())
+    expected_scores, expected_ids = _full_scores(model, head, relation).topk(10, dim=1)
+
+    model.load_entities(table)
+    retriever = KGERetriever(model, backend="exact", block_size=64)
+    scores, ids = retriever.top_k(head, relation, k=10)
+
+    assert retriever.index.vectors.data is table.data
+    assert torch.equal(ids, expected_ids)
+    assert torch.allclose(scores, expected_scores, atol=1e-4)
+
+
+@pytest.mark.parametrize("model_name", ["TransE", "DistMult", "RotatE"])
+def test_ivfpq_retrieval(model_name):
+    torch.manual_seed(0)
+    model = kge_model(model_name, nentity=300)
+    head, relation = torch.randint(300, (20,)), torch.randint(4, (20,))
+    expected_ids = _full_scores(model, head, relation).topk(10, dim=1).indices
+
+    approximate = KGERetriever(model, backend="ivfpq", num_lists=8, num_subspaces=4, num_bits=6, nprobe=4)
+    _, ids = approximate.top_k(head, relation, k=10)
+    recall = np.mean([len(set(a) & set(b)) / 10 for a, b in zip(ids.tolist(), expected_ids.tolist())])
+    assert recall > 0.5
+
+    # Scanning every list and re-scoring enough candidates exactly recovers the exact result
+    refined = KGERetriever(model, backend="ivfpq", num_lists=8, num_subspaces=4, nprobe=8, refine=30)
+    scores, ids = refined.top_k(head, relation, k=10)
+    assert torch.equal(ids, expected_ids)
+    assert torch.allclose(scores, _full_scores(model, head, relation).topk(10, dim=1).values, atol=1e-4)
+
+
+def test_ivfpq_checks_subspaces():
+    with pytest.raises(ValueError):
+        IVFPQIndex("ip", num_subspaces=3).add(np.zeros((10, 8), dtype=np.float32))
+
+
+def test_faiss_retrieval():
+    pytest.importorskip("faiss")
+    torch.manual_seed(0)
+    model = kge_model("DistMult", nentity=300)
+    head, relation = torch.randint(300, (5,)), torch.randint(4, (5,))
+
+    _, ids = KGERetriever(model, backend="faiss").top_k(head, relation, k=10)
+
+    assert torch.equal(ids, _full_scores(model, head, relation).topk(10, dim=1).indices)
+
+
+def test_faiss_l1_needs_flat_encoding():
+    with pytest.raises(ValueError):
+        FaissIndex("l1", factory="IVF16,PQ4")
+    with pytest.raises(ValueError):
+        FaissIndex("complex_l2")
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from redkg.evaluator import Evaluator
+from redkg.models.kge_scoring import rank_against_table
+from tests.utils import kge_model
+
+
+def _broadcast_score(model, positive, negative, mode):
+    """Reference score built the old way: broadcast to (batch, negatives, dim) and reduce"""
+    batch_size, negative_sample_size = negative.shape
+    entities = model.entity_embedding[negative.view(-1)].view(batch_size, negative_sample_size, -1)
+    relation = model.relation_embedding[positive[:, 1]].unsqueeze(1)
+    if mode == "head-batch":
+        head, tail = entities, model.entity_embedding[positive[:, 2]].unsqueeze(1)
+    else:
+        head, tail = model.entity_embedding[positive[:, 0]].unsqueeze(1), entities
+    return getattr(model, model.model_name)(head, relation, tail, mode)
+
+
+@pytest.mark.parametrize("model_name", ["TransE", "DistMult", "ComplEx", "RotatE"])
+@pytest.mark.parametrize("mode", ["head-batch", "tail-batch"])
+@pytest.mark.parametrize("score_chunk_size", [None, 3, 7])
+def test_blocked_scores_match_broadcast(model_name, mode, score_chunk_size):
+    torch.manual_seed(0)
+    model = kge_model(model_name, score_chunk_size=score_chunk_size)
+    positive = torch.stack([torch.randint(0, 30, (5,)), torch.randint(0, 4, (5,)), torch.randint(0, 30, (5,))], dim=1)
+    negative = torch.randint(0, 30, (5, 16))
+
+    score = model((positive, negative), mode=mode)
+
+    assert score.shape == (5, 16)
+    assert torch.allclose(score, _broadcast_score(model, positive, negative, mode), atol=1e-4)
+
+
+def test_blocked_scores_backward():
+    model = kge_model("DistMult", score_chunk_size=4)
+    positive = torch.tensor([[0, 1, 2], [3, 0, 4]])
+    negative = torch.randint(0, 30, (2, 10))
+
+    model((positive, negative), mode="tail-batch").sum().backward()
+
+    assert model.entity_embedding.grad is not None
+    assert model.relation_embedding.grad is not None
+
+
+def test_rank_against_table_default_ties():
+    query = torch.tensor([[1.0, 0.0]])
+    table = torch.tensor([[1.0, 0.0], [1.0, 5.0], [2.0, 0.0], [0.0, 1.0]])
+    positive_score = torch.tensor([1.0])
+
+    ranks = rank_against_table("DistMult", query, positive_score, table, gamma=0.0, block_size=2)
+
+    # Rows 0 and 1 tie with the positive, row 2 beats it
+    assert torch.equal(ranks, Evaluator.rank(positive_score, query @ table.t()))
+    assert ranks.item() == 3.0
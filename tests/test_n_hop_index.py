@@ -0,0 +1,41 @@
+import numpy as np
+import scipy.sparse as sp
+
+from redkg.n_hop_index import NHopIndex
+
+
+def _bfs_distances(edges, num_entities, source):
+    distances = {source: 0}
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for entity in frontier:
+            for head, tail in edges:
+                for a, b in ((head, tail), (tail, head)):
+                    if a == entity and b not in distances:
+                        distances[b] = distances[entity] + 1
+                        next_frontier.append(b)
+        frontier = next_frontier
+    return distances
+
+
+def test_n_hop_index(tmp_path):
+    rng = np.random.default_rng(0)
+    num_entities = 30
+    edges = {tuple(edge) for edge in rng.integers(0, num_entities, (40, 2)).tolist() if edge[0] != edge[1]}
+    heads, tails = np.array(sorted(edges)).T
+    adjacency = sp.coo_matrix(
+        (np.ones(2 * len(heads)), (np.r_[heads, tails], np.r_[tails, heads])), shape=(num_entities, num_entities)
+    ).tocsr()
+
+    index = NHopIndex.build(adjacency, hops=3, row_block=7)
+    index.save(str(tmp_path / "n_hop"))
+    loaded = NHopIndex.load(str(tmp_path / "n_hop"))
+
+    assert loaded.hops == 3 and loaded.num_entities == num_entities
+    assert isinstance(loaded.neighbors[0], np.memmap)
+    for entity in range(num_entities):
+        distances = _bfs_distances(edges, num_entities, entity)
+        for hop, neighbors in loaded.get(entity).items():
+            assert neighbors.tolist() == sorted(e for e, d in distances.items() if d == hop)
+    assert loaded.neighbors_of(num_entities, 1).tolist() == []
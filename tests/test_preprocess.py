@@ -0,0 +1,184 @@
+import random
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from redkg.config import Config
+from redkg.preprocess import DataPreprocessor
+
+
+def test_most_frequent_entities():
+    entities = np.array([5, 3, 3, 7, 5, 9, 1, 1, 3, 8])
+
+    selected = DataPreprocessor._most_frequent_entities(entities, exclude={9: 0}, k=3)
+
+    # 3 occurs three times; 5 and 1 tie with two occurrences and 5 comes first
+    assert selected.tolist() == [3, 5, 1]
+    assert DataPreprocessor._most_frequent_entities(entities, exclude={}, k=0).tolist() == []
+    assert len(DataPreprocessor._most_frequent_entities(entities, exclude={}, k=100)) == 6
+
+
+def test_read_kg(tmp_path):
+    random.seed(1)
+    kg_path = tmp_path / "kg.txt"
+    with open(kg_path, "w") as f:
+        for _ in range(300):
+            f.write(f"{random.randint(0, 60)}\tr{random.randint(0, 3)}\t{random.randint(0, 90)}\n")
+    config = Config()
+    config.kg_path = str(kg_path)
+    config.entity_vocab_size = 40
+    entity_vocab = {i: i for i in range(10)}
+    relation_vocab = {}
+
+    n_hop_kg, adj_mat = DataPreprocessor(config)._read_kg(entity_vocab, relation_vocab, {}, {})
+
+    assert len(entity_vocab) == 40
+    assert set(relation_vocab) == {"r0", "r1", "r2", "r3"}
+    kg = defaultdict(set)
+    with open(kg_path) as f:
+        for line in f:
+            head, _, tail = line.strip().split("\t")
+            if int(head) in entity_vocab and int(tail) in entity_vocab:
+                kg[entity_vocab[int(head)]].add(entity_vocab[int(tail)])
+                kg[entity_vocab[int(tail)]].add(entity_vocab[int(head)])
+    for entity in entity_vocab.values():
+        two_hop = set().union(*(kg[t] for t in kg[entity])) - kg[entity] - {entity}
+        assert n_hop_kg.get(entity)[1].tolist() == sorted(kg[entity])
+        assert n_hop_kg.get(entity)[2].tolist() == sorted(two_hop)
+    # Vocab id i sits at row/column i - 1, as in the former dense matrix
+    expected = np.zeros((39, 39))
+    for head, tails in kg.items():
+        for tail in tails:
+            expected[head - 1][tail - 1] = 1
+    assert np.array_equal(adj_mat.toarray(), expected)
+
+
+def test_read_attribute_file():
+    rng = np.random.default_rng(0)
+    ratings = pd.DataFrame(
+        {
+            "userId": rng.integers(0, 30, 2000),
+            "movieId": rng.integers(0, 60, 2000),
+            "rating": rng.integers(1, 6, 2000).astype(float),
+            "timestamp": rng.integers(0, 10**6, 2000),
+        }
+    )
+    config = Config()
+    config.minimum_interactions = 60
+    item_vocab = {item: i for i, item in enumerate(range(10, 70))}
+    entity_vocab = {100 + item: i for i, item in enumerate(range(10, 70))}
+    user_vocab = {}
+
+    train, valid, test = DataPreprocessor(config)._read_attribute_file(ratings, user_vocab, item_vocab, entity_vocab)
+
+    in_kg = ratings[ratings["movieId"] >= 10]
+    sizes = in_kg.groupby("userId").size()
+    remained = sorted(sizes[sizes >= 60].index)
+    assert list(user_vocab) == remained and list(user_vocab.values()) == list(range(len(remained)))
+    assert len(train) == int(len(remained) * 0.8)
+    assert len(train) + len(valid) + len(test) == len(remained)
+
+    for user, user_id in user_vocab.items():
+        records = {**train, **valid, **test}[user_id]
+        expected = in_kg[in_kg["userId"] == user].sort_values("timestamp", kind="stable")
+        assert [r[0] for r in records] == [item_vocab[m] for m in expected["movieId"]]
+        assert [r[2] for r in records] == expected["timestamp"].tolist()
+
+    watched = set(in_kg[in_kg["userId"].isin(remained)]["movieId"])
+    assert set(item_vocab) == watched
+    assert set(entity_vocab) == {100 + item for item in watched}
+
+
+def test_user_split_seed():
+    rng = np.random.default_rng(0)
+    ratings = pd.DataFrame(
+        {
+            "userId": np.repeat(np.arange(40), 5),
+            "movieId": rng.integers(0, 10, 200),
+            "rating": np.ones(200),
+            "timestamp": np.arange(200),
+        }
+    )
+    config = Config()
+    config.minimum_interactions = 1
+
+    def split(seed):
+        config.split_seed = seed
+        dicts = DataPreprocessor(config)._read_attribute_file(ratings, {}, {i: i for i in range(10)}, {})
+        return [sorted(d) for d in dicts]
+
+    first = split(3)
+    # The global RNG does not take part in the split
+    np.random.seed(0)
+    assert split(3) == first
+    assert split(4) != first
+
+
+def test_read_table_in_chunks(tmp_path):
+    path = tmp_path / "ratings.csv"
+    rng = np.random.default_rng(0)
+    expected = pd.DataFrame({"user": rng.integers(0, 50, 500), "item": rng.integers(0, 80, 500)})
+    expected.to_csv(path, index=False)
+    config = Config()
+    config.num_workers = 2
+    config.chunk_size = 256
+
+    table = DataPreprocessor(config)._read_table(str(path), header=True, sep=",")
+
+    pd.testing.assert_frame_equal(table, expected)
+
+
+def test_process_data_stage_cache(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    (raw / "item2entity.txt").write_text("".join(f"{item}\t{100 + item}\n" for item in range(10)))
+    pd.DataFrame(
+        {
+            "user": np.repeat(np.arange(10), 6),
+            "item": rng.integers(0, 10, 60),
+            "rating": rng.integers(1, 6, 60),
+            "timestamp": np.arange(60),
+        }
+    ).to_csv(raw / "attributes.csv", index=False)
+
+    def write_kg(num_triples):
+        lines = (
+            f"{rng.integers(100, 130)}\tr{rng.integers(0, 3)}\t{rng.integers(100, 130)}\n" for _ in range(num_triples)
+        )
+        (raw / "kg.txt").write_text("".join(lines))
+
+    write_kg(100)
+    config = Config()
+    config.preprocess_results_dir = str(tmp_path / "results")
+    config.item2entity_path, config.attribute_path, config.kg_path = (
+        str(raw / name) for name in ("item2entity.txt", "attributes.csv", "kg.txt")
+    )
+    config.minimum_interactions, config.entity_vocab_size = 1, 20
+
+    calls = []
+    for stage, method in (("attribute", "_read_attribute_file"), ("kg", "_read_kg")):
+        original = getattr(DataPreprocessor, method)
+
+        def counted(self, *args, stage=stage, original=original):
+            calls.append(stage)
+            return original(self, *args)
+
+        monkeypatch.setattr(DataPreprocessor, method, counted)
+
+    DataPreprocessor(config).process_data()
+    assert calls == ["attribute", "kg"]
+
+    DataPreprocessor(config).process_data()
+    assert calls == ["attribute", "kg"]
+
+    write_kg(120)
+    DataPreprocessor(config).process_data()
+    assert calls == ["attribute", "kg", "kg"]
+
+    config.hops = 3
+    DataPreprocessor(config).process_data()
+    assert calls == ["attribute", "kg", "kg", "kg"]
+    DataPreprocessor(config).process_data()
+    assert calls == ["attribute", "kg", "kg", "kg"]
@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from redkg.replay_buffer import PrioritizedReplayBuffer, ReplayBuffer, SumTree
+
+
+def test_replay_buffer_ring():
+    buffer = ReplayBuffer(capacity=4, state_dim=2)
+    for step in range(6):
+        buffer.add(torch.full((2,), float(step)), step % 3, float(step), torch.full((2,), step + 1.0), step == 5)
+
+    assert len(buffer) == 4
+    # The two oldest transitions were overwritten in place
+    assert buffer.rewards.tolist() == [4.0, 5.0, 2.0, 3.0]
+    states, actions, rewards, next_states, dones = buffer.sample(32)
+    assert states.shape == (32, 2) and actions.dtype == torch.long and dones.dtype == torch.bool
+    assert torch.equal(states[:, 0], rewards)
+    assert torch.equal(next_states[:, 0], rewards + 1)
+    assert torch.equal(dones, rewards == 5)
+
+
+def test_sum_tree():
+    tree = SumTree(5)
+    tree.update(np.arange(5), np.array([1.0, 0.0, 2.0, 3.0, 4.0]))
+    assert tree.total == 10.0
+    assert tree.find(np.array([0.0, 0.99, 1.0, 2.5, 3.0, 5.9, 6.0, 9.99])).tolist() == [0, 0, 2, 2, 3, 3, 4, 4]
+    tree.update(np.array([3, 3]), np.array([0.5, 0.5]))
+    assert tree.total == 7.5
+
+
+def test_prioritized_replay_buffer():
+    np.random.seed(0)
+    buffer = PrioritizedReplayBuffer(capacity=8, state_dim=1, alpha=1.0, beta=1.0)
+    buffer.add_batch(
+        torch.arange(8.0).unsqueeze(1), torch.zeros(8), torch.arange(8.0), torch.zeros(8, 1), torch.zeros(8)
+    )
+    buffer.update_priorities(torch.arange(8), torch.tensor([0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 9.0]))
+
+    (states, _, rewards, _, _), rows, weights = buffer.sample_prioritized(1000)
+
+    assert torch.equal(states[:, 0], rewards) and torch.equal(rewards, rows.float())
+    assert (rows == 7).float().mean() > 0.99
+    # Frequently sampled transitions get the smallest importance sampling weights
+    assert weights.max() == 1.0 and weights[rows == 7].max() == weights.min()
@@ -0,0 +1,24 @@
+import os
+
+from redkg.stage_cache import StageCache
+
+
+def test_stage_cache(tmp_path):
+    input_path, output_path = tmp_path / "input.txt", tmp_path / "output.pkl"
+    input_path.write_text("1\t2\t3\n")
+    cache = StageCache(str(tmp_path))
+    key = cache.stage_key("kg", [str(input_path)], {"hops": 2})
+
+    assert not cache.is_fresh("kg", key, [str(output_path)])
+    output_path.write_bytes(b"")
+    cache.commit("kg", key)
+
+    reopened = StageCache(str(tmp_path))
+    assert reopened.is_fresh("kg", reopened.stage_key("kg", [str(input_path)], {"hops": 2}), [str(output_path)])
+    assert reopened.stage_key("kg", [str(input_path)], {"hops": 3}) != key
+    assert reopened.stage_key("kg", [str(input_path)], {"hops": 2}, upstream=["attribute"]) != key
+
+    input_path.write_text("1\t2\t4\n")
+    assert reopened.stage_key("kg", [str(input_path)], {"hops": 2}) != key
+    os.remove(output_path)
+    assert not reopened.is_fresh("kg", key, [str(output_path)])
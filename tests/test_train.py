@@ -0,0 +1,114 @@
+import numpy as np
+import torch
+from torch.functional import F
+
+from redkg.config import Config
+from redkg.train import TrainPipeline
+from redkg.utils import pickle_dump
+from tests.utils import gcn_gru_layer
+
+
+def _pipeline(**overrides):
+    config = Config()
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    pipeline = TrainPipeline(config, item_vocab={}, model=None, optimizer=None)
+    states = torch.randn(64, config.state_embed_dim)
+    pipeline.memory.add_batch(
+        states, torch.randint(3, (64,)), torch.rand(64), torch.randn(64, config.state_embed_dim), torch.rand(64) < 0.2
+    )
+    return pipeline
+
+
+def test_optimize_model():
+    torch.manual_seed(0)
+    pipeline = _pipeline(replay_batch_size=256)
+    rows = torch.randint(len(pipeline.memory), (256,))
+    pipeline.memory_sampling = lambda memory: (memory.transitions(rows), None, None)
+    states, actions, rewards, next_states, dones = pipeline.memory.transitions(rows)
+
+    # Reference: per-row Bellman targets written into the predicted Q values one by one
+    predicted = pipeline.policy_net(states)
+    expected = predicted.tolist()
+    for i, next_values in enumerate(pipeline.target_net(next_states).tolist()):
+        expected[i][actions[i]] = rewards[i].item() + (0.0 if dones[i] else pipeline.config.discount * max(next_values))
+    reference = F.smooth_l1_loss(predicted, torch.tensor(expected)).item()
+
+    assert abs(pipeline.optimize_model(pipeline.memory) - reference) < 1e-6
+    # The optimizer keeps its state between steps
+    pipeline.optimize_model(pipeline.memory)
+    assert pipeline.dqn_optimizer.state[next(pipeline.policy_net.parameters())]["step"] == 2
+
+
+def test_optimize_model_prioritized():
+    torch.manual_seed(0)
+    pipeline = _pipeline(replay_batch_size=32, prioritized_replay=True)
+    memory = pipeline.memory
+    rows = torch.randint(len(memory), (32,))
+    weights = torch.rand(32)
+    memory.sample_prioritized = lambda batch_size: (memory.transitions(rows), rows, weights)
+    states, actions, rewards, next_states, dones = memory.transitions(rows)
+
+    predicted = pipeline.policy_net(states)
+    with torch.no_grad():
+        targets = rewards + pipeline.config.discount * pipeline.target_net(next_states).max(dim=1).values * (~dones)
+    expected = predicted.detach().scatter(1, actions.unsqueeze(1), targets.unsqueeze(1))
+    sample_loss = F.smooth_l1_loss(predicted, expected, reduction="none").mean(dim=1)
+    td_errors = predicted.detach().gather(1, actions.unsqueeze(1)).squeeze(1) - targets
+
+    assert abs(pipeline.optimize_model(memory) - (weights * sample_loss).mean().item()) < 1e-6
+    priorities = memory.tree.tree[rows.numpy() + memory.tree.size]
+    assert np.allclose(priorities, (td_errors.abs().numpy() + memory.eps) ** memory.alpha)
+
+
+def test_update_target():
+    pipeline = _pipeline(target_soft_update=0.5)
+    with torch.no_grad():
+        for param in pipeline.policy_net.parameters():
+            param.add_(1.0)
+    before = [param.clone() for param in pipeline.target_net.parameters()]
+
+    pipeline.update_target(step=1)
+
+    for old, new, policy in zip(before, pipeline.target_net.parameters(), pipeline.policy_net.parameters()):
+        assert torch.allclose(new, (old + policy) / 2)
+
+
+def test_eps_greedy_maps_actions_to_candidates():
+    pipeline = _pipeline(epsilon=0.0)
+    state = torch.randn(pipeline.config.state_embed_dim)
+    item = torch.randn(4)
+    candidates = torch.randn(10, 4)
+    action = int(pipeline.policy_net(state).argmax())
+
+    # Action a recommends the a-th candidate closest to the item, among all the candidates
+    assert pipeline.tmp_Q_eps_greedy(state, candidates, item) == (
+        action,
+        int((candidates @ item).argsort()[-1 - action]),
+    )
+    # Actions without a candidate are never picked
+    assert pipeline.tmp_Q_eps_greedy(state, candidates[:1], item) == (0, 0)
+    assert pipeline.tmp_Q_eps_greedy(state, candidates[:0], item) is None
+
+    pipeline.config.epsilon = 1.0
+    assert {pipeline.tmp_Q_eps_greedy(state, candidates[:2], item)[0] for _ in range(50)} == {0, 1}
+
+
+def test_run_parallel(tmp_path):
+    torch.manual_seed(0)
+    config = Config()
+    config.num_rollout_workers, config.rollout_envs, config.replay_batch_size = 2, 3, 8
+    model = gcn_gru_layer(tmp_path, config, hops=1)
+    model.gru = torch.nn.GRU(4, config.state_embed_dim, 2)
+    rng = np.random.default_rng(0)
+    rating_dict = {user: [[int(item), 4.0, t] for t, item in enumerate(rng.integers(0, 6, 5))] for user in range(7)}
+    pickle_dump(str(tmp_path / "train_data_dict.pkl"), rating_dict)
+    pipeline = TrainPipeline(config, item_vocab={}, model=model, optimizer=None)
+    before = [param.clone() for param in pipeline.policy_net.parameters()]
+
+    losses = pipeline.run_parallel(num_steps=5)
+
+    assert len(losses) == 5
+    assert len(pipeline.memory) > 100
+    assert set(pipeline.memory.rewards[: len(pipeline.memory)].tolist()) <= {0.0, 4.0}
+    assert any(not torch.equal(old, new) for old, new in zip(before, pipeline.policy_net.parameters()))
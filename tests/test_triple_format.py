@@ -0,0 +1,80 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from redkg import dataloader
+from redkg.triple_format import CategoricalColumn, MappedArray, load_triples, save_triples
+from redkg.triple_store import TripleStore
+from redkg.utils import AttributeDict
+from tests.utils import read_test_data
+
+train, test, valid = read_test_data()
+
+
+def test_save_load_triples(tmp_path):
+    triples = test.rename(columns={"neg_head": "head_neg", "neg_tail": "tail_neg"})
+    save_triples(triples, str(tmp_path))
+
+    loaded = load_triples(str(tmp_path))
+
+    assert isinstance(loaded["head"], np.memmap)
+    assert loaded["head_neg"].shape == (len(test), 10)
+    assert loaded["tail_neg"].tolist() == test["neg_tail"].tolist()
+
+    args = AttributeDict(nentity=20, nrelation=2)
+    for mode in ["head-batch", "tail-batch"]:
+        batches = [
+            next(
+                iter(
+                    DataLoader(
+                        dataloader.TestDataset(data, args, mode, False),
+                        batch_size=8,
+                        collate_fn=dataloader.TestDataset.collate_fn,
+                    )
+                )
+            )
+            for data in (triples, loaded)
+        ]
+        assert torch.equal(batches[0][0], batches[1][0])
+        assert torch.equal(batches[0][1], batches[1][1])
+        assert batches[1][1].shape == (8, 11)
+
+
+def test_save_load_typed_triples(tmp_path):
+    triples = {
+        "head": np.array([0, 1, 2]),
+        "relation": np.array([0, 1, 0]),
+        "tail": np.array([1, 0, 3]),
+        "head_type": np.array(["drug", "drug", "protein"]),
+        "tail_type": np.array(["protein", "drug", "protein"]),
+    }
+    entity_dict = {"drug": (0, 3), "protein": (3, 7)}
+    save_triples(triples, str(tmp_path))
+
+    loaded = load_triples(str(tmp_path))
+    store = TripleStore.from_triples(loaded, 7, 2, entity_dict)
+    dataset = dataloader.TrainDataset(loaded, 7, 2, 4, "tail-batch", count=store, entity_dict=entity_dict)
+
+    assert isinstance(loaded["tail_type"], CategoricalColumn)
+    assert list(loaded["tail_type"]) == ["protein", "drug", "protein"]
+    assert dataset.__getitems__([0, 1, 2])[0].tolist() == [[0, 0, 4], [1, 1, 0], [5, 0, 6]]
+    # The columns are referenced, not copied, and pickled as their files
+    assert np.shares_memory(dataset.head, loaded["head"])
+    assert np.shares_memory(dataset.tail_codes, loaded["tail_type"].codes)
+    restored = pickle.loads(pickle.dumps(dataset))
+    assert isinstance(restored.head, MappedArray) and restored.head.source.filename == loaded["head"].source.filename
+    assert restored.tail_codes.source.offset == loaded["tail_type"].codes.source.offset
+    # Arrays derived from a column are not whole files and are pickled by value
+    assert loaded["head"][1:].source is None
+    dataset.head = loaded["head"][:]
+    copied = pickle.loads(pickle.dumps(dataset)).head
+    assert copied.source is None and copied.tolist() == loaded["head"].tolist()
+    assert torch.equal(restored.__getitems__([0, 1, 2])[0], dataset.__getitems__([0, 1, 2])[0])
+
+
+def test_save_ragged_negatives(tmp_path):
+    with pytest.raises(ValueError):
+        save_triples({"head": [0, 1], "relation": [0, 0], "tail": [1, 0], "head_neg": [[1, 2], [0]]}, str(tmp_path))
@@ -0,0 +1,85 @@
+import pickle
+from collections import defaultdict
+
+import numpy as np
+
+from redkg.dataloader import get_info
+from redkg.triple_store import TripleStore
+from redkg.utils import AttributeDict
+from tests.utils import read_test_data
+
+train, test, valid = read_test_data()
+
+
+def test_triple_store_matches_dicts():
+    store = TripleStore.from_triples(train, nentity=20, nrelation=2)
+
+    true_head, true_tail = defaultdict(list), defaultdict(list)
+    for head, relation, tail in zip(train["head"], train["relation"], train["tail"]):
+        true_head[(relation, tail)].append(head)
+        true_tail[(head, relation)].append(tail)
+
+    for (head, relation), tails in true_tail.items():
+        assert store.true_tails(head, relation).tolist() == tails
+    for (relation, tail), heads in true_head.items():
+        assert store.true_heads(relation, tail).tolist() == heads
+    assert len(store.true_tails(19, 1)) == len(true_tail.get((19, 1), []))
+
+
+def test_triple_store_filter_index():
+    store = TripleStore.from_triples(train, nentity=20, nrelation=2)
+    anchor, relation = np.array([3, 0, 19]), np.array([1, 1, 0])
+
+    rows, cols = store.filter_index(anchor, relation, "tail-batch")
+
+    for row in range(3):
+        assert cols[rows == row].tolist() == store.true_tails(anchor[row], relation[row]).tolist()
+
+
+def test_triple_store_save_load(tmp_path):
+    store = TripleStore.from_triples(train, nentity=20, nrelation=2)
+    store.save(str(tmp_path))
+
+    loaded = TripleStore.load(str(tmp_path))
+    unpickled = pickle.loads(pickle.dumps(loaded))
+
+    assert isinstance(loaded.head_index.values, np.memmap)
+    assert isinstance(unpickled.tail_index.values, np.memmap)
+    weights = store.subsampling_weight(store.head, store.relation, store.tail)
+    assert np.array_equal(weights, unpickled.subsampling_weight(store.head, store.relation, store.tail))
+
+
+def test_get_info_compatibility_views():
+    info = get_info(triples=train, dataset=AttributeDict(nentity=20, nrelation=2))
+
+    count = defaultdict(lambda: 4)
+    true_head, true_tail = defaultdict(list), defaultdict(list)
+    for head, relation, tail in zip(train["head"], train["relation"], train["tail"]):
+        count[(head, relation)] += 1
+        count[(tail, -relation - 1)] += 1
+        true_head[(relation, tail)].append(head)
+        true_tail[(head, relation)].append(tail)
+
+    for key, value in count.items():
+        assert info["count"][key] == value
+    assert info["count"][(19, 1)] == count[(19, 1)]
+    for key, heads in true_head.items():
+        assert info["true_head"][key] == heads
+    for key, tails in true_tail.items():
+        assert info["true_tail"][key] == tails
+
+
+def test_count_view_typed():
+    triples = {
+        "head": np.array([0, 1, 0]),
+        "relation": np.array([0, 0, 1]),
+        "tail": np.array([1, 1, 0]),
+        "head_type": np.array(["drug", "drug", "protein"]),
+        "tail_type": np.array(["protein", "protein", "drug"]),
+    }
+    info = get_info(triples=triples, dataset=[{"num_nodes_dict": {"drug": 3, "protein": 4}}], do_count=True)
+
+    assert info["count"][(0, 0, "drug")] == 5
+    assert info["count"][(1, -1, "protein")] == 6
+    assert info["count"][(0, 1, "protein")] == 5
+    assert info["count"][(0, 1, "drug")] == 4
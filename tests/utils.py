@@ -1,6 +1,14 @@
 import pathlib
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+
+from redkg.config import Config
+from redkg.evaluator import Evaluator
+from redkg.models.gcn_gru_layers import AbstractLayer
+from redkg.models.kge import KGEModel
+from redkg.n_hop_index import NHopIndex
 
 
 def read_test_data():
@@ -13,3 +21,34 @@ def read_test_data():
         i["neg_head"] = [eval(l_) for l_ in i["neg_head"]]
         i["neg_tail"] = [eval(l_) for l_ in i["neg_tail"]]
     return train, test, valid
+
+
+def kge_model(model_name, nentity=30, nrelation=4, hidden_dim=8, **kwargs):
+    """KGEModel with the embedding layout the model requires"""
+    return KGEModel(
+        model_name=model_name,
+        nentity=nentity,
+        nrelation=nrelation,
+        hidden_dim=hidden_dim,
+        gamma=12.0,
+        evaluator=Evaluator(),
+        double_entity_embedding=model_name in ("ComplEx", "RotatE"),
+        double_relation_embedding=model_name == "ComplEx",
+        **kwargs,
+    )
+
+
+def gcn_gru_layer(tmp_path, config=None, nentity=6, nfeat=4, hops=2):
+    """AbstractLayer with a TransE KGE model over a path graph whose adjacency and n-hop index are saved in tmp_path"""
+    adj = sp.csr_matrix(np.eye(nentity, k=1) + np.eye(nentity, k=-1))
+    config = config if config is not None else Config()
+    config.preprocess_results_dir = str(tmp_path)
+    config.adj_path = str(tmp_path / "kg_adj_mat.npz")
+    sp.save_npz(config.adj_path, adj)
+    NHopIndex.build(adj, hops=hops).save(str(tmp_path / "n_hop_kg"))
+
+    layer = AbstractLayer(config, {i: i for i in range(nentity + 1)}, {0: 0, 1: 1}, nfeat)
+    layer.kge_model = KGEModel(
+        model_name="TransE", nentity=nentity, nrelation=1, hidden_dim=nfeat, gamma=12.0, evaluator=Evaluator()
+    )
+    return layer